@@ -0,0 +1,133 @@
+import re
+from bisect import bisect_left, bisect_right, insort
+from functools import lru_cache
+
+# the sorted account names are kept in chunks of about this many names, so adding or removing a name
+# only shifts the names in one chunk
+INDEX_CHUNK_SIZE = 1000
+# number of compiled wildcards kept around for repeated listings
+PATTERN_CACHE_SIZE = 256
+
+# characters that have a special meaning somewhere in a regex
+_REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+# quantifiers that let the character before them not appear at all
+_OPTIONAL = set("*?{")
+
+
+# the literal text every match of the regex must start with, if the regex is anchored at the start;
+# only a simple run of plain or escaped characters after the ^ is recognized, which covers prefix,
+# exact and glob (see glob_to_regex) wildcards
+def literal_prefix(wildcard):
+    # an alternative can match without the prefix
+    if not wildcard.startswith("^") or "|" in wildcard:
+        return ""
+    prefix = []
+    i = 1
+    while i < len(wildcard):
+        c, width = wildcard[i], 1
+        if c == "\\":
+            # an escaped letter or digit is a character class like \d, not a literal
+            if i + 1 == len(wildcard) or wildcard[i + 1].isalnum():
+                break
+            c, width = wildcard[i + 1], 2
+        elif c in _REGEX_SPECIAL:
+            break
+        following = wildcard[i + width:i + width + 1]
+        if following in _OPTIONAL:
+            break
+        prefix.append(c)
+        if following == "+":
+            # the character appears at least once, but we don't know what comes after it
+            break
+        i += width
+    return "".join(prefix)
+
+
+# compile a wildcard and work out the prefix its matches must have, remembering recent wildcards
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_wildcard(wildcard):
+    return re.compile(wildcard), literal_prefix(wildcard)
+
+
+# the set of account names in sorted order, so that listing the accounts with a given prefix or after
+# a given name only looks at that range. Membership checks go through a plain set; writers must
+# serialize their updates, but readers may check membership without locking
+class AccountIndex:
+    def __init__(self, names=()):
+        self.names = set(names)
+        ordered = sorted(self.names)
+        self.chunks = [ordered[i:i + INDEX_CHUNK_SIZE] for i in range(0, len(ordered), INDEX_CHUNK_SIZE)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]  # the last name in each chunk
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def add(self, name):
+        if name in self.names:
+            return
+        self.names.add(name)
+        if not self.chunks:
+            self.chunks.append([name])
+            self.maxes.append(name)
+            return
+        i = min(bisect_left(self.maxes, name), len(self.chunks) - 1)
+        chunk = self.chunks[i]
+        insort(chunk, name)
+        self.maxes[i] = chunk[-1]
+        if len(chunk) > 2 * INDEX_CHUNK_SIZE:
+            # split an overgrown chunk in half
+            self.chunks[i:i + 1] = [chunk[:INDEX_CHUNK_SIZE], chunk[INDEX_CHUNK_SIZE:]]
+            self.maxes[i:i + 1] = [chunk[INDEX_CHUNK_SIZE - 1], chunk[-1]]
+
+    def discard(self, name):
+        if name not in self.names:
+            return
+        self.names.discard(name)
+        i = bisect_left(self.maxes, name)
+        chunk = self.chunks[i]
+        del chunk[bisect_left(chunk, name)]
+        if chunk:
+            self.maxes[i] = chunk[-1]
+        else:
+            del self.chunks[i]
+            del self.maxes[i]
+
+    # a copy of the names in the chunk holding the first name after key (or at key, if inclusive),
+    # starting from that name; an empty list means there are no more names
+    def slice_from(self, key, inclusive=True):
+        find = bisect_left if inclusive else bisect_right
+        i = find(self.maxes, key)
+        if i == len(self.chunks):
+            return []
+        chunk = self.chunks[i]
+        return chunk[find(chunk, key):]
+
+
+# keeps a single copy of each user name, so that the sets and dicts that mention a user share the one
+# copy of their name instead of each holding the copy that came off the wire. A name is released when
+# its account is deleted, so the table only holds the names of accounts that exist
+class UserNames:
+    def __init__(self):
+        self.names = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    # the stored copy of a name, storing this one if there isn't one yet; setdefault is atomic under
+    # the GIL, so two threads storing the same name end up sharing whichever copy got there first
+    def canonical(self, name):
+        return self.names.setdefault(name, name)
+
+    # forget a name, e.g. once its account is deleted; anything still holding the old copy keeps it
+    def release(self, name):
+        self.names.pop(name, None)
+
+    def clear(self):
+        self.names.clear()
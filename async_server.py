@@ -0,0 +1,151 @@
+import asyncio
+import os
+from functools import partial
+from common import *
+from server import Server, Connection, log, PEER_RECONNECT_INTERVAL, PEER_CONNECT_TIMEOUT, OUTPUT_HIGH_WATER, OUTPUT_LOW_WATER, PROFILE_FILE, READ_WAIT_TIMEOUT, \
+    REQUEST_ERRORS
+
+# how many not yet accepted connections each listening socket will queue up
+LISTEN_BACKLOG = 4096
+
+
+# a server that handles client RPCs, heartbeats, chat streams and forwarding to the other servers as
+# coroutines on a single asyncio event loop; all of the chat service state and methods are shared with Server
+class AsyncServer(Server):
+    # sockets are opened on the event loop once the server runs rather than in the constructor
+    def setup_network(self):
+        if self.workers:
+            raise ValueError("Worker processes are only supported by the selector engine")
+        self.loop = None
+        self.main_task = None
+        self.tasks = set()
+        _, self.peer_targets = self.peer_links()
+
+    # writes are buffered by the transport, which sends them as soon as the socket is writable
+    def queue_output(self, data, frame, query=False):
+        data.writer.write(self.pack(data, frame))
+        self.metrics.record_peak("output_buffer_bytes", self.output_backlog(data))
+
+    # stream frames to a connection, waiting for the transport to drain between frames
+    def send_frames(self, data, frames):
+        async def send():
+            for frame in frames:
+                data.writer.write(self.pack(data, frame))
+                await data.writer.drain()
+        self.start_task(send())
+
+    def output_backlog(self, data):
+        return data.writer.transport.get_write_buffer_size()
+
+    # hold off on delivering a user's messages, and pick back up once the transport has drained
+    def throttle_stream(self, data):
+        super().throttle_stream(data)
+        async def resume():
+            try:
+                await data.writer.drain()
+            except ConnectionError:
+                return
+            data.stream_throttled = False
+            self.notify_stream(data.stream_user)
+        self.start_task(resume())
+
+    # make sure the read gets answered or turned away once it has waited READ_WAIT_TIMEOUT seconds
+    def hold_read(self, read):
+        super().hold_read(read)
+        self.loop.call_later(READ_WAIT_TIMEOUT, self.flush_pending)
+
+    # schedule a flush on the event loop; this is safe to call from any thread
+    def wakeup(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.flush_pending)
+
+    # run a coroutine in the background, keeping a reference to it so it isn't garbage collected while it runs
+    def start_task(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    # read frames off a connection until it closes, handling each request as it arrives
+    async def handle_connection(self, reader, writer, is_peer=False, addr=None):
+        data = Connection(addr or writer.get_extra_info("peername"), is_peer=is_peer, writer=writer)
+        # drain() blocks once the transport has OUTPUT_HIGH_WATER bytes buffered, until it's down to OUTPUT_LOW_WATER
+        writer.transport.set_write_buffer_limits(high=OUTPUT_HIGH_WATER, low=OUTPUT_LOW_WATER)
+        log.info("Accepted connection from %s", data.addr)
+        if is_peer:
+            self.add_peer(data)
+        try:
+            while chunk := await reader.read(RECV_BUFFER_SIZE):
+                data.inb += chunk
+                for request in pop_frames(data.inb):
+                    self.handle_request(data, *request)
+                self.flush_pending()
+                # stop reading from a client that isn't keeping up with its replies
+                if not is_peer and self.output_backlog(data) >= OUTPUT_HIGH_WATER:
+                    self.metrics.increment("reads_paused")
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # the connection dropped or the server is shutting down
+            pass
+        except REQUEST_ERRORS as e:
+            log.warning("Closing connection to %s: %s", data.addr, e)
+            self.metrics.increment("bad_requests")
+        finally:
+            log.info("Closing connection to %s", data.addr)
+            self.connection_closed(data)
+            writer.close()
+
+    # connect to every server we're supposed to connect to that we don't have a connection with
+    async def connect_peers(self, quiet=False):
+        connected = {peer.addr for peer in self.peers}
+        for addr, port in self.peer_targets:
+            if (addr, port) in connected:
+                continue
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(addr, port), PEER_CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                if not quiet:
+                    log.warning("Connection refused on address %s and port %s", addr, port)
+                continue
+            self.start_task(self.handle_connection(reader, writer, is_peer=True, addr=(addr, port)))
+
+    # periodically try to reconnect to servers that are down, and write out the metrics if it's time to
+    async def reconnect_peers(self):
+        while True:
+            await asyncio.sleep(PEER_RECONNECT_INTERVAL)
+            await self.connect_peers(quiet=True)
+            self.maybe_dump_stats()
+
+    # listen on the client facing port, listen or connect on the server facing ports, and serve until stopped
+    async def serve_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        listen_ports, _ = self.peer_links()
+        address = self.addresses[self.id]
+        listeners = []
+        for port, is_peer in [(self.client_facing_ports[self.id], False), *((port, True) for port in listen_ports)]:
+            listeners.append(await asyncio.start_server(partial(self.handle_connection, is_peer=is_peer), address, port,
+                                                        backlog=LISTEN_BACKLOG, reuse_address=True))
+            log.info("Listening on %s", (address, port))
+        await self.connect_peers()
+        try:
+            await asyncio.gather(self.reconnect_peers(), *(listener.serve_forever() for listener in listeners))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for listener in listeners:
+                listener.close()
+            for task in list(self.tasks):
+                task.cancel()
+            self.wal.close()
+            self.history.close()
+            if self.profiler is not None:
+                self.profiler.dump(os.path.join(self.log_dir, PROFILE_FILE))
+
+    def run(self):
+        asyncio.run(self.serve_async())
+
+    # stop the server from any thread, e.g. to simulate a crash
+    def stop(self):
+        self.running = False
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
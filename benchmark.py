@@ -0,0 +1,1292 @@
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import selectors
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from collections import deque
+from common import *
+from server import Server, Connection, REPLICATION_LOG_SIZE, STREAM_BATCH_SIZE
+from accounts import AccountIndex, UserNames
+from async_server import AsyncServer
+from client import Client
+from history import HistoryStore, direct_conversation
+from mailboxes import Mailboxes
+from sharding import localhost_cluster, ring_for
+from wal import WriteAheadLog
+
+LOCALHOST = "127.0.0.1"
+
+
+# run fn repeatedly for roughly the given number of seconds and return calls per second
+def measure_rate(fn, seconds=1.0):
+    calls = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            fn()
+        calls += 100
+    return round(calls / (time.perf_counter() - start))
+
+
+# return the pth percentile of a list of numbers
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+# keyword arguments for Server that put all three servers on localhost starting at base_port
+def server_kwargs(base_port):
+    return dict(server_addr_0=LOCALHOST, server_addr_1=LOCALHOST, server_addr_2=LOCALHOST,
+                cfp_0=base_port, cfp_1=base_port + 1, cfp_2=base_port + 2,
+                sfp_0=base_port + 3, sfp_1=base_port + 4, sfp_2=base_port + 5)
+
+
+def _server_process_main(id, kwargs, use_asyncio, conn):
+    # keep the per-request logging and the log directories out of the benchmark's way
+    os.chdir(tempfile.mkdtemp(prefix=f"bench_server_{id}_"))
+    sys.stdout = open(os.devnull, "w")
+    server = AsyncServer(id, **kwargs) if use_asyncio else Server(id, **kwargs)
+    t = threading.Thread(target=server.run)
+    t.daemon = True
+    t.start()
+    conn.send("ready")
+    # answer cpu time and metrics queries until told to stop
+    while (query := conn.recv()) != "stop":
+        conn.send(time.process_time() if query == "cpu" else server.metrics.snapshot())
+
+
+# a server running in its own process so its cpu use can be measured separately from the clients
+class ServerProcess:
+    def __init__(self, id, base_port, use_asyncio=False, **options):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_server_process_main,
+                                               args=(id, {**server_kwargs(base_port), **options}, use_asyncio, child_conn))
+        # a daemonic process isn't allowed to start the server's worker processes
+        self.process.daemon = not options.get("workers")
+        self.process.start()
+        assert self.conn.recv() == "ready"
+
+    def cpu_time(self):
+        self.conn.send("cpu")
+        return self.conn.recv()
+
+    def metrics(self):
+        self.conn.send("metrics")
+        return self.conn.recv()
+
+    # the server process's resident memory in bytes
+    def rss(self):
+        with open(f"/proc/{self.process.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+
+    def stop(self):
+        self.conn.send("stop")
+        self.process.join()
+
+    # kill the server without letting it shut down cleanly, like a crash
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+
+
+# run in-process servers from a fresh directory, with their per-request logging silenced
+@contextlib.contextmanager
+def sandbox(prefix):
+    workdir = os.getcwd()
+    os.chdir(tempfile.mkdtemp(prefix=prefix))
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(workdir)
+
+
+# start an in-process server on a background thread
+def start_server(server):
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    server.thread = thread
+    return server
+
+
+# close the sockets and flush the log of an in-process server that was called directly rather than
+# run; with running cleared, run() goes straight to its shutdown
+def close_server(server):
+    server.running = False
+    server.run()
+
+
+# call a server method over a raw framed connection and return the reply
+def rpc(sock, buf, method, *args):
+    sock.sendall(encode_frame((True, SERVER_METHODS.index(method), args, 0)))
+    output = recv_frame(sock, buf)[1]
+    return output
+
+
+# compare the framed binary codec against the old repr/eval wire format on typical payloads
+def bench_protocol(args):
+    payloads = {
+        "send_message_request": (True, SERVER_METHODS.index('SendMessage'), ("alice", "bob", "hello there, how are you?"), 1),
+        "list_accounts_reply": [f"user_{i}" for i in range(100)],
+        "stream_message": SingleMessage("alice", "x" * 512),
+    }
+    results = {}
+    for name, payload in payloads.items():
+        legacy = str(payload).encode("utf-8")
+        framed = encode_frame(payload)
+        # decoding goes through the incremental decoder so the buffer handling is included
+        stream = framed * 100
+        results[name] = {
+            "legacy_bytes": len(legacy),
+            "framed_bytes": len(framed),
+            "legacy_encode_per_s": measure_rate(lambda: str(payload).encode("utf-8"), args.seconds),
+            "framed_encode_per_s": measure_rate(lambda: encode_frame(payload), args.seconds),
+            "legacy_decode_per_s": measure_rate(lambda: eval(legacy.decode("utf-8")), args.seconds),
+            "framed_decode_per_s": 100 * measure_rate(lambda: pop_frames(bytearray(stream)), args.seconds),
+        }
+    return results
+
+
+# measure end-to-end chat stream delivery latency and server cpu use with many concurrent streams
+def bench_streams(args):
+    server = ServerProcess(0, args.base_port, args.asyncio)
+    try:
+        control = socket.create_connection((LOCALHOST, args.base_port))
+        control_buf = bytearray()
+        users = [f"user_{i}" for i in range(args.streams)]
+        sel = selectors.DefaultSelector()
+        for user in users:
+            rpc(control, control_buf, "CreateAccount", user)
+            rpc(control, control_buf, "Login", user)
+            stream = socket.create_connection((LOCALHOST, args.base_port))
+            stream.sendall(encode_frame((True, STREAM_CODE, (user,), 0)))
+            sel.register(stream, selectors.EVENT_READ, data=bytearray())
+
+        # cpu burned by the server while every stream is open but no messages are flowing
+        cpu_start = server.cpu_time()
+        time.sleep(args.seconds)
+        idle_cpu = (server.cpu_time() - cpu_start) / args.seconds
+
+        latencies = []
+        def receive():
+            while len(latencies) < args.messages:
+                for key, _ in sel.select(timeout=1.0):
+                    chunk = key.fileobj.recv(RECV_BUFFER_SIZE)
+                    key.data.extend(chunk)
+                    now = time.perf_counter()
+                    for _, batch in pop_frames(key.data):
+                        latencies.extend(now - float(msg.message) for msg in batch)
+        receiver = threading.Thread(target=receive)
+        receiver.daemon = True
+        receiver.start()
+
+        cpu_start = server.cpu_time()
+        start = time.perf_counter()
+        for i in range(args.messages):
+            rpc(control, control_buf, "SendMessage", "bench", users[i % len(users)], repr(time.perf_counter()))
+        receiver.join(timeout=30)
+        elapsed = time.perf_counter() - start
+        load_cpu = server.cpu_time() - cpu_start
+        return {
+            "engine": "asyncio" if args.asyncio else "selectors",
+            "streams": args.streams,
+            "messages": args.messages,
+            "delivered": len(latencies),
+            "idle_server_cpu_fraction": round(idle_cpu, 4),
+            "load_server_cpu_seconds": round(load_cpu, 4),
+            "messages_per_s": round(len(latencies) / elapsed),
+            "delivery_latency_p50_ms": round(1000 * percentile(latencies, 50), 3),
+            "delivery_latency_p99_ms": round(1000 * percentile(latencies, 99), 3),
+        }
+    finally:
+        server.stop()
+
+
+# hammer a single in-process Server with concurrent SendMessage, Login and ListAccounts callers
+def bench_contention(args):
+    with sandbox("bench_contention_"):
+        server = Server(0, **server_kwargs(args.base_port))
+        users = [f"user_{i}" for i in range(args.users)]
+        for user in users:
+            server.CreateAccount(user)
+            server.Login(user)
+        operations = {
+            "SendMessage": lambda rng: server.SendMessage("bench", rng.choice(users), "hello"),
+            "Login": lambda rng: server.Login(rng.choice(users)),
+            "ListAccounts": lambda rng: server.ListAccounts("^user_1"),
+        }
+        counts = {name: 0 for name in operations}
+        latencies = []
+        stop = threading.Event()
+        def caller(seed):
+            rng = random.Random(seed)
+            names = list(operations)
+            # keep per-thread counts so the counting itself doesn't race
+            local_counts = {name: 0 for name in operations}
+            while not stop.is_set():
+                name = rng.choice(names)
+                start = time.perf_counter()
+                operations[name](rng)
+                latencies.append(time.perf_counter() - start)
+                local_counts[name] += 1
+            with counts_lock:
+                for name, count in local_counts.items():
+                    counts[name] += count
+        counts_lock = threading.Lock()
+        threads = [threading.Thread(target=caller, args=(i,)) for i in range(args.threads)]
+        for t in threads:
+            t.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for t in threads:
+            t.join()
+        # drain the mailboxes so repeated runs start from the same state
+        server.chats.clear()
+        histograms = server.metrics.snapshot()["histograms"]
+        close_server(server)
+        return {
+            "threads": args.threads,
+            "users": args.users,
+            "ops_per_s": round(sum(counts.values()) / args.seconds),
+            "ops_per_s_by_method": {name: round(count / args.seconds) for name, count in counts.items()},
+            "latency_p50_us": round(1e6 * percentile(latencies, 50), 2),
+            "latency_p99_us": round(1e6 * percentile(latencies, 99), 2),
+            # how often callers had to wait for each lock and for how long
+            "lock_waits": {name[len("lock_wait_seconds."):]: histogram for name, histogram in histograms.items()
+                           if name.startswith("lock_wait_seconds.")},
+        }
+
+
+# measure how many events/s the write-ahead log makes durable with concurrent writers, and how
+# long recovery takes as the log grows
+def bench_wal(args):
+    def writer(wal, stop, counts):
+        logged = 0
+        while not stop.is_set():
+            wal.wait_durable(wal.append(("message", "bob", SingleMessage("alice", "hello"))))
+            logged += 1
+        counts.append(logged)
+
+    wal = WriteAheadLog(tempfile.mkdtemp(prefix="bench_wal_"))
+    wal.recover(lambda state: None, lambda event: None)
+    stop = threading.Event()
+    counts = []
+    threads = [threading.Thread(target=writer, args=(wal, stop, counts)) for _ in range(args.threads)]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    wal.close()
+    results = {
+        "writers": args.threads,
+        "durable_events_per_s": round(sum(counts) / args.seconds),
+        "events_per_fsync": round(sum(counts) / max(wal.group_commits, 1), 2),
+        "recovery": [],
+    }
+
+    for size in args.wal_sizes:
+        directory = tempfile.mkdtemp(prefix="bench_wal_")
+        wal = WriteAheadLog(directory)
+        wal.recover(lambda state: None, lambda event: None)
+        for i in range(size):
+            wal.append(("create", f"user_{i}") if i % 10 == 0 else ("message", f"user_{i % 1000}", SingleMessage("alice", "hello")))
+        wal.close()
+        replayed = []
+        start = time.perf_counter()
+        WriteAheadLog(directory).recover(lambda state: None, replayed.append)
+        elapsed = time.perf_counter() - start
+        results["recovery"].append({
+            "events": size,
+            "log_bytes": sum(os.path.getsize(path) for _, path in WriteAheadLog(directory).segments()),
+            "recovery_s": round(elapsed, 4),
+            "events_replayed_per_s": round(len(replayed) / elapsed),
+        })
+    return results
+
+
+# measure how long a restarted backup takes to catch up with the leader as the backlog it missed grows
+def bench_catchup(args):
+    leader = ServerProcess(0, args.base_port)
+    results = []
+    try:
+        with sandbox("bench_catchup_"):
+            control = socket.create_connection((LOCALHOST, args.base_port))
+            control_buf = bytearray()
+            backup = start_server(Server(1, **server_kwargs(args.base_port)))
+            created = 0
+            for backlog in args.backlogs:
+                backup.stop()
+                backup.thread.join()
+                for _ in range(backlog):
+                    rpc(control, control_buf, "CreateAccount", f"user_{created}")
+                    created += 1
+                start = time.perf_counter()
+                # the restarted backup recovers from its own log and then asks the leader for the rest
+                backup = start_server(Server(1, **server_kwargs(args.base_port)))
+                while backup.applied_seq < created and time.perf_counter() - start < 60:
+                    time.sleep(0.001)
+                results.append({
+                    "backlog": backlog,
+                    "caught_up": backup.applied_seq >= created,
+                    "method": "delta" if backlog <= REPLICATION_LOG_SIZE else "state transfer",
+                    "catch_up_s": round(time.perf_counter() - start, 4),
+                })
+            backup.stop()
+    finally:
+        leader.stop()
+    return results
+
+
+# keep depth requests in flight on each of many connections to a server for the given number of
+# seconds and return the replies per second along with the latency of each request; make_request(n)
+# returns the (is_client, method_code, args) of the nth request
+def drive_requests(port, connections, seconds, make_request, depth=1):
+    sel = selectors.DefaultSelector()
+    counter = iter(range(1 << 62))
+    sent_at = {}
+    def send(conn, count):
+        frames = []
+        for _ in range(count):
+            n = next(counter)
+            sent_at[n] = time.perf_counter()
+            frames.append(encode_frame((*make_request(n), n)))
+        conn.sock.sendall(b"".join(frames))
+    for _ in range(connections):
+        sock = socket.create_connection((LOCALHOST, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = types.SimpleNamespace(sock=sock, inb=bytearray())
+        send(conn, depth)
+        sel.register(sock, selectors.EVENT_READ, data=conn)
+    latencies = []
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for key, _ in sel.select(timeout=1.0):
+            conn = key.data
+            conn.inb += conn.sock.recv(RECV_BUFFER_SIZE)
+            replies = pop_frames(conn.inb)
+            now = time.perf_counter()
+            for request_id, *_ in replies:
+                latencies.append(now - sent_at.pop(request_id))
+            # top the connection back up to depth requests in flight
+            if replies:
+                send(conn, len(replies))
+    elapsed = time.perf_counter() - start
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+    return len(latencies) / elapsed, latencies
+
+
+# compare write throughput on a lone server against a three server cluster in each ack mode
+def bench_replication(args):
+    create = SERVER_METHODS.index('CreateAccount')
+    setups = [("single_server", 1, 'leader'), ("cluster_leader_ack", 3, 'leader'), ("cluster_majority_ack", 3, 'majority')]
+    results = {}
+    for i, (name, size, ack_mode) in enumerate(setups):
+        base_port = args.base_port + 10 * i
+        servers = [ServerProcess(id, base_port, args.asyncio, ack_mode=ack_mode) for id in range(size)]
+        try:
+            rate, latencies = drive_requests(base_port, args.connections, args.seconds,
+                                             lambda n: (True, create, (f"{name}_{n}",)))
+        finally:
+            for server in servers:
+                server.stop()
+        results[name] = {
+            "writes_per_s": round(rate),
+            "latency_p50_ms": round(1000 * percentile(latencies, 50), 3),
+            "latency_p99_ms": round(1000 * percentile(latencies, 99), 3),
+        }
+    return results
+
+
+# compare write throughput with one request at a time on each connection against pipelining several
+def bench_pipelining(args):
+    create = SERVER_METHODS.index('CreateAccount')
+    results = {}
+    for i, depth in enumerate(args.depths):
+        base_port = args.base_port + 10 * i
+        server = ServerProcess(0, base_port, args.asyncio)
+        try:
+            rate, latencies = drive_requests(base_port, args.connections, args.seconds,
+                                             lambda n: (True, create, (f"depth_{depth}_{n}",)),
+                                             depth=depth)
+        finally:
+            server.stop()
+        results[f"depth_{depth}"] = {
+            "calls_per_s": round(rate),
+            "latency_p50_ms": round(1000 * percentile(latencies, 50), 3),
+            "latency_p99_ms": round(1000 * percentile(latencies, 99), 3),
+        }
+    return results
+
+
+# measure ListAccounts latency for different kinds of wildcard as the number of accounts grows,
+# against the old approach of compiling the regex and searching every account on each call
+def bench_listing(args):
+    results = {}
+    with sandbox("bench_listing_"):
+        server = Server(0, **server_kwargs(args.base_port))
+        for count in args.account_counts:
+            users = [f"user_{i}" for i in range(count)]
+            with server.users_lock:
+                server.users = AccountIndex(users)
+                server.users_version += 1
+            target = users[len(users) // 2]
+            queries = {
+                "exact": lambda: server.ListAccounts(f"^{target}$"),
+                "prefix": lambda: server.ListAccounts(f"^{target[:-1]}"),
+                "glob": lambda: server.ListAccounts(glob_to_regex(f"{target[:-1]}*")),
+                "first_page": lambda: server.ListAccounts(".*", None, ACCOUNT_PAGE_SIZE),
+                "legacy_prefix_scan": lambda: [user for user in server.users_view()
+                                               if re.compile(f"^{target[:-1]}").search(user) is not None],
+            }
+            results[count] = {}
+            for name, query in queries.items():
+                latencies = []
+                deadline = time.perf_counter() + args.seconds
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    query()
+                    latencies.append(time.perf_counter() - start)
+                results[count][name] = {
+                    "latency_p50_us": round(1e6 * percentile(latencies, 50), 2),
+                    "latency_p99_us": round(1e6 * percentile(latencies, 99), 2),
+                }
+        close_server(server)
+    return results
+
+
+# a Client connected to the three localhost servers starting at base_port
+def local_client(base_port, **options):
+    return Client(base_port, base_port + 1, base_port + 2, LOCALHOST, LOCALHOST, LOCALHOST, **options)
+
+
+# the mix of calls each simulated client makes, as (method, weight)
+CLUSTER_WORKLOAD = [("SendMessage", 60), ("CreateAccount", 15), ("Login", 15), ("ListAccounts", 10)]
+
+
+def _cluster_client_main(index, base_port, clients, seconds, conn):
+    sys.stdout = open(os.devnull, "w")
+    rng = random.Random(index)
+    client = local_client(base_port)
+    username = f"cluster_{index}"
+    client.CreateAccount(username)
+    client.Login(username)
+    # messages carry the wall clock time they were sent at, which all processes on this machine share
+    delivery = []
+    client.on_message = lambda msg: delivery.append(time.time() - float(msg.message))
+    client.ListenForMessages()
+    conn.send("ready")
+    conn.recv()
+    calls = {
+        "SendMessage": lambda: client.SendMessage(f"cluster_{rng.randrange(clients)}", repr(time.time())),
+        "CreateAccount": lambda: client.CreateAccount(f"cluster_{index}_{rng.randrange(1 << 30)}"),
+        "Login": lambda: client.Login(username),
+        "ListAccounts": lambda: client.ListAccounts(f"^cluster_{rng.randrange(clients)}_1"),
+    }
+    methods, weights = zip(*CLUSTER_WORKLOAD)
+    latencies = {method: [] for method in methods}
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        method = rng.choices(methods, weights)[0]
+        start = time.perf_counter()
+        calls[method]()
+        latencies[method].append(time.perf_counter() - start)
+    # give the last messages a moment to arrive
+    time.sleep(0.2)
+    conn.send((latencies, delivery))
+
+
+# boot a three server cluster on localhost, drive it with simulated clients running a mixed workload,
+# and then kill the leader and time how long it takes a client to get a call through to a new leader
+def bench_cluster(args):
+    servers = [ServerProcess(id, args.base_port, args.asyncio, ack_mode=args.ack) for id in range(3)]
+    try:
+        workers = []
+        for index in range(args.clients):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_cluster_client_main,
+                                              args=(index, args.base_port, args.clients, args.seconds, child_conn))
+            process.daemon = True
+            process.start()
+            workers.append((process, conn))
+        for _, conn in workers:
+            assert conn.recv() == "ready"
+        # start every client at once so they all overlap for the whole run
+        for _, conn in workers:
+            conn.send("go")
+        latencies = {method: [] for method, _ in CLUSTER_WORKLOAD}
+        delivery = []
+        for process, conn in workers:
+            worker_latencies, worker_delivery = conn.recv()
+            for method, values in worker_latencies.items():
+                latencies[method].extend(values)
+            delivery.extend(worker_delivery)
+            process.kill()
+            process.join()
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            client = local_client(args.base_port)
+            client.CreateAccount("failover_probe")
+            start = time.perf_counter()
+            servers[0].kill()
+            # the client notices the dead connection and retries the call on the next leader
+            client.CreateAccount("failover_probe_2")
+            failover_s = time.perf_counter() - start
+            client.Close()
+    finally:
+        for server in servers:
+            if server.process.is_alive():
+                server.stop()
+    calls = sum(len(values) for values in latencies.values())
+    return {
+        "engine": "asyncio" if args.asyncio else "selectors",
+        "ack_mode": args.ack,
+        "clients": args.clients,
+        "calls_per_s": round(calls / args.seconds),
+        "by_method": {method: {
+            "calls_per_s": round(len(values) / args.seconds),
+            "latency_p50_ms": round(1000 * percentile(values, 50), 3) if values else None,
+            "latency_p99_ms": round(1000 * percentile(values, 99), 3) if values else None,
+        } for method, values in latencies.items()},
+        "messages_delivered": len(delivery),
+        "delivery_latency_p50_ms": round(1000 * percentile(delivery, 50), 3) if delivery else None,
+        "delivery_latency_p99_ms": round(1000 * percentile(delivery, 99), 3) if delivery else None,
+        "failover_s": round(failover_s, 4),
+    }
+
+
+# share of a read-heavy client's calls that are writes
+READ_HEAVY_WRITE_FRACTION = 0.1
+
+
+def _read_client_main(index, base_port, read_consistency, max_staleness, seconds, conn):
+    sys.stdout = open(os.devnull, "w")
+    rng = random.Random(index)
+    client = local_client(base_port, read_consistency=read_consistency, max_staleness=max_staleness)
+    # the first read opens the connections to the backups, and their heartbeats say how far along they are
+    client.ListAccounts("^reads_0")
+    time.sleep(0.3)
+    conn.send("ready")
+    conn.recv()
+    reads = writes = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        if rng.random() < READ_HEAVY_WRITE_FRACTION:
+            client.CreateAccount(f"reads_{index}_{rng.randrange(1 << 30)}")
+            writes += 1
+        else:
+            client.ListAccounts(f"^reads_{rng.randrange(10)}")
+            reads += 1
+    conn.send((reads, writes))
+
+
+# throughput of a read-heavy workload when reads only go to the leader and when they're spread over
+# every server with each read consistency mode, along with how the reads were split between the servers
+def bench_reads(args):
+    results = {}
+    for i, mode in enumerate(READ_CONSISTENCY_MODES):
+        base_port = args.base_port + 10 * i
+        servers = [ServerProcess(id, base_port, args.asyncio, ack_mode=args.ack) for id in range(3)]
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                client = local_client(base_port)
+                for n in range(args.users):
+                    client.CreateAccount(f"reads_{n % 10}_{n}")
+                client.Close()
+            workers = []
+            for index in range(args.clients):
+                conn, child_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_read_client_main, args=(
+                    index, base_port, mode, args.max_staleness, args.seconds, child_conn))
+                process.daemon = True
+                process.start()
+                workers.append((process, conn))
+            for _, conn in workers:
+                assert conn.recv() == "ready"
+            before = [server.metrics() for server in servers]
+            cpu_start = [server.cpu_time() for server in servers]
+            for _, conn in workers:
+                conn.send("go")
+            reads = writes = 0
+            for process, conn in workers:
+                worker_reads, worker_writes = conn.recv()
+                reads += worker_reads
+                writes += worker_writes
+                process.join()
+            after = [server.metrics() for server in servers]
+            cpu = [server.cpu_time() - start for server, start in zip(servers, cpu_start)]
+        finally:
+            for server in servers:
+                server.stop()
+
+        def served(metrics):
+            return metrics["histograms"].get("method_latency_seconds.ListAccounts", {}).get("count", 0)
+        results[mode] = {
+            "calls_per_s": round((reads + writes) / args.seconds),
+            "reads_per_s": round(reads / args.seconds),
+            "reads_by_server": [served(a) - served(b) for a, b in zip(after, before)],
+            "reads_sent_to_leader_after_falling_behind": sum(a["counters"].get("reads_behind", 0) for a in after),
+            "server_cpu_s": [round(t, 3) for t in cpu],
+        }
+    results["clients"] = args.clients
+    results["max_staleness"] = args.max_staleness
+    results["cpu_count"] = os.cpu_count()
+    return results
+
+
+# measure how long a client takes to get a call through to a new leader after the leader crashes
+# (its connections close) or hangs (it stops answering, which only the heartbeat timeout catches),
+# and how much cpu an idle client spends on heartbeats
+def bench_failover(args):
+    results = {"heartbeat_interval_s": HEARTBEAT_INTERVAL, "heartbeat_timeout_s": HEARTBEAT_TIMEOUT}
+    for i, failure in enumerate(["crash", "hang"]):
+        base_port = args.base_port + 10 * i
+        servers = [ServerProcess(id, base_port, args.asyncio) for id in range(3)]
+        try:
+            client = local_client(base_port)
+            client.CreateAccount("failover_probe")
+            if failure == "crash":
+                cpu_start = time.process_time()
+                time.sleep(args.seconds)
+                results["idle_client_cpu_fraction"] = round((time.process_time() - cpu_start) / args.seconds, 4)
+            start = time.perf_counter()
+            if failure == "crash":
+                servers[0].kill()
+            else:
+                os.kill(servers[0].process.pid, signal.SIGSTOP)
+            client.CreateAccount("failover_probe_2")
+            results[f"{failure}_failover_s"] = round(time.perf_counter() - start, 4)
+            client.Close()
+        finally:
+            for server in servers:
+                if server.process.is_alive():
+                    server.kill()
+    return results
+
+
+# misbehave as a client in two ways, a chat stream that is never read and calls whose replies are
+# never read, and check how much the server's memory grows from each
+def bench_backpressure(args):
+    server = ServerProcess(0, args.base_port, args.asyncio)
+    try:
+        control = socket.create_connection((LOCALHOST, args.base_port))
+        control_buf = bytearray()
+        rpc(control, control_buf, "CreateAccount", "slow")
+        rpc(control, control_buf, "Login", "slow")
+        stalled = socket.create_connection((LOCALHOST, args.base_port))
+        stalled.sendall(encode_frame((True, STREAM_CODE, ("slow",), 0)))
+        baseline = server.rss()
+
+        # flood the stalled stream, keeping a window of calls in flight
+        payload = "x" * 1024
+        send = SERVER_METHODS.index('SendMessage')
+        window = 100
+        for start in range(0, args.messages, window):
+            count = min(window, args.messages - start)
+            control.sendall(b"".join(encode_frame((True, send, ("bench", "slow", payload), n)) for n in range(count)))
+            for _ in range(count):
+                recv_frame(control, control_buf)
+        stalled_stream_rss = server.rss()
+
+        # pipeline calls without ever reading the replies, until the server stops taking them
+        unread = socket.create_connection((LOCALHOST, args.base_port))
+        unread.settimeout(1.0)
+        list_accounts = encode_frame((True, SERVER_METHODS.index('ListAccounts'), (".*",), 0))
+        sent = 0
+        try:
+            while sent < 10 * args.messages:
+                unread.sendall(list_accounts * 100)
+                sent += 100
+        except socket.timeout:
+            pass
+        unread_replies_rss = server.rss()
+        metrics = server.metrics()
+    finally:
+        server.stop()
+    return {
+        "engine": "asyncio" if args.asyncio else "selectors",
+        "messages_to_stalled_stream": args.messages,
+        "calls_sent_without_reading_replies": sent,
+        "baseline_rss_mb": round(baseline / 2 ** 20, 1),
+        "stalled_stream_rss_growth_mb": round((stalled_stream_rss - baseline) / 2 ** 20, 1),
+        "unread_replies_rss_growth_mb": round((unread_replies_rss - stalled_stream_rss) / 2 ** 20, 1),
+        **metrics["counters"],
+        "peak_output_buffer_bytes": metrics["peaks"].get("output_buffer_bytes", 0),
+    }
+
+
+# a username that the ring places on the given shard, derived from n
+def name_on_shard(ring, shard, n):
+    attempt = 0
+    while ring.shard_for(name := f"shard_{shard}_{n}_{attempt}") != shard:
+        attempt += 1
+    return name
+
+
+def _shard_load_main(ring, shard, port, connections, seconds, conn):
+    create = SERVER_METHODS.index('CreateAccount')
+    conn.send(drive_requests(port, connections, seconds,
+                             lambda n: (True, create, (name_on_shard(ring, shard, n),)))[0])
+
+
+# total account creation throughput as users are spread over more shards, each a three server replica
+# group with its own leader, with one load generating process writing to each shard's leader
+def bench_sharding(args):
+    results = {}
+    for i, shard_count in enumerate(args.shard_counts):
+        base_port = args.base_port + 100 * i
+        cluster = localhost_cluster(shard_count, base_port)
+        ring = ring_for(cluster)
+        servers = [ServerProcess(id, base_port + 6 * shard, args.asyncio)
+                   for shard in range(shard_count) for id in range(3)]
+        try:
+            workers = []
+            for shard, layout in enumerate(cluster["shards"]):
+                conn, child_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_shard_load_main,
+                                                  args=(ring, shard, layout["client_ports"][0],
+                                                        max(1, args.connections // shard_count), args.seconds, child_conn))
+                process.daemon = True
+                process.start()
+                workers.append((process, conn))
+            rates = []
+            for process, conn in workers:
+                rates.append(conn.recv())
+                process.join()
+        finally:
+            for server in servers:
+                server.stop()
+        results[f"shards_{shard_count}"] = {
+            "writes_per_s": round(sum(rates)),
+            "writes_per_s_by_shard": [round(rate) for rate in rates],
+        }
+    results["cpu_count"] = os.cpu_count()
+    return results
+
+
+# the cost of the server's instrumentation: SendMessage calls per second through run_server_method with
+# and without the sampling profiler, how long a stats snapshot takes, and how many of the per-call debug
+# log calls can be made per second when debug logging is off
+def bench_instrumentation(args):
+    send = SERVER_METHODS.index('SendMessage')
+    results = {}
+    with sandbox("bench_instrumentation_"):
+        for name, profile_every in [("unprofiled", 0), ("profiled_1_in_100", 100)]:
+            server = Server(0, **server_kwargs(args.base_port), profile_every=profile_every)
+            server.CreateAccount("bench")
+            server.Login("bench")
+            results[f"{name}_calls_per_s"] = measure_rate(
+                lambda: server.run_server_method(send, ("bench", "bench", "hello")), args.seconds)
+            server.chats.clear()
+            start = time.perf_counter()
+            server.stats()
+            results[f"{name}_stats_snapshot_ms"] = round(1000 * (time.perf_counter() - start), 3)
+            close_server(server)
+    results["debug_log_per_call_per_s"] = measure_rate(
+        lambda: logging.getLogger("server").debug("received message from %s to %s", "bench", "bench"), args.seconds)
+    return results
+
+
+# the number of bytes of python memory that build() allocates and keeps, along with what it returns
+def allocated_by(build):
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        result = build()
+        return tracemalloc.get_traced_memory()[0] - start, result
+    finally:
+        tracemalloc.stop()
+
+
+# a fresh copy of a string, like the one decoding a frame off the wire produces
+def wire_copy(text):
+    return text.encode("utf-8").decode("utf-8")
+
+
+# memory used by queued messages, connection state and the online set, in the slotted, interned and
+# array-backed structures the server uses against the namespaces, deques of SingleMessages and sets of
+# per-request strings it used to keep; also how fast each kind of mailbox can be drained into chat stream frames
+def bench_memory(args):
+    users = [f"user_{i}" for i in range(args.users)]
+    text = "hello " * 5
+    per_user = args.memory_messages // len(users)
+    messages = args.memory_messages
+
+    def old_mailboxes():
+        chats = {user: deque() for user in users}
+        for i in range(messages):
+            chats[users[i % len(users)]].append(SingleMessage(wire_copy(users[i * 7 % len(users)]), wire_copy(text)))
+        return chats
+
+    def new_mailboxes():
+        user_names = UserNames()
+        chats = Mailboxes(tempfile.mkdtemp(prefix="bench_memory_"), user_names, limit=per_user + 1)
+        for user in users:
+            user_names.canonical(user)
+        for i in range(messages):
+            chats[users[i % len(users)]].append(SingleMessage(wire_copy(users[i * 7 % len(users)]), wire_copy(text)))
+        return chats
+
+    def old_connections():
+        return [types.SimpleNamespace(addr=("127.0.0.1", i), inb=bytearray(), outb=bytearray(), stream_user=None,
+                                      stream_request_id=None, is_peer=False, events=selectors.EVENT_READ,
+                                      reading_paused=False, stream_throttled=False, sync_requested=False,
+                                      incoming_snapshot=None, deferred_ops=[], outgoing_frames=None, closed=False,
+                                      replication_queue=[], sent_seq=0, acked_seq=0, sock=None)
+                for i in range(args.sessions)]
+
+    def new_connections():
+        return [Connection(("127.0.0.1", i)) for i in range(args.sessions)]
+
+    # the users are already stored once in the account index; the online set either holds the strings
+    # that came with each login or shares the stored ones
+    session_users = [f"session_user_{i}" for i in range(args.sessions)]
+    user_names = UserNames()
+    for user in session_users:
+        user_names.canonical(user)
+
+    results = {"messages": messages, "sessions": args.sessions}
+    for name, old, new, count in [("mailboxes", old_mailboxes, new_mailboxes, messages),
+                                  ("connections", old_connections, new_connections, args.sessions),
+                                  ("online_set", lambda: {wire_copy(user) for user in session_users},
+                                   lambda: {user_names.canonical(wire_copy(user)) for user in session_users},
+                                   args.sessions)]:
+        old_bytes, old_state = allocated_by(old)
+        new_bytes, new_state = allocated_by(new)
+        results[name] = {
+            "old_mb": round(old_bytes / 2 ** 20, 1),
+            "new_mb": round(new_bytes / 2 ** 20, 1),
+            "old_bytes_per_item": round(old_bytes / count, 1),
+            "new_bytes_per_item": round(new_bytes / count, 1),
+        }
+        if name == "mailboxes":
+            start = time.perf_counter()
+            for mailbox in old_state.values():
+                while mailbox:
+                    encode_frame((0, [mailbox.popleft() for _ in range(min(STREAM_BATCH_SIZE, len(mailbox)))]))
+            old_rate = messages / (time.perf_counter() - start)
+            start = time.perf_counter()
+            for mailbox in new_state.values():
+                while mailbox:
+                    encode_stream_frame(0, *mailbox.take_encoded(STREAM_BATCH_SIZE))
+            results[name]["old_deliver_messages_per_s"] = round(old_rate)
+            results[name]["new_deliver_messages_per_s"] = round(messages / (time.perf_counter() - start))
+        del old_state, new_state
+    return results
+
+
+# reach every member of a room either with one SendMessage per member, pipelined in a single write, or
+# with a single SendGroupMessage, and compare how many fan-outs per second each manages and how much
+# server cpu each one costs; a fan-out counts once every member's stream has received the message
+def bench_groups(args):
+    results = {}
+    for i, size in enumerate(args.room_sizes):
+        base_port = args.base_port + 10 * i
+        server = ServerProcess(0, base_port, args.asyncio)
+        try:
+            control = socket.create_connection((LOCALHOST, base_port))
+            control.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            control_buf = bytearray()
+            room = f"room_{size}"
+            members = [f"{room}_member_{n}" for n in range(size)]
+            rpc(control, control_buf, "CreateGroup", room)
+            sel = selectors.DefaultSelector()
+            for member in members:
+                rpc(control, control_buf, "CreateAccount", member)
+                rpc(control, control_buf, "Login", member)
+                rpc(control, control_buf, "JoinGroup", room, member)
+                stream = socket.create_connection((LOCALHOST, base_port))
+                stream.sendall(encode_frame((True, STREAM_CODE, (member,), 0)))
+                sel.register(stream, selectors.EVENT_READ, data=bytearray())
+
+            # wait until the message has reached every member
+            def receive():
+                delivered = 0
+                while delivered < size:
+                    for key, _ in sel.select(timeout=5.0):
+                        key.data.extend(key.fileobj.recv(RECV_BUFFER_SIZE))
+                        delivered += sum(len(batch) for _, batch in pop_frames(key.data))
+            send = SERVER_METHODS.index('SendMessage')
+            send_group = SERVER_METHODS.index('SendGroupMessage')
+            # the requests that make up one fan-out of each kind
+            fan_outs = {
+                "one_call_per_member": [(True, send, ("bench", member, "hello"), n) for n, member in enumerate(members)],
+                "group_message": [(True, send_group, ("bench", room, "hello"), 0)],
+            }
+            results[room] = {}
+            for name, requests in fan_outs.items():
+                rounds = 0
+                cpu_start = server.cpu_time()
+                start = time.perf_counter()
+                while time.perf_counter() - start < args.seconds:
+                    control.sendall(b"".join(encode_frame(request) for request in requests))
+                    for _ in requests:
+                        recv_frame(control, control_buf)
+                    receive()
+                    rounds += 1
+                elapsed = time.perf_counter() - start
+                results[room][name] = {
+                    "fan_outs_per_s": round(rounds / elapsed, 1),
+                    "server_cpu_ms_per_fan_out": round(1000 * (server.cpu_time() - cpu_start) / rounds, 3),
+                }
+            for key in list(sel.get_map().values()):
+                key.fileobj.close()
+            control.close()
+        finally:
+            server.stop()
+    return results
+
+
+# how fast messages go into the history store, and how long reading a page of a conversation takes
+# from it against reading the conversation's flat text log of SingleMessage reprs in full with eval,
+# the way undelivered messages used to be read back at login
+def bench_history(args):
+    directory = tempfile.mkdtemp(prefix="bench_history_")
+    conversations = [(f"user_{i}", f"user_{i + 1}") for i in range(args.conversations)]
+    history = HistoryStore(os.path.join(directory, "history.db"))
+    logs = {pair: open(os.path.join(directory, f"{pair[0]}_{pair[1]}.txt"), "w") for pair in conversations}
+    start = time.perf_counter()
+    for seq in range(1, args.history_messages + 1):
+        sender, recipient = conversations[seq % len(conversations)]
+        history.append(direct_conversation(sender, recipient), seq, time.time(), sender, f"message {seq}")
+    appended = time.perf_counter() - start
+    # a query writes out everything still buffered before it runs
+    history.last(direct_conversation(*conversations[0]), limit=1)
+    written = time.perf_counter() - start
+    for seq in range(1, args.history_messages + 1):
+        pair = conversations[seq % len(conversations)]
+        logs[pair].write(repr(SingleMessage(pair[0], f"message {seq}")) + "\n")
+    for f in logs.values():
+        f.close()
+
+    def read_log(pair):
+        with open(os.path.join(directory, f"{pair[0]}_{pair[1]}.txt")) as f:
+            return [eval(line.rstrip("\n")) for line in f][-HISTORY_PAGE_SIZE:]
+    queries = {
+        "last_page": lambda pair: history.last(direct_conversation(*pair), limit=HISTORY_PAGE_SIZE),
+        "page_before": lambda pair: history.last(direct_conversation(*pair), args.history_messages // 2,
+                                                 HISTORY_PAGE_SIZE),
+        "since_id": lambda pair: history.since(direct_conversation(*pair), args.history_messages // 2,
+                                               limit=HISTORY_PAGE_SIZE),
+        "flat_log_eval": read_log,
+    }
+    results = {
+        "messages": args.history_messages,
+        "conversations": args.conversations,
+        "append_messages_per_s": round(args.history_messages / appended),
+        "written_messages_per_s": round(args.history_messages / written),
+        "db_bytes_per_message": round(sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+                                          if name.startswith("history.db")) / args.history_messages, 1),
+    }
+    for name, query in queries.items():
+        rng = random.Random(0)
+        rate = measure_rate(lambda: query(rng.choice(conversations)), args.seconds)
+        results[f"{name}_ms"] = round(1000 / rate, 4)
+    history.close()
+    return results
+
+
+# words that sample chat messages are made of; text drawn from a small vocabulary compresses about
+# as well as real chat does
+CHAT_WORDS = ("hey", "are", "you", "coming", "to", "the", "meeting", "later", "sure", "see", "at", "noon",
+              "lunch", "sounds", "good", "thanks", "running", "late", "be", "there", "in", "ten", "minutes")
+
+
+def chat_text(rng, words):
+    return " ".join(rng.choice(CHAT_WORDS) for _ in range(words))
+
+
+# a socket to a server, which has asked the server for compressed frames if compress is set
+def open_bench_connection(port, compress):
+    sock = socket.create_connection((LOCALHOST, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    buf = bytearray()
+    if compress:
+        sock.sendall(encode_frame((True, COMPRESS_CODE, (), 1)))
+        assert recv_frame(sock, buf)[1]
+    return sock, buf
+
+
+# receive a chat stream until count messages have arrived; returns the bytes that were read
+def receive_stream(sock, buf, count):
+    received = delivered = 0
+    while delivered < count:
+        chunk = sock.recv(RECV_BUFFER_SIZE)
+        received += len(chunk)
+        buf += chunk
+        delivered += sum(len(batch) for _, batch in pop_frames(buf))
+    return received
+
+
+# bytes per message and the time it takes to compress and decode chat stream frames of each size,
+# and then, against a server, the bytes and time it takes to deliver a backlog of chat messages and
+# a single large message with and without negotiated compression
+def bench_compression(args):
+    rng = random.Random(0)
+    results = {"stream_frames": {}}
+    for size in (1, 10, 100, STREAM_BATCH_SIZE):
+        messages = [SingleMessage(f"user_{rng.randrange(100)}", chat_text(rng, 12)) for _ in range(size)]
+        frame = encode_stream_frame(7, size, b"".join(encode_value(message) for message in messages))
+        packed = compress_frames(frame)
+        results["stream_frames"][size] = {
+            "plain_bytes_per_message": round(len(frame) / size, 1),
+            "compressed_bytes_per_message": round(len(packed) / size, 1),
+            "compress_us_per_message": round(1e6 / (size * measure_rate(lambda: compress_frames(frame), args.seconds)), 3),
+            "plain_decode_us_per_message": round(1e6 / (size * measure_rate(lambda: pop_frames(bytearray(frame)), args.seconds)), 3),
+            "compressed_decode_us_per_message": round(1e6 / (size * measure_rate(lambda: pop_frames(bytearray(packed)), args.seconds)), 3),
+        }
+
+    server = ServerProcess(0, args.base_port, args.asyncio)
+    try:
+        control, control_buf = open_bench_connection(args.base_port, False)
+        send = SERVER_METHODS.index('SendMessage')
+        large = chat_text(rng, args.large_message_bytes // 5)
+        for compress in (False, True):
+            name = "compressed" if compress else "plain"
+            user = f"compression_{name}"
+            rpc(control, control_buf, "CreateAccount", user)
+            rpc(control, control_buf, "Login", user)
+            # queue a backlog while the user's stream isn't open, then time how long it takes to drain
+            requests = b"".join(encode_frame((True, send, ("bench", user, chat_text(rng, 12)), n))
+                                for n in range(args.messages))
+            control.sendall(requests)
+            for _ in range(args.messages):
+                recv_frame(control, control_buf)
+            stream, stream_buf = open_bench_connection(args.base_port, compress)
+            cpu_start = server.cpu_time()
+            start = time.perf_counter()
+            stream.sendall(encode_frame((True, STREAM_CODE, (user,), 0)))
+            stream_bytes = receive_stream(stream, stream_buf, args.messages)
+            backlog_s = time.perf_counter() - start
+            backlog_cpu = server.cpu_time() - cpu_start
+
+            # one large message, from a sender that compresses its calls too if compress is set
+            sender, sender_buf = open_bench_connection(args.base_port, compress)
+            request = encode_frame((True, send, ("bench", user, large), 1))
+            if compress:
+                request = compress_frames(request)
+            start = time.perf_counter()
+            sender.sendall(request)
+            stream_bytes_large = receive_stream(stream, stream_buf, 1)
+            large_s = time.perf_counter() - start
+            recv_frame(sender, sender_buf)
+            results[name] = {
+                "backlog_messages": args.messages,
+                "backlog_stream_bytes_per_message": round(stream_bytes / args.messages, 1),
+                "backlog_messages_per_s": round(args.messages / backlog_s),
+                "backlog_server_cpu_us_per_message": round(1e6 * backlog_cpu / args.messages, 3),
+                "large_message_bytes": len(large),
+                "large_message_request_bytes": len(request),
+                "large_message_stream_bytes": stream_bytes_large,
+                "large_message_delivery_ms": round(1000 * large_s, 3),
+            }
+            stream.close()
+            sender.close()
+        control.close()
+    finally:
+        server.stop()
+    return results
+
+
+# deliver a backlog of chat messages to a reader, crash the leader once about half of it has been
+# delivered, and count how many messages the reader gets twice while the new leader delivers the
+# rest: once over a stream that removes messages as they're sent, which the backups never see, and
+# once over an acknowledged stream that the client reopens after the last message it received
+def bench_resume(args):
+    results = {"messages": args.messages}
+    half = args.messages // 2
+    for i, mode in enumerate(["unacknowledged", "acknowledged"]):
+        base_port = args.base_port + 10 * i
+        servers = [ServerProcess(id, base_port, args.asyncio) for id in range(3)]
+        try:
+            sender = local_client(base_port)
+            sender.CreateAccount("resume_sender")
+            sender.CreateAccount("resume_reader")
+            for future in sender.call_many("SendMessage", [("resume_sender", "resume_reader", str(i))
+                                                           for i in range(args.messages)]):
+                future.result()
+            if mode == "unacknowledged":
+                stream, buf = open_bench_connection(base_port, False)
+                rpc(stream, buf, "Login", "resume_reader")
+                stream.sendall(encode_frame((True, STREAM_CODE, ("resume_reader",), 0)))
+                delivered = 0
+                while delivered < half:
+                    buf += stream.recv(RECV_BUFFER_SIZE)
+                    delivered += sum(len(batch) for _, batch in pop_frames(buf))
+                servers[0].kill()
+                start = time.perf_counter()
+                stream, buf = open_bench_connection(base_port + 1, False)
+                rpc(stream, buf, "Login", "resume_reader")
+                stream.sendall(encode_frame((True, STREAM_CODE, ("resume_reader",), 0)))
+                # the new leader has every message, including the ones that were delivered
+                receive_stream(stream, buf, args.messages)
+                received = delivered + args.messages
+            else:
+                reader = local_client(base_port)
+                received, unique = [], set()
+                halfway, failed_over, finished = threading.Event(), threading.Event(), threading.Event()
+
+                def on_message(msg):
+                    received.append(msg.message)
+                    unique.add(msg.message)
+                    if len(received) == half:
+                        # hold up delivery until the leader is gone
+                        halfway.set()
+                        failed_over.wait()
+                    if len(unique) == args.messages:
+                        finished.set()
+                reader.on_message = on_message
+                reader.Login("resume_reader")
+                reader.ListenForMessages()
+                halfway.wait()
+                servers[0].kill()
+                start = time.perf_counter()
+                failed_over.set()
+                finished.wait()
+                received = len(received)
+                reader.Close()
+            results[mode] = {
+                "redelivered_messages": received - args.messages,
+                "rest_of_backlog_after_failover_s": round(time.perf_counter() - start, 4),
+            }
+            sender.Close()
+        finally:
+            for server in servers:
+                if server.process.is_alive():
+                    server.kill()
+    return results
+
+
+# compare call throughput, latency and the server process's CPU time per call with the server accepting
+# clients itself against worker processes accepting them, at different numbers of workers, for writes
+# and for history reads. Every write still runs on the server, so the workers only take the socket and
+# framing work for those off it; history reads are answered by the workers themselves, so the server's
+# CPU time per read is what bounds read throughput once the workers have cores of their own
+def bench_workers(args):
+    create = SERVER_METHODS.index('CreateAccount')
+    history = SERVER_METHODS.index('GetHistory')
+    results = {"connections": args.connections, "cpu_count": os.cpu_count()}
+    for i, workers in enumerate(args.worker_counts):
+        base_port = args.base_port + 10 * i
+        server = ServerProcess(0, base_port, workers=workers)
+        try:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                client = local_client(base_port)
+                client.CreateAccount("workers_a")
+                client.CreateAccount("workers_b")
+                client.Login("workers_a")
+                for n in range(200):
+                    client.SendMessage("workers_b", f"message {n}")
+                client.Close()
+            workloads = [("writes", lambda n: (True, create, (f"workers_{workers}_{n}",))),
+                         ("history_reads", lambda n: (True, history, ("workers_a", "workers_b", None, 100)))]
+            for name, make_request in workloads:
+                cpu_start = server.cpu_time()
+                rate, latencies = drive_requests(base_port, args.connections, args.seconds, make_request, depth=8)
+                cpu_ms = 1000 * (server.cpu_time() - cpu_start)
+                results[f"workers_{workers}_{name}"] = {
+                    "calls_per_s": round(rate),
+                    "latency_p50_ms": round(1000 * percentile(latencies, 50), 3),
+                    "latency_p99_ms": round(1000 * percentile(latencies, 99), 3),
+                    "server_cpu_ms_per_1000_calls": round(1000 * cpu_ms / max(len(latencies), 1), 2),
+                }
+        finally:
+            server.stop()
+    return results
+
+
+BENCHMARKS = {
+    "protocol": bench_protocol,
+    "streams": bench_streams,
+    "contention": bench_contention,
+    "wal": bench_wal,
+    "catchup": bench_catchup,
+    "replication": bench_replication,
+    "pipelining": bench_pipelining,
+    "listing": bench_listing,
+    "cluster": bench_cluster,
+    "failover": bench_failover,
+    "backpressure": bench_backpressure,
+    "sharding": bench_sharding,
+    "instrumentation": bench_instrumentation,
+    "memory": bench_memory,
+    "groups": bench_groups,
+    "history": bench_history,
+    "reads": bench_reads,
+    "compression": bench_compression,
+    "resume": bench_resume,
+    "workers": bench_workers,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run chat service benchmarks and print the results as JSON")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help=f"which benchmarks to run, out of {', '.join(BENCHMARKS)} (all by default)")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time spent on each measurement")
+    parser.add_argument("--base-port", type=int, default=60051, help="first of the localhost ports used by benchmark servers")
+    parser.add_argument("--asyncio", action="store_true", help="run benchmark servers with the asyncio engine")
+    parser.add_argument("--streams", type=int, default=200, help="number of concurrent chat streams")
+    parser.add_argument("--ack", choices=ACK_MODES, default='leader', help="ack mode for the cluster benchmark's servers")
+    parser.add_argument("--max-staleness", type=int, default=100,
+                        help="how many calls behind a server may be to answer reads with bounded_staleness")
+    parser.add_argument("--clients", type=int, default=8, help="number of simulated clients in the cluster benchmark")
+    parser.add_argument("--connections", type=int, default=32, help="number of client connections driving load")
+    parser.add_argument("--threads", type=int, default=16, help="number of concurrent callers in the contention benchmark")
+    parser.add_argument("--users", type=int, default=1000, help="number of accounts created for in-process benchmarks")
+    parser.add_argument("--messages", type=int, default=5000, help="number of messages sent through chat streams")
+    parser.add_argument("--memory-messages", type=int, default=1000000,
+                        help="number of queued messages in the memory benchmark")
+    parser.add_argument("--room-sizes", type=lambda s: [int(n) for n in s.split(",")], default=[10, 100, 1000],
+                        help="comma separated numbers of members in the rooms of the group benchmark")
+    parser.add_argument("--history-messages", type=int, default=200000,
+                        help="number of messages written to the history benchmark's store")
+    parser.add_argument("--conversations", type=int, default=1000,
+                        help="number of conversations the history benchmark's messages are spread over")
+    parser.add_argument("--large-message-bytes", type=int, default=8 * 1024 * 1024,
+                        help="size of the large message in the compression benchmark")
+    parser.add_argument("--sessions", type=int, default=100000, help="number of client sessions in the memory benchmark")
+    parser.add_argument("--backlogs", type=lambda s: [int(n) for n in s.split(",")], default=[1000, 10000, 100000],
+                        help="comma separated numbers of missed method calls to measure catch-up time at")
+    parser.add_argument("--wal-sizes", type=lambda s: [int(n) for n in s.split(",")], default=[10000, 100000],
+                        help="comma separated log sizes (in events) to measure recovery time at")
+    parser.add_argument("--depths", type=lambda s: [int(n) for n in s.split(",")], default=[1, 8, 64],
+                        help="comma separated numbers of requests kept in flight per connection when pipelining")
+    parser.add_argument("--account-counts", type=lambda s: [int(n) for n in s.split(",")], default=[1000, 100000, 1000000],
+                        help="comma separated numbers of accounts to measure listing latency at")
+    parser.add_argument("--worker-counts", type=lambda s: [int(n) for n in s.split(",")], default=[0, 2, 4],
+                        help="comma separated numbers of worker processes for the workers benchmark (0 for none)")
+    parser.add_argument("--shard-counts", type=lambda s: [int(n) for n in s.split(",")], default=[1, 2, 4],
+                        help="comma separated numbers of shards to measure write throughput with")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+    # anything the servers and clients print goes to stderr so that stdout is just the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = {name: BENCHMARKS[name](args) for name in args.benchmarks}
+    json.dump(results, sys.stdout, indent=2)
+    print()
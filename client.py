@@ -1,57 +1,371 @@
+import argparse
+import heapq
+import itertools
+import logging
 import os
+import queue
 import socket
 import threading
 import sys
-import types
+import time
 import selectors
+from concurrent.futures import Future
 from common import *
+from sharding import client_kwargs, load_cluster, ring_for
 
 is_client = True
 
+log = logging.getLogger("client")
+
+
+# the client's one connection to a server, which carries its calls, its chat stream and its heartbeats
+class ServerConnection:
+    __slots__ = ("index", "address", "port", "sock", "inb", "outb", "pending", "registered", "last_seen",
+                 "awaiting_heartbeat", "applied_seq", "compress", "compress_request_id")
+
+    def __init__(self, index, address, port):
+        self.index = index
+        self.address = address
+        self.port = port
+        self.sock = None  # opened the first time the server is needed, and again after it drops
+        self.inb = bytearray()
+        self.outb = bytearray()
+        self.pending = {}  # request id -> (future, request) for calls waiting on a reply from this server
+        self.registered = None  # (socket, events) as currently registered with the client's selector
+        self.last_seen = 0  # when we last heard anything from the server
+        self.awaiting_heartbeat = False
+        self.applied_seq = 0  # the latest seq the server has told us it has applied
+        # whether the server agreed to compressed frames, and the id of the request that asked it to
+        self.compress = False
+        self.compress_request_id = None
+
 
 class Client:
     def __init__(self, p_0=CLIENT_FACING_PORT_0, p_1=CLIENT_FACING_PORT_1, p_2=CLIENT_FACING_PORT_2,
-                 server_addr_0=SERVER_ADDR_0, server_addr_1=SERVER_ADDR_1, server_addr_2=SERVER_ADDR_2):
+                 server_addr_0=SERVER_ADDR_0, server_addr_1=SERVER_ADDR_1, server_addr_2=SERVER_ADDR_2,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 read_consistency='leader', max_staleness=0, compression=True):
         self.username = ''
         # server that starts off as leader, 0 by default
         self.leader = 0
         self.server_addresses = [server_addr_0, server_addr_1, server_addr_2]
         self.ports = [p_0, p_1, p_2]
 
-        self.sockets = [socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM) for _ in range(3)]
-        for i in range(3):
-            # connect and initiate stream
-            try:
-                self.sockets[i].connect((self.server_addresses[i], self.ports[i]))
-                print(f"Connected to server {i} at {self.server_addresses[i], self.ports[i]}")
-            except ConnectionRefusedError:
-                print(f"Connection refused by server {i}")
-
         self.stop_listening = False  # boolean to tell listener threads when user logs out
         self.all_dead = False # boolean indicating whether all servers have gone down
         self.has_heartbeat = [True, True, True] # array of booleans indicating whether each server has a heartbeat
-        h = threading.Thread(target=self.HeartBeat)
-        h.daemon = True
-        h.start()
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        # called with each message that arrives on the chat stream, on a thread of its own so that it can
+        # make calls (see DeliverMessages)
+        self.on_message = self.PrintMessage
+        # the user whose chat stream is open and the id of the request that opened it, which the
+        # server tags every delivery with
+        self.stream_user = None
+        self.stream_request_id = None
+        # the user whose messages have been delivered, the id of the last message delivered by the
+        # stream, of the last one on_message has been called with and of the last one the servers know
+        # about, and whether an AckMessages is in flight; a stream reopened after a failover starts
+        # after delivered_id
+        self.delivered_user = None
+        self.delivered_id = -1
+        self.handled_id = -1
+        self.acked_id = -1
+        self.acking = False
+        self.closed = False
+        # which servers read-only calls may go to (see READ_CONSISTENCY_MODES) and, for
+        # bounded_staleness, how many calls behind the latest seq the client knows of they may be
+        if read_consistency not in READ_CONSISTENCY_MODES:
+            raise ValueError(f"Invalid read consistency: {read_consistency}")
+        self.read_consistency = read_consistency
+        self.max_staleness = max_staleness
+        self.last_seq = 0  # the highest seq of any reply, i.e. the latest state the client has seen
+        self.reads_sent = itertools.count()  # spreads reads over the servers in turn
+        self.compression = compression  # whether to ask each server to compress the frames it sends us
+
+        # every request carries an id that the server echoes in its reply, so many requests can be
+        # outstanding on one connection; id 0 is kept for heartbeats
+        self.request_ids = itertools.count(1)
+        # guards the connections and the choice of leader
+        self.lock = threading.RLock()
+        # calls, the chat stream and heartbeats to a server all share one connection, which is only
+        # opened when the server is first needed; a single thread reads from all of them
+        self.connections = [ServerConnection(i, self.server_addresses[i], self.ports[i]) for i in range(3)]
+        self.sel = selectors.DefaultSelector()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.sel.register(self.wakeup_recv, selectors.EVENT_READ, data=None)
+
+        # (user, id of the last message, messages) for each batch from the chat stream, waiting for on_message
+        self.deliveries = queue.SimpleQueue()
+        t = threading.Thread(target=self.ServiceConnections)
+        t.daemon = True
+        t.start()
+        t = threading.Thread(target=self.DeliverMessages)
+        t.daemon = True
+        t.start()
 
     # this encodes a method call, sends it to the server, and finally decodes and returns
     # the server's response. Takes in a method name and the args to be passed to the method
     def run_service(self, method, args):
+        return self.call_async(method, args).result()
+
+    # send a method call to the leader without waiting for the reply; returns a future for the reply.
+    # Its done callbacks run on the thread that reads from the servers, so they mustn't wait on calls
+    def call_async(self, method, args):
+        return self.call_many(method, [args])[0]
+
+    # send one call of the same method per tuple of args to the leader in a single write, and return
+    # a future for each reply; the leader answers calls on a connection in the order they were sent
+    def call_many(self, method, args_list):
         assert method in SERVER_METHODS
         # SERVER_METHODS is a list of services/methods exposed by the server
         # grabbing the index of a method from this list gives a unique integer code
         # for the method in question
         method_code = SERVER_METHODS.index(method)
-        transmission = str((is_client, method_code, args)).encode("utf-8")
-        data = None
-        while data is None:
-            if self.all_dead:
-                raise Exception('All Servers are Dead')
-            # try or retry transmission with new leader
-            self.sockets[self.leader].sendall(transmission)
-            data = self.sockets[self.leader].recv(1024)
-        return eval(data.decode("utf-8"))
+        if method in BACKUP_READ_METHODS and self.read_consistency != 'leader':
+            with self.lock:
+                if self.read_consistency == 'read_your_writes':
+                    min_seq = self.last_seq
+                else:
+                    min_seq = max(self.last_seq, *(conn.applied_seq for conn in self.connections)) - self.max_staleness
+            entries = [(Future(), (is_client, method_code, args, next(self.request_ids), min_seq)) for args in args_list]
+            self.send_requests(entries, any_server=True)
+        else:
+            entries = [(Future(), (is_client, method_code, args, next(self.request_ids))) for args in args_list]
+            self.send_requests(entries)
+        return [future for future, _ in entries]
+
+    # send (future, request) entries to the leader, or for reads that may be answered by any server to
+    # the next server in turn, registering them first so that they're retried with the leader if the
+    # server dies before replying
+    def send_requests(self, entries, any_server=False):
+        with self.lock:
+            conn = self.read_connection() if any_server else self.leader_connection()
+            if conn is not None:
+                for entry in entries:
+                    conn.pending[entry[1][3]] = entry
+                frames = b"".join(encode_frame(request) for _, request in entries)
+                if conn.compress and len(frames) >= COMPRESSION_THRESHOLD:
+                    # a batch of calls is compressed together
+                    frames = compress_frames(frames)
+                self.queue_frames(conn, frames)
+                return
+        for future, _ in entries:
+            future.set_exception(Exception('All Servers are Dead'))
+
+    # the connection to the leader, opening it if needed. If the leader can't be reached, select a new
+    # leader via carousel i.e. keep trying the next server in line (with wrap around) until one can be
+    # reached; the chat stream follows the leader. Must be called with the lock held
+    def leader_connection(self):
+        if self.all_dead:
+            return None
+        order = [self.leader, (self.leader + 1) % 3, (self.leader + 2) % 3]
+        if not self.has_heartbeat[self.leader]:
+            # the leader just died, so only come back to it once everyone else has been tried
+            order.append(order.pop(0))
+        for i in order:
+            conn = self.open_connection(i)
+            if conn is None:
+                continue
+            if i != self.leader or not self.has_heartbeat[i]:
+                self.leader = i
+                self.has_heartbeat[i] = True
+                if self.stream_user is not None and not self.stop_listening:
+                    self.open_stream(conn)
+            return conn
+        self.all_dead = True
+        return None
+
+    # the connection to the next server in turn that's up, opening it if needed. The server waits to
+    # answer a read until it has applied the read's min seq, and sends it back to us to go to the
+    # leader if that takes too long. Must be called with the lock held
+    def read_connection(self):
+        leader = self.leader_connection()
+        if leader is None:
+            return None
+        ready = [conn for conn in self.connections if self.has_heartbeat[conn.index] and
+                 self.open_connection(conn.index) is not None]
+        return ready[next(self.reads_sent) % len(ready)] if ready else leader
+
+    # the connection to server i, connecting to it first if it isn't open; None if it can't be reached
+    def open_connection(self, i):
+        conn = self.connections[i]
+        if conn.sock is None:
+            try:
+                sock = socket.create_connection((conn.address, conn.port), timeout=CONNECT_TIMEOUT)
+            except OSError:
+                print(f"Connection refused by server {i}")
+                self.has_heartbeat[i] = False
+                return None
+            print(f"Connected to server {i} at {conn.address, conn.port}")
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
+            conn.sock = sock
+            conn.inb.clear()
+            conn.outb.clear()
+            conn.last_seen = time.monotonic()
+            conn.awaiting_heartbeat = False
+            conn.applied_seq = 0
+            conn.compress = False
+            if self.compression:
+                conn.compress_request_id = next(self.request_ids)
+                conn.outb += encode_frame((is_client, COMPRESS_CODE, tuple(), conn.compress_request_id))
+            # get the connection thread to start reading from the new socket
+            self.wakeup()
+        return conn
+
+    # add frames to a connection's outbound buffer and send as much as the socket takes right away;
+    # the connection thread sends the rest once the socket is writable. Must be called with the lock held
+    def queue_frames(self, conn, frames):
+        conn.outb += frames
+        self.flush(conn)
+        if conn.outb:
+            self.wakeup()
+
+    def flush(self, conn):
+        try:
+            sent = conn.sock.send(conn.outb)
+        except OSError:
+            # the socket is full or broken; the connection thread sends the rest or notices it closed
+            return
+        del conn.outb[:sent]
+
+    # wake the connection thread up from its select call
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b"\0")
+        except BlockingIOError:
+            # the wakeup socket is already full, so the thread is bound to wake up anyway
+            pass
+
+    # read replies, chat messages and heartbeats from every open connection, finish sending whatever
+    # couldn't be sent right away, and every heartbeat_interval seconds send a heartbeat on each open
+    # connection; a server is declared dead as soon as its connection closes, or once it has gone
+    # heartbeat_timeout seconds without sending anything
+    def ServiceConnections(self):
+        heartbeat = encode_frame((is_client, HEARTBEAT_CODE, tuple(), 0))
+        next_beat = time.monotonic()
+        while not (self.closed or self.all_dead):
+            self.update_registrations()
+            for key, mask in self.sel.select(timeout=max(0, next_beat - time.monotonic())):
+                if key.data is None:
+                    while True:
+                        try:
+                            self.wakeup_recv.recv(RECV_BUFFER_SIZE)
+                        except BlockingIOError:
+                            break
+                    continue
+                conn = key.data
+                if conn.sock is not key.fileobj:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    with self.lock:
+                        self.flush(conn)
+                if mask & selectors.EVENT_READ:
+                    try:
+                        chunk = conn.sock.recv(RECV_BUFFER_SIZE)
+                    except OSError:
+                        chunk = b""
+                    if not chunk:
+                        self.connection_lost(conn)
+                        continue
+                    conn.inb += chunk
+                    self.dispatch(conn, pop_frames(conn.inb))
+            now = time.monotonic()
+            if now >= next_beat:
+                next_beat = now + self.heartbeat_interval
+                with self.lock:
+                    # only one heartbeat is outstanding per server at a time
+                    for conn in self.connections:
+                        if conn.sock is not None and not conn.awaiting_heartbeat:
+                            conn.awaiting_heartbeat = True
+                            self.queue_frames(conn, heartbeat)
+            for conn in self.connections:
+                if conn.sock is not None and now - conn.last_seen > self.heartbeat_timeout:
+                    self.connection_lost(conn)
+        with self.lock:
+            for conn in self.connections:
+                if conn.sock is not None:
+                    conn.sock.close()
+                    conn.sock = None
+        self.sel.close()
+
+    # make the selector watch every open connection for reads, and for writes while it has unsent data
+    def update_registrations(self):
+        with self.lock:
+            for conn in self.connections:
+                wanted = None
+                if conn.sock is not None:
+                    wanted = (conn.sock, selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.outb else 0))
+                if conn.registered == wanted:
+                    continue
+                if conn.registered is not None:
+                    self.sel.unregister(conn.registered[0])
+                if wanted is not None:
+                    self.sel.register(wanted[0], wanted[1], data=conn)
+                conn.registered = wanted
+
+    # hand each decoded frame from a server to whoever is waiting for it, and send reads the server
+    # was too far behind to answer to the leader
+    def dispatch(self, conn, frames):
+        conn.last_seen = time.monotonic()
+        replies = []
+        retries = []
+        with self.lock:
+            for request_id, output, *seq in frames:
+                if seq:
+                    conn.applied_seq = max(conn.applied_seq, seq[0])
+                if request_id == 0:
+                    conn.awaiting_heartbeat = False
+                elif request_id == conn.compress_request_id:
+                    conn.compress = output
+                elif request_id == self.stream_request_id:
+                    # the server delivers each user's backlog as a batch of messages in one frame,
+                    # tagged with the id of the last one; a batch the client already has is dropped
+                    if not self.stop_listening and seq[0] > self.delivered_id:
+                        self.delivered_id = seq[0]
+                        self.deliveries.put((self.delivered_user, seq[0], output))
+                else:
+                    entry = conn.pending.pop(request_id, None)
+                    if entry is None:
+                        continue
+                    if len(seq) > 1:
+                        # the leader answers reads however far along it is
+                        retries.append((entry[0], entry[1][:4]))
+                    else:
+                        self.last_seq = max(self.last_seq, seq[0])
+                        replies.append((entry[0], output))
+        for future, output in replies:
+            # a caller may have cancelled it; exceptions from its callbacks are logged by the future
+            if not future.cancelled():
+                future.set_result(output)
+        if retries:
+            self.send_requests(retries)
+
+    # stop using a server that has closed its connection or stopped answering heartbeats; the calls
+    # that were still waiting on it, and the chat stream if it was the leader, move to the next leader
+    def connection_lost(self, conn):
+        print(f"Server {conn.index} has died")
+        with self.lock:
+            if conn.registered is not None:
+                self.sel.unregister(conn.registered[0])
+                conn.registered = None
+            conn.sock.close()
+            conn.sock = None
+            self.has_heartbeat[conn.index] = False
+            orphaned = sorted(conn.pending.values(), key=lambda entry: entry[1][3])
+            conn.pending.clear()
+            if conn.index == self.leader:
+                self.leader_connection()
+        self.send_requests(orphaned)
+
+    # stop the connection thread and close every connection
+    def Close(self):
+        self.closed = True
+        self.deliveries.put(None)
+        self.wakeup()
 
     # Create an account with the given username.
     def CreateAccount(self, usr=''):
@@ -62,11 +376,27 @@ class Client:
         success = self.run_service("DeleteAccount", (self.username,))
         if success:
             self.username = ''
+            self.stream_user = None
         return success
 
     # List accounts on the server that match the wildcard
     def ListAccounts(self, wildcard='.*'):
-        return self.run_service("ListAccounts", (wildcard,))
+        return list(self.IterAccounts(wildcard))
+
+    # List accounts that match a shell-style glob such as "user_*"
+    def ListAccountsGlob(self, glob):
+        return self.ListAccounts(glob_to_regex(glob))
+
+    # Yield the accounts that match the wildcard in sorted order, fetching them from the server a page
+    # at a time so that a huge listing never has to fit in a single reply
+    def IterAccounts(self, wildcard='.*', page_size=ACCOUNT_PAGE_SIZE):
+        after = None
+        while True:
+            page = self.run_service("ListAccounts", (wildcard, after, page_size))
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1]
 
     # Login to the server with the given username.
     def Login(self, usr):
@@ -80,86 +410,138 @@ class Client:
         success = self.run_service("Logout", (self.username,))
         if success:
             self.username = ''
+            self.stream_user = None
         return success
 
     # Send a message to the given recipient.
     def SendMessage(self, recipient, message):
         return self.run_service("SendMessage", (self.username, recipient, message))
 
-    # Start a new chat connection along the given socket with the given server
-    def InitiateChatConnection(self, sock, server_addr):
-        sel = selectors.DefaultSelector()
-        # STREAM_CODE is a code for the ChatStream method call on the server
-        transmission = str((is_client, STREAM_CODE, (self.username,))).encode("utf-8")
-        sock.sendall(transmission)
-        # setup selector to listen for read events
-        data = types.SimpleNamespace(addr=server_addr, inb=b"", outb=b"")
-        events = selectors.EVENT_READ
-        sel.register(sock, events, data=data)
-        return sel
-
-    # Listen for messages from the server.
+    # Send a message to the given recipient without waiting; returns a future for whether it was sent.
+    def SendMessageAsync(self, recipient, message):
+        return self.call_async("SendMessage", (self.username, recipient, message))
+
+    # Send the same message to many recipients, with all of the calls in flight at once; returns
+    # whether it was sent to each recipient.
+    def SendMessageBatch(self, recipients, message):
+        futures = self.call_many("SendMessage", [(self.username, recipient, message) for recipient in recipients])
+        return [future.result() for future in futures]
+
+    # Create a group with no members.
+    def CreateGroup(self, group):
+        return self.run_service("CreateGroup", (group,))
+
+    # Delete a group.
+    def DeleteGroup(self, group):
+        return self.run_service("DeleteGroup", (group,))
+
+    # Add the client user to a group.
+    def JoinGroup(self, group):
+        return self.run_service("JoinGroup", (group, self.username))
+
+    # Take the client user out of a group.
+    def LeaveGroup(self, group):
+        return self.run_service("LeaveGroup", (group, self.username))
+
+    # List the members of a group.
+    def ListGroupMembers(self, group):
+        return self.run_service("ListGroupMembers", (group,))
+
+    # Send a message to every other member of a group in a single call.
+    def SendGroupMessage(self, group, message):
+        return self.run_service("SendGroupMessage", (self.username, group, message))
+
+    # Fetch the last messages between the client user and another user, oldest first, as
+    # (id, unix time sent, sender, message); pass the id of the first one as before to get the page before it.
+    def GetHistory(self, other, before=None, limit=HISTORY_PAGE_SIZE):
+        return self.run_service("GetHistory", (self.username, other, before, limit))
+
+    # Fetch the messages between the client user and another user that came after the message with id
+    # after and were sent no earlier than the unix time since, oldest first.
+    def GetHistorySince(self, other, after=0, since=0.0, limit=HISTORY_PAGE_SIZE):
+        return self.run_service("GetHistorySince", (self.username, other, after, since, limit))
+
+    # Fetch the last messages sent to a group, a page at a time like GetHistory.
+    def GetGroupHistory(self, group, before=None, limit=HISTORY_PAGE_SIZE):
+        return self.run_service("GetGroupHistory", (group, before, limit))
+
+    # Fetch the messages sent to a group after a given id and time, like GetHistorySince.
+    def GetGroupHistorySince(self, group, after=0, since=0.0, limit=HISTORY_PAGE_SIZE):
+        return self.run_service("GetGroupHistorySince", (group, after, since, limit))
+
+    # Fetch the leader's metrics: counters, latency histograms, lock waits, queue depths and replication lag.
+    def Stats(self):
+        future = Future()
+        self.send_requests([(future, (is_client, STATS_CODE, tuple(), next(self.request_ids)))])
+        return future.result()
+
+    # Start delivering the logged in user's messages to on_message. They're pushed over the same
+    # connection to the leader as every call, and the stream is reopened on the new leader after a failover
     def ListenForMessages(self):
-        # try to connect with all servers
-        stream_sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(3)]
-        for i in range(3):
-            try:
-                stream_sockets[i].connect((self.server_addresses[i], self.ports[i]))
-            except ConnectionRefusedError:
-                pass
-        leader = self.leader
-        sel = self.InitiateChatConnection(stream_sockets[leader], self.server_addresses[leader])
-        # keep listening until either you're told to stop listening because client is logging out or all servers are down
-        while not (self.stop_listening or self.all_dead):
-            # when heartbeat thread changes the leader, initiate a new chat connection
-            if leader != self.leader:
-                leader = self.leader
-                sel = self.InitiateChatConnection(stream_sockets[leader], self.server_addresses[leader])
-            events = sel.select(timeout=None)
-            for key, mask in events:
-                # data is none when the event is a new connection
-                if key.data is None:
-                    raise Exception("Shouldn't be accepting connections to socket reserved for listening to messages")
-                data = stream_sockets[self.leader].recv(1024)
-                if not data: break
-                msg = eval(data.decode("utf-8"))
-                assert isinstance(msg, SingleMessage)
-                print("\n[" + msg.sender + "]: " + msg.message)
-
-    # run the heart beat thread
-    def HeartBeat(self):
-        # connect to all servers
-        sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM)for _ in range(3)]
-        transmission = str((is_client, HEARTBEAT_CODE, tuple())).encode("utf-8")
-        for i in range(3):
+        with self.lock:
+            self.stop_listening = False
+            self.stream_user = self.username
+            if self.delivered_user != self.username:
+                # the ids delivered so far were another user's
+                self.delivered_user = self.username
+                self.delivered_id = self.handled_id = self.acked_id = -1
+            conn = self.leader_connection()
+            if conn is not None:
+                self.open_stream(conn)
+
+    # ask a server to push the stream user's messages over a connection. Must be called with the lock held
+    def open_stream(self, conn):
+        # STREAM_CODE is a code for the ChatStream method call on the server
+        self.stream_request_id = next(self.request_ids)
+        self.queue_frames(conn, encode_frame((is_client, STREAM_CODE, (self.stream_user, self.delivered_id),
+                                              self.stream_request_id)))
+
+    # pass each message in a batch pushed on the chat stream to on_message; one that fails is logged
+    # and counts as handled, so it isn't delivered again
+    def deliver(self, batch):
+        for msg in batch:
             try:
-                sockets[i].connect((self.server_addresses[i], self.ports[i]))
-            except ConnectionRefusedError:
-                sockets[i] = None
-                self.has_heartbeat[i] = False
-        while not self.all_dead:
-            # check for heartbeat from all 3 servers if they haven't already gone down
-            # this is indicated by the index in the socket list being set to None
-            for i in range(3):
-                if sockets[i]:
-                    sockets[i].sendall(transmission)
-                    try:
-                        data = sockets[i].recv(1)
-                    except ConnectionResetError:
-                        data = None
-                    if not data:
-                        print(f"Server {i} has died")
-                        self.has_heartbeat[i] = False
-                        sockets[i] = None
-            # if the leader has gone down, select a new leader via carousel i.e. keep checking the next
-            # server in line (with wrap around) for a heartbeat until there's a new leader
-            if not self.has_heartbeat[self.leader]:
-                if any(self.has_heartbeat):
-                    i = (self.leader + 1) % 3
-                    j = (self.leader + 2) % 3
-                    self.leader = i if self.has_heartbeat[i] else j
-                else:
-                    self.all_dead = True
+                self.on_message(msg)
+            except Exception:
+                log.exception("on_message failed on %r", msg)
+
+    # call on_message with each batch of messages the stream delivers, in order, and acknowledge them once
+    # it's done. It runs on its own thread so that on_message can make calls and wait for their replies
+    # while the client goes on reading from the servers
+    def DeliverMessages(self):
+        while (delivery := self.deliveries.get()) is not None:
+            user, message_id, batch = delivery
+            self.deliver(batch)
+            with self.lock:
+                if user == self.delivered_user:
+                    self.handled_id = max(self.handled_id, message_id)
+            self.acknowledge()
+
+    # tell the servers that every message up to the last one on_message has handled has been received,
+    # so that they stop holding on to them; one acknowledgement is in flight at a time, and the next one
+    # covers everything handled while it was
+    def acknowledge(self):
+        with self.lock:
+            if self.acking or self.handled_id <= self.acked_id:
+                return
+            self.acking = True
+            user, through = self.delivered_user, self.handled_id
+        future = self.call_async("AckMessages", (user, through))
+        future.add_done_callback(lambda future: self.acknowledged(future, user, through))
+
+    def acknowledged(self, future, user, through):
+        with self.lock:
+            self.acking = False
+            if future.exception() is not None:
+                # the next delivery tries again
+                return
+            if user == self.delivered_user:
+                self.acked_id = max(self.acked_id, through)
+        self.acknowledge()
+
+    # Print a message that arrived on the chat stream.
+    def PrintMessage(self, msg):
+        print("\n[" + msg.sender + "]: " + msg.message)
 
     # Print the menu for the client.
     def printMenu(self):
@@ -171,11 +553,172 @@ class Client:
         print('6. Send Message')
         print('7. Exit / Logout')
 
+
+# a client for a sharded cluster: it keeps a Client per shard, each of which finds and follows the
+# leader of its own shard's replica group, and sends each call to the shard that owns the user the
+# call is about; messages go to the recipient's shard, and account listings are merged across shards
+class ShardedClient:
+    def __init__(self, cluster, **options):
+        self.username = ''
+        self.ring = ring_for(cluster)
+        self.shards = [Client(**client_kwargs(shard), **options) for shard in cluster["shards"]]
+        self.on_message = self.PrintMessage  # called with each message that arrives on the chat stream
+        for client in self.shards:
+            client.on_message = lambda msg: self.on_message(msg)
+
+    # the client for the shard that owns a user
+    def shard(self, user):
+        return self.shards[self.ring.shard_for(user)]
+
+    # boolean to tell the chat stream when user logs out
+    @property
+    def stop_listening(self):
+        return self.shard(self.username).stop_listening
+
+    @stop_listening.setter
+    def stop_listening(self, value):
+        for client in self.shards:
+            client.stop_listening = value
+
+    # Create an account with the given username.
+    def CreateAccount(self, usr=''):
+        return self.shard(usr).CreateAccount(usr)
+
+    # Delete the account with the client username.
+    def DeleteAccount(self):
+        success = self.shard(self.username).DeleteAccount()
+        if success:
+            self.username = ''
+        return success
+
+    # List accounts on every shard that match the wildcard
+    def ListAccounts(self, wildcard='.*'):
+        return list(self.IterAccounts(wildcard))
+
+    # List accounts that match a shell-style glob such as "user_*"
+    def ListAccountsGlob(self, glob):
+        return self.ListAccounts(glob_to_regex(glob))
+
+    # Yield the accounts that match the wildcard in sorted order; every shard lists its own accounts
+    # in sorted order a page at a time, and since no account is on two shards they merge into one listing
+    def IterAccounts(self, wildcard='.*', page_size=ACCOUNT_PAGE_SIZE):
+        return heapq.merge(*(client.IterAccounts(wildcard, page_size) for client in self.shards))
+
+    # Login to the user's shard with the given username.
+    def Login(self, usr):
+        success = self.shard(usr).Login(usr)
+        if success:
+            self.username = usr
+        return success
+
+    # Logout of the user's shard.
+    def Logout(self):
+        success = self.shard(self.username).Logout()
+        if success:
+            self.username = ''
+        return success
+
+    # Send a message to the given recipient, through the recipient's shard.
+    def SendMessage(self, recipient, message):
+        return self.shard(recipient).run_service("SendMessage", (self.username, recipient, message))
+
+    # Send a message to the given recipient without waiting; returns a future for whether it was sent.
+    def SendMessageAsync(self, recipient, message):
+        return self.shard(recipient).call_async("SendMessage", (self.username, recipient, message))
+
+    # Send the same message to many recipients, with the calls to every shard in flight at once;
+    # returns whether it was sent to each recipient.
+    def SendMessageBatch(self, recipients, message):
+        by_shard = {}
+        for recipient in recipients:
+            by_shard.setdefault(self.ring.shard_for(recipient), []).append(recipient)
+        futures = {}
+        for shard, shard_recipients in by_shard.items():
+            calls = [(self.username, recipient, message) for recipient in shard_recipients]
+            futures.update(zip(shard_recipients, self.shards[shard].call_many("SendMessage", calls)))
+        return [futures[recipient].result() for recipient in recipients]
+
+    # A group exists on every shard, and each shard's copy holds the members that live on that shard,
+    # so that a message to the group is delivered by one call per shard rather than one per member.
+    # Create a group on every shard, with the calls to every shard in flight at once. If any shard
+    # already has the group, it's deleted again from the shards it was just created on, so that the
+    # shards don't end up disagreeing about whether it exists.
+    def CreateGroup(self, group):
+        futures = [client.call_async("CreateGroup", (group,)) for client in self.shards]
+        created = [client for client, future in zip(self.shards, futures) if future.result()]
+        if len(created) == len(self.shards):
+            return True
+        for future in [client.call_async("DeleteGroup", (group,)) for client in created]:
+            future.result()
+        return False
+
+    # Delete a group from every shard that has it, with the calls to every shard in flight at once;
+    # returns whether every shard had it.
+    def DeleteGroup(self, group):
+        futures = [client.call_async("DeleteGroup", (group,)) for client in self.shards]
+        return all([future.result() for future in futures])
+
+    # Add the user to the group on the user's shard.
+    def JoinGroup(self, group):
+        return self.shard(self.username).run_service("JoinGroup", (group, self.username))
+
+    # Take the user out of the group on the user's shard.
+    def LeaveGroup(self, group):
+        return self.shard(self.username).run_service("LeaveGroup", (group, self.username))
+
+    # List the members of a group across every shard.
+    def ListGroupMembers(self, group):
+        return list(heapq.merge(*(client.ListGroupMembers(group) for client in self.shards)))
+
+    # Send a message to the members of a group on every shard, with the calls to every shard in flight at once.
+    def SendGroupMessage(self, group, message):
+        futures = [client.call_async("SendGroupMessage", (self.username, group, message)) for client in self.shards]
+        return all(future.result() for future in futures)
+
+    # A message is kept in the history of the recipient's shard, so a conversation between users on
+    # different shards is split between their two shards. Message ids are seqs of a shard's own calls
+    # and can't be compared across shards, so the halves are merged by the time each message was sent
+    # and pages of such a conversation are asked for by time rather than by id.
+    # Fetch the last messages between the user and another user sent before the unix time before (the
+    # very last ones if it's None), oldest first; to page backwards pass the time of the first message
+    # of the previous page.
+    def GetHistory(self, other, before=None, limit=HISTORY_PAGE_SIZE):
+        shards = {self.shard(self.username), self.shard(other)}
+        futures = [client.call_async("GetHistory", (self.username, other, None, limit, before)) for client in shards]
+        return list(heapq.merge(*(future.result() for future in futures), key=lambda row: row[1]))[-limit:]
+
+    # Fetch the first messages between the user and another user sent no earlier than the unix time since.
+    def GetHistorySince(self, other, since=0.0, limit=HISTORY_PAGE_SIZE):
+        shards = {self.shard(self.username), self.shard(other)}
+        futures = [client.call_async("GetHistorySince", (self.username, other, 0, since, limit)) for client in shards]
+        return list(heapq.merge(*(future.result() for future in futures), key=lambda row: row[1]))[:limit]
+
+    # Every shard is sent every message to a group, so a group's history is read from a single shard.
+    # Fetch the last messages sent to a group.
+    def GetGroupHistory(self, group, before=None, limit=HISTORY_PAGE_SIZE):
+        return self.shard(group).GetGroupHistory(group, before, limit)
+
+    # Fetch the messages sent to a group after a given id and time.
+    def GetGroupHistorySince(self, group, after=0, since=0.0, limit=HISTORY_PAGE_SIZE):
+        return self.shard(group).GetGroupHistorySince(group, after, since, limit)
+
+    # Start delivering the logged in user's messages, which arrive from the user's own shard.
+    def ListenForMessages(self):
+        self.shard(self.username).ListenForMessages()
+
+    PrintMessage = Client.PrintMessage
+    printMenu = Client.printMenu
+
+    # stop every shard's connection thread and close every connection
+    def Close(self):
+        for client in self.shards:
+            client.Close()
+
 # Run the client.
 
 
-def run():
-    client = Client()
+def run(config=None, **options):
+    client = Client(**options) if config is None else ShardedClient(load_cluster(config), **options)
     client.printMenu()
     user_input = input("Enter option: ")
     if user_input in ['1', '2', '3', '4', '5', '6', '7']:
@@ -194,13 +737,13 @@ def run():
 
         # list accounts
         elif rpc_call == 2:
-            for account in client.ListAccounts():
+            for account in client.IterAccounts():
                 print(account)
 
         # list accounts by wildcard
         elif rpc_call == 3:
             wildcard = input("Enter wildcard: ")
-            for account in client.ListAccounts(wildcard):
+            for account in client.IterAccounts(wildcard):
                 print(account)
 
         # delete account
@@ -218,10 +761,8 @@ def run():
             usr = input("Enter username: ")
             if client.Login(usr):
                 print("Login successful")
-                # start a thread to listen for messages
-                t = threading.Thread(target=client.ListenForMessages)
-                t.daemon = True
-                t.start()
+                # messages are delivered by the client's connection thread from now on
+                client.ListenForMessages()
             else:
                 print("Login failed. Username might not exist.")
 
@@ -251,12 +792,21 @@ def run():
 
     # stop listening for messages
     client.stop_listening = True
+    client.Close()
     print('Exiting...')
     sys.exit(0)
 
 # run the client
 if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        run()
-    else:
-        print("This program does not take command line arguments")
+    parser = argparse.ArgumentParser(description="Run the chat client")
+    parser.add_argument("--config", help="cluster config file listing the servers of every shard; "
+                                         "without one, the client talks to the servers in common.py")
+    parser.add_argument("--read-consistency", choices=READ_CONSISTENCY_MODES, default='leader',
+                        help="which servers account listings and other reads may be answered by")
+    parser.add_argument("--max-staleness", type=int, default=0,
+                        help="with bounded_staleness, how many calls behind a server answering a read may be")
+    parser.add_argument("--no-compression", dest="compression", action="store_false",
+                        help="don't ask the servers to compress the frames they send")
+    args = parser.parse_args()
+    run(args.config, read_consistency=args.read_consistency, max_staleness=args.max_staleness,
+        compression=args.compression)
@@ -1,3 +1,7 @@
+import fnmatch
+import re
+import struct
+import zlib
 from collections import namedtuple
 
 SERVER_ADDR_0 = "192.168.1.17"
@@ -16,8 +20,449 @@ SERVER_FACING_PORT_2 = 50056
 # type for messages
 SingleMessage = namedtuple("SingleMessage", ["sender", "message"])
 
-# methods that will be exposed to the client; our analog to services
-SERVER_METHODS = ['CreateAccount', 'ListAccounts', 'DeleteAccount', 'Login', 'Logout', 'SendMessage', 'ChatStream']
+# methods that will be exposed to the client; our analog to services. New methods go at the end so
+# that the codes of the existing ones don't change
+SERVER_METHODS = ['CreateAccount', 'ListAccounts', 'DeleteAccount', 'Login', 'Logout', 'SendMessage', 'ChatStream',
+                  'CreateGroup', 'DeleteGroup', 'JoinGroup', 'LeaveGroup', 'ListGroupMembers', 'SendGroupMessage',
+                  'GetHistory', 'GetHistorySince', 'GetGroupHistory', 'GetGroupHistorySince', 'AckMessages']
 STREAM_CODE = SERVER_METHODS.index('ChatStream')
+# a chat stream opened with (user,) has each message removed from the mailbox once it's sent. One opened
+# with (user, after) starts after the message with id after (-1 for every message waiting), and its
+# frames carry the id of their last message; those messages stay in the mailbox on every server until
+# the client acknowledges them with AckMessages(user, id), so a stream reopened on another server after
+# a failover picks up where the client left off
 
-HEARTBEAT_CODE = 77
\ No newline at end of file
+HEARTBEAT_CODE = 77
+# seconds between the heartbeats a client sends each server, and how long a server may go without
+# answering one before the client declares it dead; a server that closes its connections is noticed
+# right away, so this bounds failover for servers that hang instead
+HEARTBEAT_INTERVAL = 0.1
+HEARTBEAT_TIMEOUT = 0.5
+# seconds a client waits for a connection to a server to open before counting the server as down
+CONNECT_TIMEOUT = 0.5
+
+# asks a server for its metrics, which it answers right away with a dict of them
+STATS_CODE = 78
+
+# sent by either end of a connection to say that it can decode compressed frames, and would like the
+# other end to compress the frames it sends; a client's is answered with whether the server agreed
+COMPRESS_CODE = 79
+# frames (or batches of frames sent together) of at least this many bytes are compressed on connections
+# that negotiated compression, at this zlib level; small frames aren't worth the time
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 1
+
+# methods that don't change any state, so they are neither replicated nor given a sequence number
+READ_ONLY_METHODS = {'ListAccounts', 'ListGroupMembers', 'GetHistory', 'GetHistorySince', 'GetGroupHistory',
+                     'GetGroupHistorySince'}
+# the read-only methods a client may send to any server rather than the leader (see READ_CONSISTENCY_MODES);
+# the history is only read from the leader, which has stored every message it has replied about
+BACKUP_READ_METHODS = {'ListAccounts', 'ListGroupMembers'}
+# the read-only methods a worker process answers for its own clients (see Server.answer_read)
+WORKER_READ_METHODS = {'GetHistory', 'GetHistorySince', 'GetGroupHistory', 'GetGroupHistorySince'}
+
+# methods whose args the leader adds the unix time to before applying and replicating them, so that
+# every server records the same time for the message they send
+TIMESTAMPED_METHODS = {'SendMessage', 'SendGroupMessage'}
+
+_INT = (int,)
+_NUMBER = (int, float)
+_OPTIONAL_INT = (int, type(None))
+_OPTIONAL_NUMBER = (int, float, type(None))
+_OPTIONAL_STR = (str, type(None))
+# the types of the args a client may pass to each method (and to ChatStream), as (required, optional),
+# where each entry is a tuple of accepted types; strings are names, wildcards and messages. Calls are
+# checked against this before they run, so a state-changing method never fails halfway through on bad
+# args. The timestamp of a TIMESTAMPED_METHODS call is added by the leader, never by the client
+METHOD_ARGS = {
+    'CreateAccount': (((str,),), ()),
+    'ListAccounts': (((str,),), (_OPTIONAL_STR, _INT)),
+    'DeleteAccount': (((str,),), ()),
+    'Login': (((str,),), ()),
+    'Logout': (((str,),), ()),
+    'SendMessage': (((str,), (str,), (str,)), ()),
+    'ChatStream': (((str,),), (_OPTIONAL_INT,)),
+    'CreateGroup': (((str,),), ()),
+    'DeleteGroup': (((str,),), ()),
+    'JoinGroup': (((str,), (str,)), ()),
+    'LeaveGroup': (((str,), (str,)), ()),
+    'ListGroupMembers': (((str,),), ()),
+    'SendGroupMessage': (((str,), (str,), (str,)), ()),
+    'GetHistory': (((str,), (str,)), (_OPTIONAL_INT, _INT, _OPTIONAL_NUMBER)),
+    'GetHistorySince': (((str,), (str,)), (_INT, _NUMBER, _INT)),
+    'GetGroupHistory': (((str,),), (_OPTIONAL_INT, _INT)),
+    'GetGroupHistorySince': (((str,),), (_INT, _NUMBER, _INT)),
+    'AckMessages': (((str,), _INT), ()),
+}
+
+
+# raise ProtocolError unless args are what a client may pass to method (see METHOD_ARGS)
+def check_args(method, args):
+    required, optional = METHOD_ARGS[method]
+    if not isinstance(args, tuple) or not len(required) <= len(args) <= len(required) + len(optional):
+        raise ProtocolError(f"Wrong number of arguments to {method}")
+    for i, (arg, types) in enumerate(zip(args, required + optional)):
+        if not isinstance(arg, types):
+            raise ProtocolError(f"Argument {i} to {method} can't be {type(arg).__name__}")
+
+# every reply to a call is (request_id, output, seq), where seq is the last replicated call the
+# reply reflects, and heartbeats are answered with (0, True, last applied seq). A read-only call may
+# be sent to any server with a fifth element, the least seq the server must have applied to answer
+# it; a server that is further behind answers (request_id, None, last applied seq, True) instead,
+# and the client sends the call to the leader. How a client picks the server for a read-only call:
+#   leader: always the leader, so reads see every write the leader has applied
+#   read_your_writes: any server that has applied every call the client has seen a reply for
+#   bounded_staleness: any server at most max_staleness calls behind the latest seq the client knows of
+READ_CONSISTENCY_MODES = ['leader', 'read_your_writes', 'bounded_staleness']
+
+# number of accounts the client asks for in each call when listing accounts a page at a time
+ACCOUNT_PAGE_SIZE = 1000
+# number of messages the client asks for in each call when reading a conversation's history
+HISTORY_PAGE_SIZE = 100
+
+# codes for the frames that servers exchange with each other
+REPLICATE_CODE = 80  # list of (seq, method_code, args) for method calls the leader applied
+SYNC_REQUEST_CODE = 81  # (last applied seq,) sent by a server that may be behind
+SYNC_DELTA_CODE = 82  # list of (seq, method_code, args) that the requester missed
+SYNC_SNAPSHOT_CODE = 83  # (seq, section, items) chunks of a full state transfer, ending with section "end"
+ACK_CODE = 84  # (last applied seq,) sent back after applying replicated calls
+
+# when the leader replies to a client: as soon as it has applied a call itself, or once a majority of
+# the servers (counting the leader) have applied it
+ACK_MODES = ['leader', 'majority']
+
+# how many bytes to ask for on each recv call; frames larger than this are reassembled across reads
+RECV_BUFFER_SIZE = 65536
+
+# every message on the wire is a frame: a 4 byte big-endian body length followed by the encoded body
+FRAME_HEADER = struct.Struct("!I")
+# refuse frames above this size so a corrupt header can't make us buffer forever
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# set in the length of a frame whose body is one or more whole frames compressed with zlib; receivers
+# replace it with the frames it holds, so a batch of small frames can be compressed together
+COMPRESSED_FLAG = 1 << 31
+# refuse bodies with tuples, lists, dicts and messages nested deeper than this, since decoding recurses
+# once per level; nothing we send comes close
+MAX_NESTING_DEPTH = 64
+
+_U32 = struct.Struct("!I")
+_I64 = struct.Struct("!q")
+_F64 = struct.Struct("!d")
+_I8 = struct.Struct("!b")
+
+# one byte type tags for the body encoding
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _BYTES, _TUPLE, _LIST, _DICT, _MESSAGE = b"NTFifsbtldm"
+# compact forms for the common case of small ints and short strings
+_SMALL_INT, _SHORT_STR = b"jS"
+_CONTAINERS = {_TUPLE, _LIST, _DICT, _MESSAGE}
+
+
+# turn a shell-style glob (e.g. "user_*") into a ListAccounts wildcard; the literal text before the
+# first glob character is escaped and anchored, so the server only looks at accounts with that prefix
+def glob_to_regex(glob):
+    literal = len(glob)
+    for i, c in enumerate(glob):
+        if c in "*?[":
+            literal = i
+            break
+    return "^" + re.escape(glob[:literal]) + fnmatch.translate(glob[literal:])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _encode_none(obj, out):
+    out.append(_NONE)
+
+def _encode_bool(obj, out):
+    out.append(_TRUE if obj else _FALSE)
+
+def _encode_int(obj, out):
+    if -128 <= obj < 128:
+        out.append(_SMALL_INT)
+        out += _I8.pack(obj)
+    else:
+        out.append(_INT)
+        out += _I64.pack(obj)
+
+def _encode_float(obj, out):
+    out.append(_FLOAT)
+    out += _F64.pack(obj)
+
+def _encode_str(obj, out):
+    raw = obj.encode("utf-8")
+    if len(raw) < 256:
+        out.append(_SHORT_STR)
+        out.append(len(raw))
+    else:
+        out.append(_STR)
+        out += _U32.pack(len(raw))
+    out += raw
+
+def _encode_bytes(obj, out):
+    out.append(_BYTES)
+    out += _U32.pack(len(obj))
+    out += obj
+
+def _encode_sequence(tag):
+    def encode(obj, out):
+        out.append(tag)
+        out += _U32.pack(len(obj))
+        for item in obj:
+            _ENCODERS[type(item)](item, out)
+    return encode
+
+def _encode_dict(obj, out):
+    out.append(_DICT)
+    out += _U32.pack(len(obj))
+    for key, value in obj.items():
+        _ENCODERS[type(key)](key, out)
+        _ENCODERS[type(value)](value, out)
+
+# messages are encoded field by field without a count since the field list is fixed
+def _encode_message(obj, out):
+    out.append(_MESSAGE)
+    for item in obj:
+        _ENCODERS[type(item)](item, out)
+
+
+_ENCODERS = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    tuple: _encode_sequence(_TUPLE),
+    list: _encode_sequence(_LIST),
+    dict: _encode_dict,
+    SingleMessage: _encode_message,
+}
+
+
+# decode the value starting at pos in buf, depth containers in, and return it along with the position
+# right after it
+def _decode(buf, pos, depth=0):
+    tag = buf[pos]
+    pos += 1
+    if tag == _SHORT_STR:
+        length = buf[pos]
+        pos += 1
+        return str(buf[pos:pos + length], "utf-8"), pos + length
+    if tag == _SMALL_INT:
+        return _I8.unpack_from(buf, pos)[0], pos + 1
+    if tag == _STR:
+        (length,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        return str(buf[pos:pos + length], "utf-8"), pos + length
+    if tag == _INT:
+        return _I64.unpack_from(buf, pos)[0], pos + 8
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag in _CONTAINERS and depth >= MAX_NESTING_DEPTH:
+        raise ProtocolError(f"Values nested more than {MAX_NESTING_DEPTH} deep")
+    if tag == _TUPLE or tag == _LIST:
+        (count,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        items = []
+        for _ in range(count):
+            item, pos = _decode(buf, pos, depth + 1)
+            items.append(item)
+        return (tuple(items) if tag == _TUPLE else items), pos
+    if tag == _MESSAGE:
+        fields = []
+        for _ in SingleMessage._fields:
+            field, pos = _decode(buf, pos, depth + 1)
+            fields.append(field)
+        return SingleMessage(*fields), pos
+    if tag == _NONE:
+        return None, pos
+    if tag == _BYTES:
+        (length,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        return bytes(buf[pos:pos + length]), pos + length
+    if tag == _FLOAT:
+        return _F64.unpack_from(buf, pos)[0], pos + 8
+    if tag == _DICT:
+        (count,) = _U32.unpack_from(buf, pos)
+        pos += 4
+        result = {}
+        for _ in range(count):
+            key, pos = _decode(buf, pos, depth + 1)
+            result[key], pos = _decode(buf, pos, depth + 1)
+        return result, pos
+    raise ProtocolError(f"Unknown type tag {tag}")
+
+
+# encode a python value (None, bools, ints, floats, strings, bytes, tuples, lists, dicts and messages)
+# into a complete frame that is ready to be written to a socket
+def encode_frame(obj):
+    out = bytearray(FRAME_HEADER.size)
+    try:
+        _ENCODERS[type(obj)](obj, out)
+    except KeyError as e:
+        raise ProtocolError(f"Cannot encode values of type {e.args[0].__name__}") from None
+    FRAME_HEADER.pack_into(out, 0, len(out) - FRAME_HEADER.size)
+    return bytes(out)
+
+
+# encode a value on its own, without a frame header, so it can be encoded once and spliced into frames later
+def encode_value(obj):
+    out = bytearray()
+    try:
+        _ENCODERS[type(obj)](obj, out)
+    except KeyError as e:
+        raise ProtocolError(f"Cannot encode values of type {e.args[0].__name__}") from None
+    return bytes(out)
+
+
+# a chat stream frame, (request_id, [message, ...]), put together from count messages that have already
+# been encoded with encode_value and concatenated, so delivering them doesn't encode them again. Streams
+# that are acknowledged get (request_id, [message, ...], id of the last message) instead
+def encode_stream_frame(request_id, count, encoded_messages, last_id=None):
+    out = bytearray(FRAME_HEADER.size)
+    out.append(_TUPLE)
+    out += _U32.pack(2 if last_id is None else 3)
+    _ENCODERS[type(request_id)](request_id, out)
+    out.append(_LIST)
+    out += _U32.pack(count)
+    out += encoded_messages
+    if last_id is not None:
+        _encode_int(last_id, out)
+    FRAME_HEADER.pack_into(out, 0, len(out) - FRAME_HEADER.size)
+    return bytes(out)
+
+
+# decode a single frame body (i.e. without its length header)
+def decode_body(body):
+    try:
+        obj, end = _decode(body, 0)
+    except (IndexError, TypeError, struct.error, UnicodeDecodeError) as e:
+        # TypeError is an unhashable dict key
+        raise ProtocolError(f"Malformed frame: {e}") from None
+    if end != len(body):
+        raise ProtocolError("Trailing bytes after frame body")
+    return obj
+
+
+# one or more whole frames as a single compressed frame, or unchanged if compressing doesn't make them smaller
+def compress_frames(frames, level=COMPRESSION_LEVEL):
+    if len(frames) > MAX_FRAME_SIZE:
+        # the receiver wouldn't inflate more than this
+        return frames
+    compressed = zlib.compress(frames, level)
+    if len(compressed) + FRAME_HEADER.size >= len(frames):
+        return frames
+    return FRAME_HEADER.pack(len(compressed) | COMPRESSED_FLAG) + compressed
+
+
+# replace the compressed frame with the given body length at pos in buf with the frames it holds;
+# returns whether the whole compressed frame had arrived
+def _inflate_at(buf, pos, length):
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Compressed frame of {length} bytes exceeds the maximum frame size")
+    end = pos + FRAME_HEADER.size + length
+    if end > len(buf):
+        return False
+    inflater = zlib.decompressobj()
+    try:
+        frames = inflater.decompress(buf[pos + FRAME_HEADER.size:end], MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise ProtocolError(f"Malformed compressed frame: {e}") from None
+    if inflater.unconsumed_tail or not inflater.eof:
+        raise ProtocolError("Compressed frame is truncated or inflates past the maximum frame size")
+    buf[pos:end] = frames
+    return True
+
+
+# the position right after the frame starting at pos in buf, or None if it is incomplete; a compressed
+# frame is replaced with the frames it holds first, so this is the end of the first of them
+def _frame_end(buf, pos):
+    if len(buf) - pos < FRAME_HEADER.size:
+        return None
+    (length,) = FRAME_HEADER.unpack_from(buf, pos)
+    if length > MAX_FRAME_SIZE:
+        if length & COMPRESSED_FLAG:
+            return _frame_end(buf, pos) if _inflate_at(buf, pos, length & ~COMPRESSED_FLAG) else None
+        raise ProtocolError(f"Frame of {length} bytes exceeds the maximum frame size")
+    end = pos + FRAME_HEADER.size + length
+    return end if end <= len(buf) else None
+
+
+# return the frame starting at pos in buf and the position right after it, or None if it is incomplete
+def _frame_at(buf, pos):
+    end = _frame_end(buf, pos)
+    if end is None:
+        return None
+    with memoryview(buf) as view:
+        return decode_body(view[pos + FRAME_HEADER.size:end]), end
+
+
+# incrementally decode a per-connection inbound buffer: return every complete frame in buf
+# and remove those bytes from it, leaving any partial frame behind for the next read
+def pop_frames(buf):
+    frames = []
+    pos = 0
+    while (frame := _frame_at(buf, pos)) is not None:
+        obj, pos = frame
+        frames.append(obj)
+    if pos:
+        del buf[:pos]
+    return frames
+
+
+# like pop_frames, but return each complete frame still encoded, length header and all, so it can be
+# passed on without decoding it; compressed frames are still inflated
+def pop_raw_frames(buf):
+    frames = []
+    pos = 0
+    while (end := _frame_end(buf, pos)) is not None:
+        frames.append(bytes(buf[pos:end]))
+        pos = end
+    if pos:
+        del buf[:pos]
+    return frames
+
+
+# frames between a server and its worker processes (see workers.py) are each prefixed with the id of
+# the client session they belong to; frames on CONTROL_SESSION are (kind, session id, ...) notices
+# about the sessions themselves
+SESSION_HEADER = struct.Struct("!I")
+CONTROL_SESSION = 0
+# set in the session id of a frame the server sends a worker when the frame is a read for the worker
+# to answer rather than a reply to pass on
+QUERY_FLAG = 1 << 31
+
+
+# return every complete (session id, frame) in a buffer of session-prefixed frames and remove them from it
+def pop_session_frames(buf):
+    frames = []
+    pos = 0
+    while len(buf) - pos >= SESSION_HEADER.size + FRAME_HEADER.size:
+        (session,) = SESSION_HEADER.unpack_from(buf, pos)
+        (length,) = FRAME_HEADER.unpack_from(buf, pos + SESSION_HEADER.size)
+        end = pos + SESSION_HEADER.size + FRAME_HEADER.size + length
+        if end > len(buf):
+            break
+        frames.append((session, bytes(buf[pos + SESSION_HEADER.size:end])))
+        pos = end
+    if pos:
+        del buf[:pos]
+    return frames
+
+
+# block until one full frame has arrived on sock and return it, keeping any extra bytes in buf;
+# returns None if the connection is closed before a full frame arrives
+def recv_frame(sock, buf):
+    while (frame := _frame_at(buf, 0)) is None:
+        chunk = sock.recv(RECV_BUFFER_SIZE)
+        if not chunk:
+            return None
+        buf += chunk
+    obj, end = frame
+    del buf[:end]
+    return obj
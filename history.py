@@ -0,0 +1,182 @@
+import sqlite3
+import threading
+from collections import deque
+from pathlib import Path
+from common import *
+
+# most messages returned by one history query
+HISTORY_QUERY_LIMIT = 1000
+# seconds between the background thread's passes over the messages waiting to be inserted
+HISTORY_WRITE_INTERVAL = 0.05
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    sent_at REAL NOT NULL,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+-- a message is only ever stored once, however many times the call that sent it is replayed or caught up on
+CREATE UNIQUE INDEX IF NOT EXISTS messages_by_conversation_seq ON messages (conversation, seq);
+CREATE INDEX IF NOT EXISTS messages_by_seq ON messages (seq);
+"""
+
+
+# a requested number of messages clamped to 0..HISTORY_QUERY_LIMIT; SQLite takes a negative LIMIT to mean
+# no limit at all
+def page_size(limit):
+    return max(0, min(limit, HISTORY_QUERY_LIMIT))
+
+
+# the conversation between two users, which is the same whichever of them is asking
+def direct_conversation(user, other):
+    return "u:" + "\0".join(sorted((user, other)))
+
+
+def group_conversation(group):
+    return "g:" + group
+
+
+# the history reads a client can call, run against any HistoryReader: the server's HistoryStore or a
+# worker process's own reader (see HISTORY_READS)
+
+# the last limit messages between two users before the message with id before, or the very last
+# ones if before is None, oldest first as (id, unix time sent, sender, message). A message's id is
+# the seq of the call that sent it, so to page backwards through a conversation pass the id of the
+# first message of the previous page as before. Passing the unix time until leaves out messages sent
+# at or after it, which is how a conversation split across two shards is paged through
+def get_history(history, user, other, before=None, limit=HISTORY_PAGE_SIZE, until=None):
+    return history.last(direct_conversation(user, other), before, limit, until)
+
+
+# the first limit messages between two users after the message with id after and sent no earlier
+# than the unix time since, oldest first as (id, unix time sent, sender, message)
+def get_history_since(history, user, other, after=0, since=0.0, limit=HISTORY_PAGE_SIZE):
+    return history.since(direct_conversation(user, other), after, since, limit)
+
+
+# the same as get_history for the messages sent to a group
+def get_group_history(history, group, before=None, limit=HISTORY_PAGE_SIZE):
+    return history.last(group_conversation(group), before, limit)
+
+
+# the same as get_history_since for the messages sent to a group
+def get_group_history_since(history, group, after=0, since=0.0, limit=HISTORY_PAGE_SIZE):
+    return history.since(group_conversation(group), after, since, limit)
+
+
+# the history read for each method a worker process answers (see WORKER_READ_METHODS)
+HISTORY_READS = {'GetHistory': get_history, 'GetHistorySince': get_history_since,
+                 'GetGroupHistory': get_group_history, 'GetGroupHistorySince': get_group_history_since}
+
+
+# a read-only view of a history database written by a HistoryStore, e.g. in another process. SQLite's
+# WAL mode lets it read alongside the writer, and every query sees every message the writer had
+# committed when the query started
+class HistoryReader:
+    def __init__(self, path):
+        self.db = sqlite3.connect(Path(path).absolute().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+
+    def query(self, sql, args):
+        return self.db.execute(sql, args).fetchall()
+
+    # the last limit messages of a conversation sent before the message with id before and before the
+    # unix time until (or the very last ones if both are None), oldest first, as (id, sent_at, sender, message)
+    def last(self, conversation, before=None, limit=HISTORY_QUERY_LIMIT, until=None):
+        rows = self.query("SELECT seq, sent_at, sender, message FROM messages "
+                          "WHERE conversation = ? AND seq < ? AND sent_at < ? ORDER BY seq DESC, id DESC LIMIT ?",
+                          (conversation, (1 << 63) - 1 if before is None else before,
+                           float("inf") if until is None else until, page_size(limit)))
+        rows.reverse()
+        return rows
+
+    # the first limit messages of a conversation sent after the message with id after and no earlier
+    # than the unix time since, oldest first, as (id, sent_at, sender, message)
+    def since(self, conversation, after=0, since=0.0, limit=HISTORY_QUERY_LIMIT):
+        return self.query("SELECT seq, sent_at, sender, message FROM messages "
+                          "WHERE conversation = ? AND seq > ? AND sent_at >= ? ORDER BY seq, id LIMIT ?",
+                          (conversation, after, since, page_size(limit)))
+
+    def close(self):
+        self.db.close()
+
+
+# every message sent through the server, kept by conversation in an SQLite database in WAL mode so
+# that a page of a conversation is an indexed range query. Messages are identified by the seq of the
+# replicated call that sent them, which is the same on every server, and storing a message that's
+# already there does nothing. Appends only buffer the row, so sending a message never waits on SQLite;
+# a background thread inserts everything buffered every HISTORY_WRITE_INTERVAL seconds in one
+# transaction, and queries write out anything still buffered first so they always see every message
+# sent before them. Rows still buffered when the server crashes are stored again when the write-ahead
+# log is replayed
+class HistoryStore(HistoryReader):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode this only syncs at checkpoints, so a power loss can lose the latest messages but
+        # a crash of the server can't
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+        self.db_lock = threading.Lock()  # the connection is shared by the writer thread and queries
+        # (conversation, seq, sent_at, sender, message) rows waiting to be inserted; deque appends and
+        # pops are atomic, so appending doesn't need a lock
+        self.pending = deque()
+        self.closed = threading.Event()
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    # buffer a message for the next batch of inserts
+    def append(self, conversation, seq, sent_at, sender, message):
+        self.pending.append((conversation, seq, sent_at, sender, message))
+
+    # insert every buffered row in one transaction. Must be called with db_lock held
+    def write_pending(self):
+        batch = [self.pending.popleft() for _ in range(len(self.pending))]
+        if batch:
+            with self.db:
+                self.db.executemany("INSERT OR IGNORE INTO messages (conversation, seq, sent_at, sender, message) "
+                                    "VALUES (?, ?, ?, ?, ?)", batch)
+
+    def write_loop(self):
+        while not self.closed.wait(HISTORY_WRITE_INTERVAL):
+            if self.pending:
+                with self.db_lock:
+                    self.write_pending()
+
+    def query(self, sql, args):
+        with self.db_lock:
+            self.write_pending()
+            return self.db.execute(sql, args).fetchall()
+
+    # up to limit messages sent by calls with seqs after after_seq and up to through_seq, in seq order,
+    # as (conversation, seq, sent_at, sender, message) rows that can be passed to append
+    def rows_between(self, after_seq, through_seq, limit):
+        return self.query("SELECT conversation, seq, sent_at, sender, message FROM messages "
+                          "WHERE seq > ? AND seq <= ? ORDER BY seq, id LIMIT ?", (after_seq, through_seq, limit))
+
+    # insert everything buffered, so that a HistoryReader sees every message appended so far
+    def flush(self):
+        with self.db_lock:
+            self.write_pending()
+
+    # insert everything buffered and checkpoint the database, so that every message appended so far is
+    # on disk, e.g. before the write-ahead log events they came from are compacted away
+    def checkpoint(self):
+        with self.db_lock:
+            self.write_pending()
+            self.db.execute("PRAGMA wal_checkpoint(FULL)")
+
+    # the number of messages waiting to be inserted
+    def backlog(self):
+        return len(self.pending)
+
+    # insert everything that has been appended and close the database
+    def close(self):
+        self.closed.set()
+        self.writer.join()
+        with self.db_lock:
+            self.write_pending()
+            self.db.close()
@@ -0,0 +1,303 @@
+import hashlib
+import os
+import shutil
+import struct
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from common import *
+
+# number of messages a mailbox keeps in memory; newer ones spill to disk until it drains
+MAILBOX_MEMORY_LIMIT = 1000
+
+SPILL_SUFFIX = ".spill"
+# each message in a spill file is its length and id followed by its encoding
+SPILL_HEADER = struct.Struct("!Iq")
+# higher than the id of any message
+MAX_MESSAGE_ID = (1 << 63) - 1
+# most spill files kept open for appending at once, well under the usual limit of 1024 open files
+SPILL_FILES_OPEN = 256
+
+
+# the spill files being appended to, kept open so that appending a message only copies it into the
+# file's buffer. Only the SPILL_FILES_OPEN most recently appended to stay open, so any number of
+# mailboxes can spill; the least recently used one is closed, which flushes it, to make room for another
+class SpillFiles:
+    def __init__(self, limit=SPILL_FILES_OPEN):
+        self.limit = limit
+        self.files = OrderedDict()
+        self.lock = threading.Lock()  # mailboxes under different chat locks share the pool
+
+    def append(self, path, data):
+        with self.lock:
+            f = self.files.pop(path, None)
+            if f is None:
+                if len(self.files) >= self.limit:
+                    self.files.popitem(last=False)[1].close()
+                f = open(path, "ab")
+            self.files[path] = f
+            f.write(data)
+
+    # flush what has been appended to a spill file so that it can be read
+    def flush(self, path):
+        with self.lock:
+            f = self.files.get(path)
+            if f is not None:
+                f.flush()
+
+    def close(self, path):
+        with self.lock:
+            f = self.files.pop(path, None)
+            if f is not None:
+                f.close()
+
+
+# a user's undelivered messages, oldest first. Up to limit of the oldest messages are kept in memory
+# and newer ones are appended to a spill file as frames, to be read back in as the mailbox drains.
+# Rather than a SingleMessage and two strings per message, the messages in memory are kept encoded
+# (see encode_value) one after another in a single buffer, with an array of where each one ends. A
+# message is encoded once when it arrives, however many mailboxes it goes to, and a batch of messages
+# is delivered by splicing a slice of the buffer into a stream frame; messages are only decoded back
+# into SingleMessages when they're read some other way.
+# Every message also has an id, the seq of the replicated call that sent it, which is the same on every
+# server and only grows within a mailbox, so a client can acknowledge everything it has received up to
+# an id and pick up after it on any server (see peek_encoded and drop_through)
+class Mailbox:
+    __slots__ = ("path", "limit", "ends", "ids", "encoded", "head", "spilled", "spill_pos", "spill_files")
+
+    def __init__(self, path, limit=MAILBOX_MEMORY_LIMIT, entries=(), spill_files=None):
+        self.path = path
+        self.limit = limit
+        self.ends = array("q")  # where each message ends in self.encoded
+        self.ids = array("q")  # the id of each message in self.ends
+        self.encoded = bytearray()
+        self.head = 0  # index of the oldest message in memory; the ones before it have been taken
+        self.spilled = 0  # number of messages in the spill file that haven't been read back in yet
+        self.spill_pos = 0  # offset in the spill file of the first of them
+        # where the spill file is appended to, shared with the other mailboxes; it's flushed before it's read
+        self.spill_files = SpillFiles() if spill_files is None else spill_files
+        for message_id, message in entries:
+            self.append(message, message_id)
+
+    def __len__(self):
+        return len(self.ends) - self.head + self.spilled
+
+    # the number of messages held in memory
+    def in_memory(self):
+        return len(self.ends) - self.head
+
+    # the offset in self.encoded of the message at index i of self.ends
+    def start_of(self, i):
+        return self.ends[i - 1] if i else 0
+
+    def __iter__(self):
+        return (message for _, message in self.entries())
+
+    # every message as (id, message), oldest first
+    def entries(self):
+        entries = [(self.ids[i], decode_body(self.encoded[self.start_of(i):self.ends[i]]))
+                   for i in range(self.head, len(self.ends))]
+        yield from entries
+        if self.spilled:
+            self.spill_files.flush(self.path)
+            with open(self.path, "rb") as f:
+                f.seek(self.spill_pos)
+                for _ in range(self.spilled):
+                    message_id, encoded = self.read_spilled(f)
+                    yield message_id, decode_body(encoded)
+
+    # the id and encoding of the next message in a spill file
+    def read_spilled(self, f):
+        length, message_id = SPILL_HEADER.unpack(f.read(SPILL_HEADER.size))
+        return message_id, f.read(length)
+
+    # add a message to the end of the mailbox and return whether it had to be spilled to disk
+    def append(self, message, message_id=0):
+        return self.append_encoded(encode_value(message), message_id)
+
+    # add a message that has already been encoded with encode_value, e.g. one going to many mailboxes
+    def append_encoded(self, encoded, message_id=0):
+        # once anything has spilled, later messages have to spill too so they stay in order
+        if not self.spilled and self.in_memory() < self.limit:
+            self.encoded += encoded
+            self.ends.append(len(self.encoded))
+            self.ids.append(message_id)
+            return False
+        self.spill_files.append(self.path, SPILL_HEADER.pack(len(encoded), message_id) + encoded)
+        self.spilled += 1
+        return True
+
+    # remove and return up to count of the oldest messages, or all of them if count is None
+    def take(self, count=None):
+        count = len(self) if count is None else min(count, len(self))
+        batch = []
+        while len(batch) < count:
+            if not self.in_memory():
+                self.load_spilled()
+            taken = min(count - len(batch), self.in_memory())
+            batch.extend(decode_body(self.encoded[self.start_of(i):self.ends[i]])
+                         for i in range(self.head, self.head + taken))
+            self.head += taken
+            self.compact()
+        return batch
+
+    # remove up to count of the oldest messages without decoding them, returning how many were taken
+    # and their encodings concatenated; only messages in memory are taken, so if the ones in memory
+    # run out, fewer than count come back even though more are waiting
+    def take_encoded(self, count):
+        if not self.in_memory() and self.spilled:
+            self.load_spilled()
+        count = min(count, self.in_memory())
+        if not count:
+            return 0, b""
+        encoded = bytes(self.encoded[self.start_of(self.head):self.ends[self.head + count - 1]])
+        self.head += count
+        self.compact()
+        return count, encoded
+
+    # the number of messages with ids up to and including message_id, which for a stream is how many
+    # it has sent that haven't been acknowledged yet. Those are usually in memory since peek_encoded
+    # reads them in, but a stream resumed after a failover can start past messages that are still spilled
+    def count_through(self, message_id):
+        end = bisect_right(self.ids, message_id, self.head)
+        counted = end - self.head
+        if end < len(self.ends) or not self.spilled:
+            return counted
+        self.spill_files.flush(self.path)
+        with open(self.path, "rb") as f:
+            f.seek(self.spill_pos)
+            for _ in range(self.spilled):
+                length, spilled_id = SPILL_HEADER.unpack(f.read(SPILL_HEADER.size))
+                if spilled_id > message_id:
+                    break
+                counted += 1
+                f.seek(length, os.SEEK_CUR)
+        return counted
+
+    # up to count of the oldest messages with ids after message_id and no later than through, without
+    # removing or decoding them, as how many there are, the id of the last one and their encodings
+    # concatenated. Messages are read back in from the spill file once every one in memory is past
+    # message_id, so the ones that have been peeked at stay in memory until they're dropped
+    def peek_encoded(self, message_id, count, through=MAX_MESSAGE_ID):
+        start = bisect_right(self.ids, message_id, self.head)
+        while start == len(self.ends) and self.spilled:
+            self.load_spilled()
+            start = bisect_right(self.ids, message_id, start)
+        end = bisect_right(self.ids, through, start, min(start + count, len(self.ends)))
+        if end == start:
+            return 0, message_id, b""
+        # messages imported from old logs share an id, so they can't be split across batches
+        while end < len(self.ends) and self.ids[end] == self.ids[end - 1]:
+            end += 1
+        return end - start, self.ids[end - 1], bytes(self.encoded[self.start_of(start):self.ends[end - 1]])
+
+    # whether there may be messages with ids after message_id and no later than through; it's only a
+    # guess when every message in memory is up to message_id and the next ones are still spilled
+    def has_between(self, message_id, through):
+        start = bisect_right(self.ids, message_id, self.head)
+        return self.ids[start] <= through if start < len(self.ends) else self.spilled > 0
+
+    # remove every message with an id up to and including message_id, returning how many there were
+    def drop_through(self, message_id):
+        dropped = 0
+        while True:
+            if not self.in_memory():
+                if not self.spilled:
+                    return dropped
+                self.load_spilled()
+            end = bisect_right(self.ids, message_id, self.head)
+            dropped += end - self.head
+            self.head = end
+            self.compact()
+            if self.in_memory():
+                return dropped
+
+    # drop the messages that have been taken from the front of the buffer once they make up at least
+    # half of the mailbox, so that taking messages a batch at a time doesn't shift everything every time
+    def compact(self):
+        if self.head == len(self.ends):
+            self.reset()
+        elif self.head * 2 >= len(self.ends):
+            offset = self.ends[self.head - 1]
+            del self.encoded[:offset]
+            self.ends = array("q", [end - offset for end in self.ends[self.head:]])
+            del self.ids[:self.head]
+            self.head = 0
+
+    def reset(self):
+        del self.ends[:]
+        del self.ids[:]
+        del self.encoded[:]
+        self.head = 0
+
+    # move the next limit messages from the spill file back into memory
+    def load_spilled(self):
+        count = min(self.limit, self.spilled)
+        self.spill_files.flush(self.path)
+        with open(self.path, "rb") as f:
+            f.seek(self.spill_pos)
+            for _ in range(count):
+                message_id, encoded = self.read_spilled(f)
+                self.encoded += encoded
+                self.ends.append(len(self.encoded))
+                self.ids.append(message_id)
+            self.spill_pos = f.tell()
+        self.spilled -= count
+        if not self.spilled:
+            self.remove_spill_file()
+
+    def remove_spill_file(self):
+        self.spill_files.close(self.path)
+        os.remove(self.path)
+        self.spilled = 0
+        self.spill_pos = 0
+
+    def clear(self):
+        self.reset()
+        if self.spilled:
+            self.remove_spill_file()
+
+
+# every user's mailbox, created the first time it's looked up, with spill files kept in directory;
+# mailboxes are keyed by the copy of the user's name kept in user_names
+class Mailboxes(dict):
+    def __init__(self, directory, user_names, limit=MAILBOX_MEMORY_LIMIT):
+        super().__init__()
+        self.directory = directory
+        self.user_names = user_names
+        self.limit = limit
+        self.spill_files = SpillFiles()
+        # spill files only extend memory, and everything in them is rebuilt from the write-ahead log on
+        # startup, so any left behind by an earlier run are stale
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    def __missing__(self, user):
+        mailbox = self[self.user_names.canonical(user)] = self.new_mailbox(user)
+        return mailbox
+
+    def new_mailbox(self, user, entries=()):
+        name = hashlib.sha1(user.encode("utf-8")).hexdigest() + SPILL_SUFFIX
+        return Mailbox(os.path.join(self.directory, name), self.limit, entries, self.spill_files)
+
+    # number of messages across every mailbox that are currently spilled to disk
+    def spilled(self):
+        return sum(mailbox.spilled for mailbox in list(self.values()))
+
+    # drop a user's mailbox along with its spill file
+    def discard(self, user):
+        mailbox = super().pop(user, None)
+        if mailbox is not None:
+            mailbox.clear()
+
+    # replace every mailbox with the given (user, [(id, message), ...]) pairs
+    def replace(self, items):
+        self.clear()
+        for user, entries in items:
+            self[self.user_names.canonical(user)] = self.new_mailbox(user, entries)
+
+    def clear(self):
+        for mailbox in self.values():
+            mailbox.clear()
+        super().clear()
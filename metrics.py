@@ -0,0 +1,182 @@
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import time
+from bisect import bisect_left
+from threading import Lock
+
+# upper bounds in seconds of the latency histogram buckets, from 10 microseconds up to about 10 seconds
+LATENCY_BUCKETS = tuple(1e-5 * 2 ** i for i in range(21))
+# how many records a log message may emit per second once its burst allowance is used up
+LOG_RATE_LIMIT = 10
+LOG_RATE_BURST = 50
+
+
+# counts of observed values in fixed buckets, from which percentiles are estimated without keeping the values
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket holds values above every bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # the upper bound of the bucket holding the pth percentile, or the largest value seen if that's smaller
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+# a lock that records how long callers wait for it when it's contended; uncontended acquisitions skip
+# the timing, so the histogram's count is the number of times anyone had to wait
+class TimedLock:
+    def __init__(self, waits):
+        self.lock = Lock()
+        self.waits = waits
+
+    def __enter__(self):
+        if not self.lock.acquire(False):
+            start = time.perf_counter()
+            self.lock.acquire()
+            self.waits.observe(time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+# the server's counters, histograms and gauges. Counters and histograms are updated in place on the hot
+# path; gauges are functions that are only called when a snapshot is taken, so values like queue depths
+# cost nothing until someone looks at them
+class MetricsRegistry:
+    def __init__(self):
+        self.counters = {}
+        self.peaks = {}  # the largest value each of these has reached
+        self.histograms = {}
+        self.gauges = {}
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_peak(self, name, value):
+        if value > self.peaks.get(name, 0):
+            self.peaks[name] = value
+
+    # the histogram with the given name, created the first time it's asked for
+    def histogram(self, name, bounds=LATENCY_BUCKETS):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds)
+        return self.histograms[name]
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    # the current value of every metric, as plain values that can be encoded on the wire or as JSON
+    def snapshot(self):
+        return {
+            "counters": dict(self.counters),
+            "peaks": dict(self.peaks),
+            "gauges": {name: read() for name, read in self.gauges.items()},
+            "histograms": {name: histogram.summary() for name, histogram in list(self.histograms.items())
+                           if histogram.count},
+        }
+
+
+# profiles one in every `every` calls it runs with cProfile, so hot spots show up in production
+# without paying for profiling on every call
+class SamplingProfiler:
+    def __init__(self, every):
+        self.every = every
+        self.calls = 0
+        self.sampled = 0
+        self.profile = cProfile.Profile()
+        # only one thread can be profiled at a time, so calls that come in while another is being
+        # profiled just run unprofiled
+        self.active = Lock()
+
+    def run(self, fn, *args):
+        self.calls += 1
+        if self.calls % self.every or not self.active.acquire(False):
+            return fn(*args)
+        try:
+            self.sampled += 1
+            self.profile.enable()
+            try:
+                return fn(*args)
+            finally:
+                self.profile.disable()
+        finally:
+            self.active.release()
+
+    # the functions the sampled calls spent the most time in, as printed by pstats
+    def report(self, limit=20):
+        out = io.StringIO()
+        with self.active:
+            if self.sampled:
+                pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def dump(self, path):
+        with self.active:
+            self.profile.dump_stats(path)
+
+
+# lets each distinct log message through at up to LOG_RATE_LIMIT records per second after an initial
+# burst, and notes how many were dropped on the next record that gets through; messages are told apart
+# by their unformatted text, so log calls should pass their arguments separately rather than pre-format them
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=LOG_RATE_LIMIT, burst=LOG_RATE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # message -> [tokens, last refill time, records dropped]
+
+    def filter(self, record):
+        now = time.monotonic()
+        bucket = self.buckets.setdefault(record.msg, [self.burst, now, 0])
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = f"{record.msg} ({bucket[2]} similar messages suppressed)"
+            bucket[2] = 0
+        return True
+
+
+# send log records at or above the given level to stderr, rate limited per message
+def configure_logging(level="INFO"):
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
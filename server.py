@@ -1,101 +1,556 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import re
 import socket
 import selectors
-import sys
-import types
-import re
-from threading import Lock, Thread
-from collections import defaultdict
+from itertools import islice, takewhile
+from collections import deque
 from common import *
+from history import HistoryStore, direct_conversation, get_group_history, get_group_history_since, get_history, \
+    get_history_since, group_conversation
+from accounts import AccountIndex, UserNames, compile_wildcard
+from mailboxes import Mailboxes
+from metrics import MetricsRegistry, SamplingProfiler, TimedLock, configure_logging
+from sharding import load_cluster, server_kwargs
+from wal import WriteAheadLog
 import os
 import time
 
+# number of locks that the users' mailboxes are striped across
+CHAT_LOCK_STRIPES = 64
+# number of logged events after which the write-ahead log is compacted into a snapshot
+SNAPSHOT_INTERVAL = 100000
+# number of recently replicated method calls kept to catch up servers that fall behind; servers
+# that are further behind than this get a full state transfer instead
+REPLICATION_LOG_SIZE = 50000
+# number of users or mailboxes sent in each frame of a state transfer
+SYNC_CHUNK_SIZE = 1000
+# seconds between attempts to reconnect to servers that are down, and how long each attempt may take
+PEER_RECONNECT_INTERVAL = 1.0
+PEER_CONNECT_TIMEOUT = 0.5
+# seconds a read-only call that needs a later seq than this server has applied waits for it to arrive
+# before the client is told to ask the leader instead
+READ_WAIT_TIMEOUT = 0.05
+# once this many bytes are waiting to be sent on a connection, stop reading requests from it and stop
+# delivering chat messages to it until it drains to the low water mark
+OUTPUT_HIGH_WATER = 1024 * 1024
+OUTPUT_LOW_WATER = 256 * 1024
+# most messages delivered in one chat stream frame
+STREAM_BATCH_SIZE = 1000
+# most messages an acknowledged stream may have sent that the client hasn't acknowledged yet
+STREAM_WINDOW = 4 * STREAM_BATCH_SIZE
+# names of the files in the log directory that the metrics are periodically written to, and that the
+# profiler's samples are written to when the server stops
+STATS_FILE = "stats.json"
+PROFILE_FILE = "profile.out"
+# name of the message history database in the log directory
+HISTORY_FILE = "history.db"
+# name of the local socket in the log directory that worker processes connect back to, and how many
+# seconds the server waits for them to start
+WORKER_SOCKET = "workers.sock"
+WORKER_START_TIMEOUT = 30.0
+# what a malformed frame or a call with a bad method code, bad arguments (see check_args) or a bad
+# wildcard raises while it's decoded and dispatched; only the connection that sent it is closed
+REQUEST_ERRORS = (ProtocolError, IndexError, KeyError, TypeError, ValueError, re.error)
+
+log = logging.getLogger("server")
+
+
+# the state kept for each connection, whether it's to a client or to another server; a busy server has
+# one per client session, so it's slotted to leave out the per-object attribute dict
+class Connection:
+    __slots__ = ("addr", "sock", "writer", "inb", "outb", "is_peer", "stream_user", "stream_request_id",
+                 "stream_sent", "events", "reading_paused", "stream_throttled", "sync_requested", "incoming_snapshot",
+                 "deferred_ops", "outgoing_frames", "closed", "replication_queue", "sent_seq", "acked_seq",
+                 "compress", "sessions", "worker", "session_id", "session_paused")
+
+    # sock is the connection's socket in the selector engine and writer its stream writer in the asyncio engine
+    def __init__(self, addr, is_peer=False, sock=None, writer=None):
+        self.addr = addr
+        self.sock = sock
+        self.writer = writer
+        self.inb = bytearray()
+        self.outb = bytearray()
+        self.is_peer = is_peer
+        self.stream_user = None
+        self.stream_request_id = None
+        # the id of the last message sent on an acknowledged stream, or None if the stream removes
+        # messages as it sends them
+        self.stream_sent = None
+        # backpressure: the selector events being watched, whether reads are paused because too much
+        # output is waiting, and whether stream delivery is held off
+        self.events = selectors.EVENT_READ
+        self.reading_paused = False
+        self.stream_throttled = False
+        # catch-up bookkeeping for connections to other servers
+        self.sync_requested = False
+        self.incoming_snapshot = None
+        self.deferred_ops = ()  # replaced with a list once a state transfer starts arriving
+        self.outgoing_frames = None
+        self.closed = False
+        # calls waiting to be sent to this server in the next batch, the last seq sent to it in a batch,
+        # and the last seq it acked; client connections never replicate, so they go without the queue
+        self.replication_queue = [] if is_peer else None
+        self.sent_seq = 0
+        self.acked_seq = 0
+        self.compress = False  # whether frames to this connection are compressed, once the other end asks
+        # a connection to a worker process has a session for each of the worker's clients, by id; a
+        # session has no socket of its own, and its output goes through the worker, which says when
+        # too much of it is waiting to be sent to the client
+        self.sessions = None
+        self.worker = None
+        self.session_id = 0
+        self.session_paused = False
+
 
 class Server():
     # initialize the server with empty users, chats, and online lists
     def __init__(self, id, server_addr_0=SERVER_ADDR_0, server_addr_1=SERVER_ADDR_1, server_addr_2=SERVER_ADDR_2,
                  cfp_0=CLIENT_FACING_PORT_0, cfp_1=CLIENT_FACING_PORT_1, cfp_2=CLIENT_FACING_PORT_2,
-                 sfp_0=SERVER_FACING_PORT_0, sfp_1=SERVER_FACING_PORT_1, sfp_2=SERVER_FACING_PORT_2):
+                 sfp_0=SERVER_FACING_PORT_0, sfp_1=SERVER_FACING_PORT_1, sfp_2=SERVER_FACING_PORT_2, ack_mode='leader',
+                 shard=None, profile_every=0, stats_interval=0, compression=True, workers=0):
+        if ack_mode not in ACK_MODES:
+            raise ValueError(f"Invalid ack mode: {ack_mode}")
         self.id = id
+        self.ack_mode = ack_mode
+        # whether to agree when a client or server asks for compressed frames, and ask other servers for them
+        self.compression = compression
+        # if set, this many worker processes accept the clients instead (see workers.py)
+        self.workers = workers
+        self.worker_connections = []
+        self.worker_processes = []
+        # servers of different shards can share a machine, so each shard gets its own log directories
+        self.shard = shard
+        self.log_dir = ("" if shard is None else f"Shard_{shard}_") + "Server_" + str(self.id) + "_Logs"
         self.addresses = [server_addr_0, server_addr_1, server_addr_2]
 
         self.client_facing_ports = [cfp_0, cfp_1, cfp_2]
         self.server_facing_ports = [sfp_0, sfp_1, sfp_2]
-        self.sel = selectors.DefaultSelector()
-        self.server_facing_sockets = [socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM) for _ in range(2)]
-        self.client_facing_socket = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
 
-        # listen and connect to server facing ports while listening only on client facing ports
+        # counters, latency histograms and gauges, served to anyone who sends a STATS_CODE frame and
+        # written to STATS_FILE every stats_interval seconds if it's set
+        self.metrics = MetricsRegistry()
+        # backpressure counters: client reads paused, streams held off, and messages spilled to disk
+        self.metrics.counters.update(reads_paused=0, streams_throttled=0, messages_spilled=0, frames_compressed=0,
+                                     bytes_saved_by_compression=0)
+        # every method call is timed, and the histogram's count doubles as the method's request counter
+        self.method_latency = [self.metrics.histogram(f"method_latency_seconds.{method}") for method in SERVER_METHODS]
+        # if set, one in every profile_every method calls is run under cProfile
+        self.profiler = SamplingProfiler(profile_every) if profile_every else None
+        self.stats_interval = stats_interval
+        self.next_stats_dump = time.monotonic() + stats_interval
+
+        # writers to self.users and self.online take their lock, but membership checks are single set
+        # operations that are atomic under the GIL and so read without locking; users are also kept
+        # in sorted order so accounts can be listed by prefix and a page at a time. Every stored name
+        # is the single copy kept in self.user_names
+        self.user_names = UserNames()
+        self.users_lock = TimedLock(self.metrics.histogram("lock_wait_seconds.users"))
+        self.users = AccountIndex()
+        self.users_version = 0  # bumped on every change to self.users so snapshots know when they're stale
+        self.users_snapshot = (0, ())  # (version, tuple of users) for read-mostly paths that iterate over users
+        self.online_lock = TimedLock(self.metrics.histogram("lock_wait_seconds.online"))
+        self.online = set()
+        # mailboxes are guarded by a fixed set of striped locks rather than one lock per user; each one
+        # keeps a bounded number of messages in memory and spills the rest to disk
+        chat_lock_waits = self.metrics.histogram("lock_wait_seconds.chats")
+        self.chat_locks = [TimedLock(chat_lock_waits) for _ in range(CHAT_LOCK_STRIPES)]
+        self.chats = Mailboxes(os.path.join(self.log_dir, "spill"), self.user_names)
+        # members of each group by group name
+        self.groups_lock = TimedLock(self.metrics.histogram("lock_wait_seconds.groups"))
+        self.groups = {}
+        # open chat streams by user and the users whose streams have undelivered messages
+        self.streams_lock = TimedLock(self.metrics.histogram("lock_wait_seconds.streams"))
+        self.streams = {}
+        self.pending_streams = set()
+        # users whose acknowledged streams are waiting for more of their messages to be committed; only
+        # used from the server loop
+        self.uncommitted_streams = set()
+        # seq of the last replicated method call applied here and the most recent calls, for catching up other servers
+        self.applied_seq = 0
+        # seq of the last call applied here that came from another server, which means at least two
+        # servers have applied it
+        self.replicated_seq = 0
+        self.replication_log = deque(maxlen=REPLICATION_LOG_SIZE)
+        # (min_seq, deadline, connection, request_id, method_code, args) for reads waiting on later calls
+        self.waiting_reads = []
+        self.peers = []  # connections to the other servers that are up
+        # (seq, log seq, connection, frame) for client replies waiting for the events their call logged
+        # to be fsynced and, in majority mode, for the call to be applied by a majority
+        self.pending_replies = deque()
+        self.running = True
+
+        self.metrics.gauge("users", lambda: len(self.users))
+        self.metrics.gauge("online_users", lambda: len(self.online))
+        self.metrics.gauge("groups", lambda: len(self.groups))
+        self.metrics.gauge("open_streams", lambda: len(self.streams))
+        self.metrics.gauge("pending_streams", lambda: len(self.pending_streams))
+        self.metrics.gauge("pending_replies", lambda: len(self.pending_replies))
+        self.metrics.gauge("waiting_reads", lambda: len(self.waiting_reads))
+        self.metrics.gauge("replication_queue", lambda: sum(len(peer.replication_queue) for peer in self.peers))
+        self.metrics.gauge("applied_seq", lambda: self.applied_seq)
+        # how many of the calls this server forwarded each connected server has yet to ack
+        self.metrics.gauge("replication_lag", lambda: {
+            "%s:%d" % peer.addr: max(0, (peer.replication_queue[-1][0] if peer.replication_queue else peer.sent_seq)
+                                     - peer.acked_seq) for peer in list(self.peers)})
+        self.metrics.gauge("wal_unsynced_events", lambda: self.wal.seq - self.wal.durable_seq)
+        self.metrics.gauge("wal_group_commits", lambda: self.wal.group_commits)
+        self.metrics.gauge("mailbox_messages_on_disk", lambda: self.chats.spilled())
+        self.metrics.gauge("worker_sessions", lambda: sum(len(worker.sessions) for worker in self.worker_connections))
+        self.metrics.gauge("history_unwritten_messages", lambda: self.history.backlog())
+
+        # account and message events are persisted in a write-ahead log; replay it to rebuild the state
+        self.wal = WriteAheadLog(self.log_dir)
+        # every message that's sent is also kept in the history, whether or not it's been delivered
+        self.history = HistoryStore(os.path.join(self.log_dir, HISTORY_FILE))
+        self.wal.recover(self.restore_snapshot, self.apply_logged_event)
+        self.import_legacy_logs()
+
+        self.setup_network()
+        # held replies are sent from the server loop as soon as the events they wait on are on disk
+        self.wal.on_durable = self.wakeup
+
+    # replace the state with a snapshot taken by snapshot_state
+    def restore_snapshot(self, state):
+        self.applied_seq = state["applied_seq"]
+        self.users = AccountIndex(map(self.user_names.canonical, state["users"]))
+        self.users_version += 1
+        self.chats.replace(state["unsent"].items())
+        self.replace_groups(state["groups"].items())
+
+    # the durable state: all users, the members of every group, and the messages waiting for users who are offline
+    def snapshot_state(self):
+        unsent = {}
+        for user, messages in list(self.chats.items()):
+            if messages and user not in self.online:
+                with self.chat_lock(user):
+                    unsent[user] = list(messages.entries())
+        return {"applied_seq": self.applied_seq, "users": list(self.users_view()), "unsent": unsent,
+                "groups": self.groups_view()}
+
+    # log an event along with the seq of the replicated method call that caused it
+    def log_event(self, kind, user, *args):
+        return self.wal.append((self.applied_seq, kind, user, *args))
+
+    # apply an event from the write-ahead log during recovery
+    def apply_logged_event(self, event):
+        seq, kind, user, *args = event
+        self.applied_seq = max(self.applied_seq, seq)
+        if kind == "applied":
+            # only records the seq of a method call that didn't change any persisted state
+            pass
+        elif kind == "create":
+            self.users.add(self.user_names.canonical(user))
+            self.users_version += 1
+        elif kind == "delete":
+            self.users.discard(user)
+            self.users_version += 1
+            self.chats.discard(user)
+            self.leave_all_groups(user)
+            self.user_names.release(user)
+        elif kind == "message":
+            self.chats[user].append(args[0], seq)
+        elif kind == "group_message":
+            # a message to a group is logged once, along with the members who were offline
+            message, recipients = args
+            encoded = encode_value(message)
+            for recipient in recipients:
+                self.chats[recipient].append_encoded(encoded, seq)
+        elif kind == "group_create":
+            self.groups[user] = set()
+        elif kind == "group_delete":
+            self.groups.pop(user, None)
+        elif kind == "group_join":
+            self.groups[user].add(self.user_names.canonical(args[0]))
+        elif kind == "group_leave":
+            self.groups[user].discard(args[0])
+        elif kind == "login":
+            # messages loaded at login were only kept in memory from then on
+            self.chats.discard(user)
+        elif kind == "ack":
+            if user in self.chats:
+                self.chats[user].drop_through(args[0])
+        elif kind == "history":
+            # the message may or may not have been written to the history before the server stopped
+            sender, message, sent_at = args
+            self.history.append(user, seq, sent_at, sender, message)
+        else:
+            raise ValueError(f"Unknown log event: {kind}")
+
+    # compact the write-ahead log once enough events have been logged; only called from the server loop
+    # so that no events are logged while the snapshot is taken
+    def maybe_snapshot(self):
+        if self.wal.records_since_snapshot >= SNAPSHOT_INTERVAL:
+            # the history events are about to be compacted away, so everything they hold must be stored
+            self.history.checkpoint()
+            self.wal.snapshot(self.snapshot_state())
+
+    # move users.txt and unsent_messages/ logs written by older versions of the server into the write-ahead log
+    def import_legacy_logs(self):
+        users_log = self.log_dir + "/users.txt"
+        unsent_messages_log_dir = self.log_dir + "/unsent_messages"
+        if os.path.exists(users_log):
+            with open(users_log, "r") as file:
+                for line in file:
+                    self.CreateAccount(line.rstrip("\n"))
+            os.remove(users_log)
+        if os.path.isdir(unsent_messages_log_dir):
+            for filename in os.listdir(unsent_messages_log_dir):
+                with open(unsent_messages_log_dir + "/" + filename, "r") as f:
+                    for line in f:
+                        message = eval(line.rstrip("\n"))
+                        self.SendMessage(message.sender, filename[:-len(".txt")], message.message)
+                os.remove(unsent_messages_log_dir + "/" + filename)
+            os.rmdir(unsent_messages_log_dir)
+
+    # the server facing ports this server listens on and the (address, port) pairs of the servers it
+    # connects to; each server listens for the servers after it and connects to the servers before it
+    def peer_links(self):
         if self.id == 0:
-            self.listen_wrapper([*self.server_facing_sockets, self.client_facing_socket],
-                                [*self.server_facing_ports[:2], self.client_facing_ports[self.id]])
+            return self.server_facing_ports[:2], []
         elif self.id == 1:
-            self.listen_wrapper([self.server_facing_sockets[0], self.client_facing_socket],
-                                [self.server_facing_ports[2], self.client_facing_ports[self.id]])
-            self.connect_wrapper(
-                self.server_facing_sockets[1:2], self.addresses[0:1], self.server_facing_ports[0:1])
+            return self.server_facing_ports[2:], [(self.addresses[0], self.server_facing_ports[0])]
         elif self.id == 2:
-            self.listen_wrapper([self.client_facing_socket], [
-                                self.client_facing_ports[self.id]])
-            self.connect_wrapper(self.server_facing_sockets,
-                                 self.addresses[:2], self.server_facing_ports[1:])
+            return [], [(self.addresses[0], self.server_facing_ports[1]), (self.addresses[1], self.server_facing_ports[2])]
         else:
             raise ValueError(f"Invalid Id: {self.id}")
 
-        self.users_lock = Lock()  # lock for both self.users and self.online
-        self.users = set()
-        self.online = set()
-        self.chat_locks = defaultdict(Lock) # locks for each k, v pair in self.chats
-        self.chats = defaultdict(list)
-
-        self.log_dir = "Server_" + str(self.id) + "_Logs"
-        self.users_log = self.log_dir + "/users.txt"
-        self.unsent_messages_log_dir = self.log_dir + "/unsent_messages"
+    # create the selector and sockets, listening on client facing ports and listening or connecting on server facing ports
+    def setup_network(self):
+        listen_ports, self.peer_targets = self.peer_links()
+        self.sel = selectors.DefaultSelector()
+        # a socket pair that lets other threads wake up the selector loop when there is output to flush
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.sel.register(self.wakeup_recv, selectors.EVENT_READ, data=None)
+        self.server_facing_sockets = [socket.socket(
+            socket.AF_INET, socket.SOCK_STREAM) for _ in listen_ports]
+        if self.workers:
+            self.client_facing_socket = None
+            self.listen_wrapper(self.server_facing_sockets, listen_ports)
+            self.start_workers()
+        else:
+            self.client_facing_socket = socket.socket(
+                socket.AF_INET, socket.SOCK_STREAM)
+            self.listen_wrapper([*self.server_facing_sockets, self.client_facing_socket],
+                                [*listen_ports, self.client_facing_ports[self.id]])
+        self.connect_peers()
 
+    # start the worker processes that accept clients on the client-facing port in this server's place,
+    # and wait for each of them to connect back over a local socket in the log directory
+    def start_workers(self):
+        from workers import run_worker
+        path = os.path.join(self.log_dir, WORKER_SOCKET)
+        if os.path.exists(path):
+            os.remove(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen()
+        listener.settimeout(WORKER_START_TIMEOUT)
+        # the server already has threads running, so the workers start from a fresh interpreter
+        context = multiprocessing.get_context("spawn")
+        for _ in range(self.workers):
+            process = context.Process(target=run_worker, args=(self.addresses[self.id], self.client_facing_ports[self.id],
+                                                               path, os.path.join(self.log_dir, HISTORY_FILE),
+                                                               self.compression, logging.getLogger().level))
+            process.daemon = True
+            process.start()
+            self.worker_processes.append(process)
+        for i in range(self.workers):
+            sock, _ = listener.accept()
+            sock.setblocking(False)
+            data = Connection(("worker", i), sock=sock)
+            data.sessions = {}
+            self.sel.register(sock, data.events, data=data)
+            self.worker_connections.append(data)
+        listener.close()
+        os.remove(path)
+        log.info("Started %d workers listening on %s", self.workers, (self.addresses[self.id], self.client_facing_ports[self.id]))
 
-        # check for existing log files
-        if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir)
-            os.makedirs(self.unsent_messages_log_dir)
-        else:
-            # check for existing users and load them
-            if os.path.exists(self.users_log):
-                # first get all the users
-                with open(self.users_log, "r") as file:
-                    self.users = set(line.rstrip("\n") for line in file)
+    # connect to every server we're supposed to connect to that we don't have a connection with
+    def connect_peers(self, quiet=False):
+        connected = {peer.addr for peer in self.peers}
+        missing = [target for target in self.peer_targets if target not in connected]
+        self.connect_wrapper([socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in missing],
+                             [addr for addr, _ in missing], [port for _, port in missing], quiet)
+        self.next_reconnect = time.monotonic() + PEER_RECONNECT_INTERVAL
 
     # a wrapper function for connecting sockets w/ selector
-    def connect_wrapper(self, sockets, addrs, ports):
+    def connect_wrapper(self, sockets, addrs, ports, quiet=False):
         for socket, addr, port in zip(sockets, addrs, ports):
             try:
+                socket.settimeout(PEER_CONNECT_TIMEOUT)
                 socket.connect((addr, port))
-                data = types.SimpleNamespace(addr=(addr, port), inb=b"", outb=b"")
-                events = selectors.EVENT_READ | selectors.EVENT_WRITE
-                self.sel.register(socket, events, data=data)
-            except ConnectionRefusedError:
-                print(f"Connection refused on address {addr} and port {port}")
+            except OSError:
+                if not quiet:
+                    log.warning("Connection refused on address %s and port %s", addr, port)
+                socket.close()
+                continue
+            log.info("Connected to server at %s", (addr, port))
+            socket.setblocking(False)
+            data = Connection((addr, port), is_peer=True, sock=socket)
+            self.sel.register(socket, data.events, data=data)
+            self.add_peer(data)
 
     # a wrapper function for binding and listening to sockets w/ selector
     def listen_wrapper(self, sockets, ports):
         for sock, port in zip(sockets, ports):
+            # allow a revived server to rebind its ports right away
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.bind((self.addresses[self.id], port))
             sock.listen()
-            print(f"Listening on {(self.addresses[self.id], port)}")
+            log.info("Listening on %s", (self.addresses[self.id], port))
             sock.setblocking(False)
             self.sel.register(sock, selectors.EVENT_READ, data=None)
 
     # a wrapper function for accepting sockets w/ selector
     def accept_wrapper(self, sock):
         conn, (addr, port) = sock.accept()
-        if sock != self.client_facing_socket:
-            repl = self.server_facing_sockets.index(sock)
-            self.server_facing_sockets[repl] = conn
-        print(f"Accepted connection from {addr, port}")
+        log.info("Accepted connection from %s", (addr, port))
         conn.setblocking(False)
-        data = types.SimpleNamespace(addr=(addr, port), inb=b"", outb=b"")
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        self.sel.register(conn, events, data=data)
+        # replies, stream deliveries and heartbeats share a connection, so don't hold small frames back
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        data = Connection((addr, port), is_peer=sock is not self.client_facing_socket, sock=conn)
+        # only ask for write events once there is something to write so the selector doesn't spin
+        self.sel.register(conn, data.events, data=data)
+        if data.is_peer:
+            self.add_peer(data)
+
+    # drain the wakeup socket; the wakeup itself is all that matters since pending streams are flushed every loop
+    def handle_wakeup(self):
+        try:
+            while self.wakeup_recv.recv(RECV_BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+    # queue an encoded frame on a connection and start watching it for write events; a query frame is
+    # a read for the worker of the client it's going to to answer instead (see answer_read)
+    def queue_output(self, data, frame, query=False):
+        if data.worker is not None:
+            # the frame is for a worker's client; the worker compresses it if the client asked
+            data.worker.outb += SESSION_HEADER.pack(data.session_id | QUERY_FLAG if query else data.session_id)
+            data = data.worker
+        else:
+            frame = self.pack(data, frame)
+        data.outb += frame
+        self.metrics.record_peak("output_buffer_bytes", len(data.outb))
+        self.update_events(data)
+
+    # compress a frame on its way to a connection that asked for compressed frames, if it's big enough
+    def pack(self, data, frame):
+        if not data.compress or len(frame) < COMPRESSION_THRESHOLD:
+            return frame
+        packed = compress_frames(frame)
+        if packed is not frame:
+            self.metrics.increment("frames_compressed")
+            self.metrics.increment("bytes_saved_by_compression", len(frame) - len(packed))
+        return packed
+
+    # watch a connection for reads unless they're paused, and for writes while it has output waiting
+    def update_events(self, data):
+        events = (0 if data.reading_paused else selectors.EVENT_READ) | (selectors.EVENT_WRITE if data.outb else 0)
+        if events != data.events:
+            self.sel.modify(data.sock, events, data=data)
+            data.events = events
+
+    # the number of bytes queued on a connection that haven't been sent yet
+    def output_backlog(self, data):
+        if data.worker is not None:
+            return OUTPUT_HIGH_WATER if data.session_paused else 0
+        return len(data.outb)
+
+    # hold off on delivering a user's messages until their connection drains below OUTPUT_LOW_WATER
+    def throttle_stream(self, data):
+        data.stream_throttled = True
+        self.metrics.increment("streams_throttled")
+
+    # stream a sequence of frames to a connection, encoding each one only once the previous ones have been sent
+    def send_frames(self, data, frames):
+        data.outgoing_frames = frames
+        self.pump_frames(data)
+
+    # queue the next of a connection's outgoing frames
+    def pump_frames(self, data):
+        frame = next(data.outgoing_frames, None)
+        if frame is None:
+            data.outgoing_frames = None
+        else:
+            self.queue_output(data, frame)
+
+    # mark a user's stream as having undelivered messages and wake the selector loop if it might be asleep
+    def notify_stream(self, user):
+        with self.streams_lock:
+            if user not in self.streams or user in self.pending_streams:
+                return
+            self.pending_streams.add(user)
+            needs_wakeup = len(self.pending_streams) == 1
+        if needs_wakeup:
+            self.wakeup()
+
+    # notify_stream for many users at once, taking the streams lock once for all of them
+    def notify_streams(self, users):
+        with self.streams_lock:
+            needs_wakeup = not self.pending_streams
+            self.pending_streams.update(user for user in users if user in self.streams)
+            needs_wakeup = needs_wakeup and bool(self.pending_streams)
+        if needs_wakeup:
+            self.wakeup()
+
+    # wake up the selector loop from any thread so that it flushes pending streams
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b"\0")
+        except BlockingIOError:
+            # the wakeup socket is already full, so the loop is bound to wake up anyway
+            pass
+
+    # send each pending user's backlog in batches on their stream, holding off slow and unacknowledged streams
+    def flush_streams(self):
+        with self.streams_lock:
+            pending = [(user, self.streams[user]) for user in self.pending_streams if user in self.streams]
+            self.pending_streams.clear()
+        for user, data_stream in pending:
+            if data_stream.stream_throttled:
+                # it's notified again once its connection drains
+                continue
+            if self.output_backlog(data_stream) >= OUTPUT_HIGH_WATER:
+                self.throttle_stream(data_stream)
+                continue
+            with self.chat_lock(user):
+                mailbox = self.chats[user]
+                if data_stream.stream_sent is None:
+                    count, encoded = mailbox.take_encoded(STREAM_BATCH_SIZE)
+                    more = len(mailbox) > 0
+                    last_id = None
+                else:
+                    unacknowledged = mailbox.count_through(data_stream.stream_sent)
+                    if unacknowledged >= STREAM_WINDOW:
+                        self.metrics.increment("stream_windows_full")
+                        continue
+                    # a message's id is the seq of the call that sent it, and a client skips ids it has
+                    # already seen, so a message isn't sent until enough servers have it that the next
+                    # leader can't give its id to a different message
+                    committed = self.committed_seq()
+                    count, last_id, encoded = mailbox.peek_encoded(
+                        data_stream.stream_sent, min(STREAM_BATCH_SIZE, STREAM_WINDOW - unacknowledged), committed)
+                    data_stream.stream_sent = last_id
+                    more = mailbox.has_between(last_id, committed)
+                    if not more and len(mailbox) > unacknowledged + count:
+                        self.uncommitted_streams.add(user)
+            if count:
+                self.queue_output(data_stream, encode_stream_frame(data_stream.stream_request_id, count, encoded, last_id))
+            if more:
+                self.notify_stream(user)
+
+    # stop delivering messages to a user, e.g. because they logged out or their stream closed
+    def close_stream(self, user):
+        with self.streams_lock:
+            self.streams.pop(user, None)
+            self.pending_streams.discard(user)
 
     # service a socket that is connected: handle inbound and outbound data
     # while running any necessary chat server methods
@@ -105,62 +560,421 @@ class Server():
         if mask & selectors.EVENT_READ:
             # retry on initial error since connection may be finnicky
             try:
-                recv_data = sock.recv(1024)
+                recv_data = sock.recv(RECV_BUFFER_SIZE)
             except ConnectionResetError:
-                recv_data = sock.recv(1024)
+                recv_data = sock.recv(RECV_BUFFER_SIZE)
             if recv_data:
-                is_client, method_code, args = eval(recv_data.decode("utf-8"))
-                # if we're receiving a method call from the client, we need to respond
-                # otherwise we mirror the method call but don't respond
-                if is_client:
-                    if method_code == STREAM_CODE:
-                        # start up the thread and pass the data object, so the thread can write to it
-                        t = Thread(target=self.ChatStream, args=(*args, data))
-                        t.daemon = True
-                        t.start()
-                    elif method_code == HEARTBEAT_CODE:
-                        data.outb += b'1'
+                data.inb += recv_data
+                try:
+                    if data.sessions is not None:
+                        self.handle_worker_frames(data)
                     else:
-                        output = self.run_server_method(method_code, args)
-                        data.outb += str(output).encode("utf-8")
-                        # forward method calls to other servers since you're the leader
-                        # if you're getting calls from the client
-                        invalid = []
-                        for server_sock in self.server_facing_sockets:
-                            try:
-                                server_sock.sendall(
-                                    str((False, method_code, args)).encode("utf-8"))
-                            except OSError:
-                                invalid.append(server_sock)
-                        # remove invalid sockets for other servers that have crashed
-                        for server_sock in invalid:
-                            self.server_facing_sockets.remove(server_sock)
-                # process a forwarded method call without responding
-                else:
-                    self.run_server_method(method_code, args)
+                        # a single read can hold several frames or only part of one, so decode incrementally
+                        for request in pop_frames(data.inb):
+                            self.handle_request(data, *request)
+                except REQUEST_ERRORS as e:
+                    log.warning("Closing connection to %s: %s", data.addr, e)
+                    self.metrics.increment("bad_requests")
+                    self.close_connection(data)
+                    return
+                if not data.is_peer and data.sessions is None and len(data.outb) >= OUTPUT_HIGH_WATER:
+                    # stop taking requests from a client that isn't reading its replies until it catches up
+                    data.reading_paused = True
+                    self.metrics.increment("reads_paused")
+                    self.update_events(data)
             else:
-                print(f"Closing connection to {data.addr}")
-                self.sel.unregister(sock)
-                sock.close()
+                log.info("Closing connection to %s", data.addr)
+                self.close_connection(data)
+                return
         if mask & selectors.EVENT_WRITE and data.outb:
-            # handle outbound data
-            sock.sendall(data.outb)
-            data.outb = b''
+            # handle outbound data; deleting from the front of a bytearray doesn't copy the rest
+            sent = sock.send(data.outb)
+            del data.outb[:sent]
+            if len(data.outb) <= OUTPUT_LOW_WATER:
+                data.reading_paused = False
+                if data.stream_throttled:
+                    data.stream_throttled = False
+                    self.notify_stream(data.stream_user)
+            if not data.outb and data.outgoing_frames is not None:
+                self.pump_frames(data)
+            # stop watching for write events once everything has been sent
+            self.update_events(data)
+
+    # close a connection and clean up after it
+    def close_connection(self, data):
+        self.connection_closed(data)
+        self.sel.unregister(data.sock)
+        data.sock.close()
+
+    # clean up after a connection to a client or server closes
+    def connection_closed(self, data):
+        if data.stream_user is not None and self.streams.get(data.stream_user) is data:
+            self.close_stream(data.stream_user)
+        if data in self.peers:
+            self.peers.remove(data)
+        if data.sessions is not None:
+            log.warning("Worker %d exited, dropping its %d clients", data.addr[1], len(data.sessions))
+            self.worker_connections.remove(data)
+            for session in data.sessions.values():
+                self.connection_closed(session)
+            data.sessions.clear()
+        data.closed = True
+
+    # handle the frames a worker process passed on from its clients, and what it has to say about them
+    def handle_worker_frames(self, worker):
+        for session_id, frame in pop_session_frames(worker.inb):
+            if session_id == CONTROL_SESSION:
+                self.handle_worker_control(worker, *decode_body(memoryview(frame)[FRAME_HEADER.size:]))
+                continue
+            session = worker.sessions.get(session_id)
+            if session is None:
+                continue
+            try:
+                self.handle_request(session, *decode_body(memoryview(frame)[FRAME_HEADER.size:]))
+            except REQUEST_ERRORS as e:
+                # a bad frame from one of the worker's clients only closes that client's session
+                log.warning("Closing connection to %s: %s", session.addr, e)
+                self.metrics.increment("bad_requests")
+                self.close_session(worker, session)
+
+    # close a worker's client and clean up after it
+    def close_session(self, worker, session):
+        del worker.sessions[session.session_id]
+        self.connection_closed(session)
+        self.queue_output(worker, SESSION_HEADER.pack(CONTROL_SESSION) + encode_frame(("close", session.session_id)))
+
+    def handle_worker_control(self, worker, kind, session_id, *args):
+        if kind == "open":
+            session = worker.sessions[session_id] = Connection(args[0])
+            session.worker = worker
+            session.session_id = session_id
+            return
+        session = worker.sessions.get(session_id)
+        if session is None:
+            return
+        if kind == "close":
+            del worker.sessions[session_id]
+            self.connection_closed(session)
+        elif kind == "paused":
+            # too much is waiting to be sent to the client
+            session.session_paused = True
+            self.metrics.increment("reads_paused")
+        elif kind == "drained":
+            session.session_paused = False
+            if session.stream_throttled:
+                session.stream_throttled = False
+                self.notify_stream(session.stream_user)
+
+    # handle a single decoded request frame that arrived on the connection described by data; client
+    # calls carry a request id that is echoed in the reply so a client can have many calls in flight
+    def handle_request(self, data, is_client, method_code, args, request_id=None, min_seq=0):
+        # if we're receiving a method call from the client, we need to respond
+        # otherwise it's a frame from another server, which never gets a response
+        if is_client:
+            if method_code == STREAM_CODE:
+                # register the connection so messages get pushed to it from the selector loop
+                check_args('ChatStream', args)
+                data.stream_request_id = request_id
+                self.ChatStream(data, *args)
+            elif method_code == HEARTBEAT_CODE:
+                self.queue_output(data, encode_frame((request_id, True, self.applied_seq)))
+            elif method_code == STATS_CODE:
+                self.queue_output(data, encode_frame((request_id, self.stats(), self.applied_seq)))
+            elif method_code == COMPRESS_CODE:
+                data.compress = self.compression
+                self.queue_output(data, encode_frame((request_id, self.compression, self.applied_seq)))
+            elif not 0 <= method_code < len(SERVER_METHODS):
+                raise ProtocolError(f"Unknown method code {method_code}")
+            elif SERVER_METHODS[method_code] in READ_ONLY_METHODS:
+                check_args(SERVER_METHODS[method_code], args)
+                if self.applied_seq < min_seq:
+                    # the calls it needs are most likely on their way from the leader
+                    self.hold_read((min_seq, time.monotonic() + READ_WAIT_TIMEOUT, data, request_id, method_code, args))
+                    return
+                self.answer_read(data, request_id, method_code, args)
+            else:
+                # the call is checked before it runs since a state-changing method that fails partway
+                # through would leave this server out of step with the others
+                check_args(SERVER_METHODS[method_code], args)
+                # we're the leader if we're getting calls from the client, so we pick the next seq
+                seq = self.applied_seq + 1
+                if SERVER_METHODS[method_code] in TIMESTAMPED_METHODS:
+                    # check_args only let the client's own args through, so the time always lands in sent_at
+                    args = (*args, time.time())
+                output = self.apply_replicated(seq, method_code, args)
+                self.reply(data, request_id, seq, output)
+                # forward method calls to other servers since you're the leader
+                self.forward(seq, method_code, args)
+        elif method_code == REPLICATE_CODE:
+            for op in args:
+                self.receive_replicated(data, *op)
+            self.acknowledge(data)
+        elif method_code == ACK_CODE:
+            data.acked_seq = max(data.acked_seq, *args)
+            self.release_replies()
+            if self.uncommitted_streams:
+                self.notify_streams(self.uncommitted_streams)
+                self.uncommitted_streams.clear()
+        elif method_code == SYNC_REQUEST_CODE:
+            self.send_catch_up(data, *args)
+        elif method_code == SYNC_DELTA_CODE:
+            data.sync_requested = False
+            for op in args:
+                self.receive_replicated(data, *op)
+            self.acknowledge(data)
+        elif method_code == SYNC_SNAPSHOT_CODE:
+            self.receive_snapshot_chunk(data, *args)
+        elif method_code == COMPRESS_CODE:
+            data.compress = self.compression
+
+    # answer a read-only call. History reads from a worker's client are answered by the worker itself
+    # from its own connection to the history database, which takes the SQLite query and the encoding of
+    # the rows off the server loop; the server only makes sure that everything the reply has to reflect
+    # has been inserted, and sends the call back to the worker in the reply's place
+    def answer_read(self, data, request_id, method_code, args):
+        if data.worker is not None and SERVER_METHODS[method_code] in WORKER_READ_METHODS:
+            self.history.flush()
+            self.metrics.increment("worker_reads")
+            self.reply(data, request_id, self.applied_seq, (SERVER_METHODS[method_code], args), query=True)
+        else:
+            self.reply(data, request_id, self.applied_seq, self.run_server_method(method_code, args))
+
+    # reply to a client once every event logged so far, including the ones for the state the reply
+    # reflects, has been fsynced, and once that state (everything up to seq) has been applied by enough
+    # servers for the ack mode; replies are always released in order. A query reply is a read for the
+    # client's worker to answer in the server's place (see answer_read)
+    def reply(self, data, request_id, seq, output, query=False):
+        frame = encode_frame((request_id, output, seq))
+        log_seq = self.wal.seq
+        if (self.pending_replies or log_seq > self.wal.durable_seq
+                or self.ack_mode == 'majority' and seq > self.committed_seq()):
+            self.pending_replies.append((seq, log_seq, data, frame, query))
+        else:
+            self.queue_output(data, frame, query)
+
+    # the highest seq that a majority of all the servers, including this one, have applied. A backup
+    # isn't acked by anyone, but the calls it got from another server are on both of them, which is
+    # a majority of three, so it can answer reads about them right away
+    def committed_seq(self):
+        acked = sorted([self.applied_seq, *(peer.acked_seq for peer in self.peers)], reverse=True)
+        majority = len(self.addresses) // 2 + 1
+        return max(acked[majority - 1] if len(acked) >= majority else 0, self.replicated_seq)
+
+    # send every held reply whose events are now on disk and whose call has been applied by a majority
+    def release_replies(self):
+        committed = self.committed_seq() if self.ack_mode == 'majority' else self.applied_seq
+        durable = self.wal.durable_seq
+        while self.pending_replies:
+            seq, log_seq, data, frame, query = self.pending_replies[0]
+            if seq > committed or log_seq > durable:
+                break
+            self.pending_replies.popleft()
+            if not data.closed:
+                self.queue_output(data, frame, query)
+
+    # wait to answer a read until the server has applied the calls it needs
+    def hold_read(self, read):
+        self.waiting_reads.append(read)
 
-    # run a method on the server given a code for the method and a tuple of the args to pass in
+    # answer the waiting reads whose calls have now been applied, and tell the clients of the ones that
+    # have waited READ_WAIT_TIMEOUT seconds to ask the leader instead
+    def release_reads(self):
+        now = time.monotonic()
+        waiting = []
+        for read in self.waiting_reads:
+            min_seq, deadline, data, request_id, method_code, args = read
+            if data.closed:
+                continue
+            if self.applied_seq >= min_seq:
+                self.answer_read(data, request_id, method_code, args)
+            elif now >= deadline:
+                self.metrics.increment("reads_behind")
+                self.queue_output(data, encode_frame((request_id, None, self.applied_seq, True)))
+            else:
+                waiting.append(read)
+        self.waiting_reads = waiting
+
+    # tell the server that sent us calls how far we've gotten
+    def acknowledge(self, data):
+        self.queue_output(data, encode_frame((False, ACK_CODE, (self.applied_seq,))))
+
+    # start replicating with a newly connected server; both sides ask to be caught up, and whichever
+    # one is behind gets the method calls or state it missed
+    def add_peer(self, data):
+        self.peers.append(data)
+        if self.compression:
+            self.queue_output(data, encode_frame((False, COMPRESS_CODE, ())))
+        data.sync_requested = True
+        self.queue_output(data, encode_frame((False, SYNC_REQUEST_CODE, (self.applied_seq,))))
+
+    # queue a method call to be mirrored on every other server that is still up
+    def forward(self, seq, method_code, args):
+        for peer in self.peers:
+            peer.replication_queue.append((seq, method_code, args))
+
+    # send each server every call queued for it since the last pass as one batch
+    def flush_replication(self):
+        for peer in self.peers:
+            if peer.replication_queue:
+                self.queue_output(peer, encode_frame((False, REPLICATE_CODE, peer.replication_queue)))
+                peer.sent_seq = peer.replication_queue[-1][0]
+                peer.replication_queue = []
+
+    # everything that's done once per pass of the server loop after handling the requests that came in
+    def flush_pending(self):
+        if self.waiting_reads:
+            self.release_reads()
+        if self.pending_replies:
+            self.release_replies()
+        self.flush_replication()
+        self.flush_streams()
+        self.maybe_snapshot()
+
+    # apply a replicated method call and remember it so other servers can be caught up
+    def apply_replicated(self, seq, method_code, args):
+        self.applied_seq = seq
+        logged = self.wal.seq
+        output = self.run_server_method(method_code, args)
+        if self.wal.seq == logged:
+            # persist the seq even if the method didn't log anything, so a restart knows where to catch up from
+            self.log_event("applied", None)
+        self.replication_log.append((seq, method_code, args))
+        return output
+
+    # apply a method call forwarded by another server, asking to be caught up if we missed earlier ones
+    def receive_replicated(self, data, seq, method_code, args):
+        if data.incoming_snapshot is not None:
+            # apply it after the state transfer in progress is installed
+            data.deferred_ops.append((seq, method_code, args))
+        elif seq == self.applied_seq + 1:
+            self.apply_replicated(seq, method_code, args)
+            self.replicated_seq = seq
+        elif seq > self.applied_seq + 1 and not data.sync_requested:
+            # the catch-up will include this call, so it can be dropped for now
+            data.sync_requested = True
+            self.queue_output(data, encode_frame((False, SYNC_REQUEST_CODE, (self.applied_seq,))))
+
+    # send a server everything it missed after last_seq: the calls themselves if we still have them
+    # all and a full state transfer otherwise
+    def send_catch_up(self, data, last_seq):
+        if last_seq >= self.applied_seq:
+            delta = []
+        elif self.replication_log and self.replication_log[0][0] <= last_seq + 1:
+            delta = [op for op in self.replication_log if op[0] > last_seq]
+        else:
+            log.info("Sending state transfer at seq %d to %s", self.applied_seq, data.addr)
+            self.metrics.increment("state_transfers_sent")
+            self.send_frames(data, self.snapshot_frames(last_seq))
+            return
+        log.info("Sending %d missed method calls to %s", len(delta), data.addr)
+        self.metrics.increment("catch_up_calls_sent", len(delta))
+        self.queue_output(data, encode_frame((False, SYNC_DELTA_CODE, delta)))
+
+    # copy the full replicated state right away, but only encode it chunk by chunk as it's sent so
+    # that a large transfer doesn't hold up the server loop. The messages sent by the calls after
+    # last_seq, which the other server is missing from its history, are read from the history store a
+    # chunk at a time; the ones up to the transfer's seq never change, so they can be read as they're sent
+    def snapshot_frames(self, last_seq):
+        seq = self.applied_seq
+        sections = {
+            "users": list(self.users_view()),
+            "online": list(self.online),
+            "mailboxes": [(user, list(messages.entries())) for user, messages in list(self.chats.items()) if messages],
+            "groups": list(self.groups_view().items()),
+        }
+        for section, items in sections.items():
+            for i in range(0, len(items), SYNC_CHUNK_SIZE):
+                yield encode_frame((False, SYNC_SNAPSHOT_CODE, (seq, section, items[i:i + SYNC_CHUNK_SIZE])))
+        while rows := self.history.rows_between(last_seq, seq, SYNC_CHUNK_SIZE):
+            yield encode_frame((False, SYNC_SNAPSHOT_CODE, (seq, "history", rows)))
+            last_seq = rows[-1][1]
+        yield encode_frame((False, SYNC_SNAPSHOT_CODE, (seq, "end", [])))
+
+    # collect a chunk of a state transfer, and install the state once the last chunk arrives
+    def receive_snapshot_chunk(self, data, seq, section, items):
+        if data.incoming_snapshot is None:
+            data.incoming_snapshot = {"users": [], "online": [], "mailboxes": [], "groups": []}
+            data.deferred_ops = []
+        if section == "history":
+            # messages are stored the same way on every server, so they go straight into the history
+            for row in items:
+                self.history.append(*row)
+            return
+        if section != "end":
+            data.incoming_snapshot[section].extend(items)
+            return
+        snapshot, data.incoming_snapshot = data.incoming_snapshot, None
+        data.sync_requested = False
+        if seq > self.applied_seq:
+            log.info("Installing state transfer at seq %d", seq)
+            self.metrics.increment("state_transfers_installed")
+            # every name is about to be replaced, so only the ones in the new state need to be kept
+            self.user_names.clear()
+            with self.users_lock:
+                self.users = AccountIndex(map(self.user_names.canonical, snapshot["users"]))
+                self.users_version += 1
+            with self.online_lock:
+                self.online = set(map(self.user_names.canonical, snapshot["online"]))
+            self.chats.replace(snapshot["mailboxes"])
+            self.replace_groups(snapshot["groups"])
+            self.applied_seq = self.replicated_seq = seq
+            self.replication_log.clear()
+            # persist the new state right away since none of it is in our log
+            self.history.checkpoint()
+            self.wal.snapshot(self.snapshot_state())
+        for op in data.deferred_ops:
+            self.receive_replicated(data, *op)
+        data.deferred_ops = []
+        self.acknowledge(data)
+
+    # run a method on the server given a code for the method and a tuple of the args to pass in, timing it
     def run_server_method(self, method_code, args):
-        return getattr(self, SERVER_METHODS[method_code])(*args)
+        method = getattr(self, SERVER_METHODS[method_code])
+        start = time.perf_counter()
+        output = method(*args) if self.profiler is None else self.profiler.run(method, *args)
+        self.method_latency[method_code].observe(time.perf_counter() - start)
+        return output
+
+    # every metric, along with the busiest functions seen by the profiler if it's on
+    def stats(self):
+        stats = {"server": self.id, "shard": self.shard, **self.metrics.snapshot()}
+        if self.profiler is not None:
+            stats["profile"] = self.profiler.report()
+        return stats
+
+    # write the metrics to STATS_FILE in the log directory if stats_interval seconds have passed since the last time
+    def maybe_dump_stats(self):
+        if not self.stats_interval or time.monotonic() < self.next_stats_dump:
+            return
+        self.next_stats_dump = time.monotonic() + self.stats_interval
+        path = os.path.join(self.log_dir, STATS_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.stats(), f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    # the striped lock guarding a user's mailbox
+    def chat_lock(self, user):
+        return self.chat_locks[hash(user) % CHAT_LOCK_STRIPES]
+
+    # a tuple of every user that is rebuilt only when the set of users has changed since the last call
+    def users_view(self):
+        version, users = self.users_snapshot
+        if version != self.users_version:
+            with self.users_lock:
+                version, users = self.users_version, tuple(self.users)
+                self.users_snapshot = (version, users)
+        return users
 
     # report failure if account already exists and add user otherwise
     def CreateAccount(self, user):
         with self.users_lock:
             success = user not in self.users
             if success:
-                print("adding user: " + user)
-                self.users.add(user)
-                # add user to log file
-                with open(self.users_log, mode = "a") as file:
-                    print(user, file=file)
+                log.debug("adding user: %s", user)
+                self.users.add(self.user_names.canonical(user))
+                self.users_version += 1
+                # logging only buffers the event, so this doesn't do any I/O while holding the lock
+                self.log_event("create", user)
         return success
 
     # report failure if account doesn't exist and delete user otherwise
@@ -168,104 +982,296 @@ class Server():
         with self.users_lock:
             success = user in self.users
             if success:
-                print("deleting user: " + user)
+                log.debug("deleting user: %s", user)
                 self.users.discard(user)
+                self.users_version += 1
+                self.log_event("delete", user)
+        if success:
+            with self.online_lock:
                 self.online.discard(user)
-                with self.chat_locks[user]:
-                    if user in self.chats:
-                        # delete undelivered chats if you are deleting the account
-                        del self.chats[user]
-                del self.chat_locks[user]
-                # update user log to exclude the deleted account
-                with open(self.users_log, "w") as file:
-                    for el in list(self.users):
-                        print(el, file=file)
+            self.close_stream(user)
+            with self.chat_lock(user):
+                # delete undelivered chats if you are deleting the account
+                self.chats.discard(user)
+            self.leave_all_groups(user)
+            self.user_names.release(user)
         return success
 
-    # report failure if account doesn't exist and return list of accounts that match wildcard otherwise
-    def ListAccounts(self, accountWildcard):
-        # search in users for accounts that match wildcard
-        pattern = re.compile(accountWildcard)
-        with self.users_lock:
-            accounts = list(filter(lambda user: pattern.search(user) != None, self.users))
-        print("listing users: " + str(accounts))
+    # every user after key (or from key, if inclusive) in sorted order; the users lock is only held
+    # while copying out one chunk of the index at a time, so long listings don't hold up writers
+    def users_from(self, key, inclusive=True):
+        while True:
+            with self.users_lock:
+                users = self.users.slice_from(key, inclusive)
+            if not users:
+                return
+            yield from users
+            key, inclusive = users[-1], False
+
+    # report failure if account doesn't exist and return list of accounts that match wildcard otherwise;
+    # accounts are listed in sorted order, and passing limit returns a page of at most that many
+    # accounts, starting after the account given as after (the last account of the previous page)
+    def ListAccounts(self, accountWildcard, after=None, limit=0):
+        pattern, prefix = compile_wildcard(accountWildcard)
+        # every match starts with the wildcard's literal prefix, so only that range of the index is scanned
+        if after is None or after < prefix:
+            candidates = self.users_from(prefix)
+        else:
+            candidates = self.users_from(after, inclusive=False)
+        matches = (user for user in takewhile(lambda user: user.startswith(prefix), candidates)
+                   if pattern.search(user) is not None)
+        accounts = list(islice(matches, limit or None))
+        log.debug("listing %d users matching %s", len(accounts), accountWildcard)
         return accounts
 
     # report failure if account doesn't exist and add user to online list otherwise
     def Login(self, user):
-        print("logging in user: " + user)
-        with self.users_lock:
-            self.online.add(user)
-            success = user in self.users
-        if success:
-            # try loading in unsent message log
-            filepath = self.unsent_messages_log_dir + '/' + user + '.txt'
-            if os.path.exists(filepath):
-                with open(filepath, "r") as f:
-                    with self.chat_locks[user]:
-                        self.chats[user] = [eval(line.rstrip("\n")) for line in f]
-                os.remove(filepath)
-        return success
+        log.debug("logging in user: %s", user)
+        # only names of accounts that exist are interned, so logins for made-up names can't grow the interner
+        if user not in self.users:
+            return False
+        with self.online_lock:
+            self.online.add(self.user_names.canonical(user))
+        # unsent messages are already in memory, so just record that they no longer need to be persisted
+        with self.chat_lock(user):
+            if self.chats.get(user):
+                self.log_event("login", user)
+        return True
 
     # report failure if account doesn't exist and remove user from online list otherwise
     def Logout(self, user):
-        print("logging out user: " + user)
-        with self.users_lock:
+        log.debug("logging out user: %s", user)
+        with self.online_lock:
             success = user in self.online
             self.online.discard(user)
+        self.close_stream(user)
         return success
 
-    # report failure if recipient doesn't exist and send message otherwise
-    def SendMessage(self, sender, recipient, message):
-        print(f"received message from {sender} to {recipient}: {message}")
-        self.users_lock.acquire(blocking=True)
+    # report failure if recipient doesn't exist and send message otherwise. sent_at is the time the leader
+    # stamped on the call (see TIMESTAMPED_METHODS), or now if the method is called on the server directly
+    def SendMessage(self, sender, recipient, message, sent_at=None):
+        log.debug("received message from %s to %s", sender, recipient)
         if recipient not in self.users:
-            self.users_lock.release()
             return False
-        else:
-            self.users_lock.release()
-            message = SingleMessage(sender, message)
-            with self.chat_locks[recipient]:
-                self.chats[recipient].append(message)
-            with self.users_lock:
-                # if the user is offline, then write the message to the log for persistence
+        self.record_history(direct_conversation(sender, recipient), sender, message, sent_at)
+        message = SingleMessage(sender, message)
+        with self.chat_lock(recipient):
+            if self.chats[recipient].append(message, self.applied_seq):
+                self.metrics.increment("messages_spilled")
+            # if the user is offline, then log the message for persistence
+            if recipient not in self.online:
+                self.log_event("message", recipient, message)
+        # wake up the recipient's stream if they have one open
+        self.notify_stream(recipient)
+        return True
+
+    # keep a message in the history; the store only buffers it for a while, so it's logged as well in
+    # case the server stops before it's written
+    def record_history(self, conversation, sender, message, sent_at):
+        sent_at = time.time() if sent_at is None else sent_at
+        self.history.append(conversation, self.applied_seq, sent_at, sender, message)
+        self.log_event("history", conversation, sender, message, sent_at)
+
+    # a copy of the members of every group, as lists
+    def groups_view(self):
+        with self.groups_lock:
+            return {group: list(members) for group, members in self.groups.items()}
+
+    # replace every group with the given (group, members) pairs
+    def replace_groups(self, items):
+        with self.groups_lock:
+            self.groups = {group: set(map(self.user_names.canonical, members)) for group, members in items}
+
+    # take a user out of every group, e.g. because their account was deleted
+    def leave_all_groups(self, user):
+        with self.groups_lock:
+            for members in self.groups.values():
+                members.discard(user)
+
+    # report failure if the group already exists and create it with no members otherwise
+    def CreateGroup(self, group):
+        with self.groups_lock:
+            success = group not in self.groups
+            if success:
+                log.debug("creating group: %s", group)
+                self.groups[group] = set()
+                self.log_event("group_create", group)
+        return success
+
+    # report failure if the group doesn't exist and delete it otherwise
+    def DeleteGroup(self, group):
+        with self.groups_lock:
+            success = self.groups.pop(group, None) is not None
+            if success:
+                log.debug("deleting group: %s", group)
+                self.log_event("group_delete", group)
+        return success
+
+    # report failure if the group or account doesn't exist and add the user to the group otherwise
+    def JoinGroup(self, group, user):
+        if user not in self.users:
+            return False
+        with self.groups_lock:
+            success = group in self.groups
+            if success:
+                self.groups[group].add(self.user_names.canonical(user))
+                self.log_event("group_join", group, user)
+        return success
+
+    # report failure if the user isn't in the group and take them out of it otherwise
+    def LeaveGroup(self, group, user):
+        with self.groups_lock:
+            success = user in self.groups.get(group, ())
+            if success:
+                self.groups[group].discard(user)
+                self.log_event("group_leave", group, user)
+        return success
+
+    # the members of a group in sorted order, or an empty list if the group doesn't exist
+    def ListGroupMembers(self, group):
+        with self.groups_lock:
+            return sorted(self.groups.get(group, ()))
+
+    # report failure if the group doesn't exist and send the message to every other member otherwise.
+    # The message is encoded once and the same bytes go into every member's mailbox, and it's logged
+    # as a single event, just as the call is replicated as a single call however big the group is
+    def SendGroupMessage(self, sender, group, message, sent_at=None):
+        log.debug("received message from %s to group %s", sender, group)
+        with self.groups_lock:
+            members = self.groups.get(group)
+            if members is None:
+                return False
+            recipients = [member for member in members if member != sender]
+        self.record_history(group_conversation(group), sender, message, sent_at)
+        message = SingleMessage(sender, message)
+        encoded = encode_value(message)
+        offline = []
+        for recipient in recipients:
+            with self.chat_lock(recipient):
+                if self.chats[recipient].append_encoded(encoded, self.applied_seq):
+                    self.metrics.increment("messages_spilled")
                 if recipient not in self.online:
-                    with open(self.unsent_messages_log_dir + "/" + recipient + ".txt", mode="a") as f:
-                        f.write(str(message) + '\n')
-            return True
-
-    # report failure if account doesn't exist and start chat stream otherwise
-    def ChatStream(self, user, data_stream):
-        # always make sure to release this; note that this needs to intermittently release
-        self.users_lock.acquire(blocking=True)
-        while user in self.online:
-            assert user in self.users, "user does not exist or no longer exists"
-            # release so that the streams aren't constantly holding onto the lock
-            self.users_lock.release()
-            with self.chat_locks[user]:
-                if self.chats[user]:
-                    msg = self.chats[user].pop(0)
-                    data_stream.outb += str(msg).encode("utf-8")
-            # wait slightly to avoid sending two messages in same outbound message
-            time.sleep(0.01)
-            # reacquire lock before checking while condition
-            self.users_lock.acquire(blocking=True)
-        # release lock before stopping stream
-        self.users_lock.release()
-
-# start the server
-def serve(id):
-    server = Server(id)
-    while True:
-        events = server.sel.select(timeout=None)
-        for key, mask in events:
-            if key.data is None:
-                server.accept_wrapper(key.fileobj)
-            else:
-                server.service_connection(key, mask)
+                    offline.append(recipient)
+        if offline:
+            self.log_event("group_message", group, message, offline)
+        self.notify_streams(recipients)
+        return True
+
+    # the history reads are shared with the worker processes, which answer them for their own clients
+    # (see history.py)
+    def GetHistory(self, user, other, before=None, limit=HISTORY_PAGE_SIZE, until=None):
+        return get_history(self.history, user, other, before, limit, until)
+
+    def GetHistorySince(self, user, other, after=0, since=0.0, limit=HISTORY_PAGE_SIZE):
+        return get_history_since(self.history, user, other, after, since, limit)
+
+    def GetGroupHistory(self, group, before=None, limit=HISTORY_PAGE_SIZE):
+        return get_group_history(self.history, group, before, limit)
+
+    def GetGroupHistorySince(self, group, after=0, since=0.0, limit=HISTORY_PAGE_SIZE):
+        return get_group_history_since(self.history, group, after, since, limit)
+
+    # report failure if account doesn't exist and start chat stream otherwise; messages are then pushed
+    # to data_stream by the selector loop whenever the user's mailbox is non-empty. Passing after makes
+    # it an acknowledged stream that starts after the message with that id
+    def ChatStream(self, data_stream, user, after=None):
+        if user not in self.online or user not in self.users:
+            return False
+        with self.streams_lock:
+            self.streams[user] = data_stream
+        data_stream.stream_user = user
+        data_stream.stream_sent = after
+        # deliver any backlog that built up before the stream was opened
+        self.notify_stream(user)
+        return True
+
+    # drop a user's messages up to and including the one with id through, which their client has
+    # received; it's replicated like any other call, so every server forgets them and a stream opened
+    # on any of them after a failover only sends what the client hasn't acknowledged
+    def AckMessages(self, user, through):
+        with self.chat_lock(user):
+            dropped = self.chats[user].drop_through(through) if user in self.chats else 0
+            if dropped:
+                self.log_event("ack", user, through)
+        if dropped:
+            self.metrics.increment("messages_acknowledged", dropped)
+            # the stream may be waiting for room in its window
+            self.notify_stream(user)
+        return True
+
+    # run the selector loop until stopped, flushing replication batches and chat streams and compacting
+    # the log after each pass, and periodically trying to reconnect to servers that are down
+    def run(self):
+        while self.running:
+            events = self.sel.select(timeout=READ_WAIT_TIMEOUT if self.waiting_reads else PEER_RECONNECT_INTERVAL)
+            for key, mask in events:
+                if key.fileobj is self.wakeup_recv:
+                    self.handle_wakeup()
+                elif key.data is None:
+                    self.accept_wrapper(key.fileobj)
+                else:
+                    self.service_connection(key, mask)
+            self.flush_pending()
+            if time.monotonic() >= self.next_reconnect:
+                self.connect_peers(quiet=True)
+            self.maybe_dump_stats()
+        # flush the log and close every socket we were serving; the log's writer wakes the loop up after
+        # its last group commit, so it's stopped while the wakeup socket is still open
+        self.wal.close()
+        for key in list(self.sel.get_map().values()):
+            key.fileobj.close()
+        self.sel.close()
+        self.wakeup_send.close()
+        self.history.close()
+        # the workers stop once their connections to the server close
+        for process in self.worker_processes:
+            process.join()
+        if self.profiler is not None:
+            self.profiler.dump(os.path.join(self.log_dir, PROFILE_FILE))
+
+    # stop the server loop from any thread, e.g. to simulate a crash
+    def stop(self):
+        self.running = False
+        self.wakeup()
+
+# start the server, using the asyncio engine instead of the selector loop if requested; given a cluster
+# config, it serves as server id of the given shard's replica group instead of using the constants in common.py
+def serve(id, use_asyncio=False, ack_mode='leader', config=None, shard=0, profile_every=0, stats_interval=0,
+          compression=True, workers=0):
+    kwargs = dict(ack_mode=ack_mode, profile_every=profile_every, stats_interval=stats_interval, compression=compression,
+                  workers=workers)
+    if config is not None:
+        kwargs.update(server_kwargs(load_cluster(config)["shards"][shard]), shard=shard)
+    if use_asyncio:
+        from async_server import AsyncServer
+        AsyncServer(id, **kwargs).run()
+    else:
+        Server(id, **kwargs).run()
 
 
 # run the server when this script is executed
 if __name__ == '__main__':
-    assert len(sys.argv) == 2, "provide server id"
-    serve(int(sys.argv[1]))
+    parser = argparse.ArgumentParser(description="Run one of the replicated chat servers")
+    parser.add_argument("id", type=int, choices=[0, 1, 2], help="server id")
+    parser.add_argument("--asyncio", action="store_true", help="serve connections with the asyncio engine")
+    parser.add_argument("--ack", choices=ACK_MODES, default='leader',
+                        help="reply to clients once the leader has applied a call or once a majority of servers have")
+    parser.add_argument("--config", help="cluster config file listing the servers of every shard")
+    parser.add_argument("--shard", type=int, default=0, help="which shard of the cluster config this server belongs to")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="least severe log messages to print; DEBUG logs every call")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help=f"seconds between writes of the metrics to {STATS_FILE} in the log directory")
+    parser.add_argument("--profile-every", type=int, default=0, metavar="N",
+                        help=f"profile one in every N method calls, writing the samples to {PROFILE_FILE} on exit")
+    parser.add_argument("--no-compression", dest="compression", action="store_false",
+                        help="never compress frames, even for clients and servers that ask for it")
+    parser.add_argument("--workers", type=int, default=0, metavar="N",
+                        help="accept clients in N worker processes sharing the client-facing port, "
+                             "with this process keeping the state and replicating")
+    args = parser.parse_args()
+    if args.workers and args.asyncio:
+        parser.error("--workers only works with the selector engine")
+    configure_logging(args.log_level)
+    serve(args.id, args.asyncio, args.ack, args.config, args.shard, args.profile_every, args.stats_interval,
+          args.compression, args.workers)
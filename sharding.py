@@ -0,0 +1,70 @@
+import hashlib
+import json
+from bisect import bisect_right
+
+# points each shard gets on the hash ring; more points spread users more evenly across shards
+VIRTUAL_NODES = 64
+
+
+# a stable 64 bit hash of a string, the same in every process (unlike hash())
+def stable_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+# consistent hashing of usernames onto shards: every shard owns virtual_nodes points on a ring, and a
+# user belongs to the shard owning the first point at or after the user's hash, so adding a shard only
+# moves the users that land on its new points
+class HashRing:
+    def __init__(self, shard_count, virtual_nodes=VIRTUAL_NODES):
+        self.shard_count = shard_count
+        points = sorted((stable_hash(f"shard-{shard}-{node}"), shard)
+                        for shard in range(shard_count) for node in range(virtual_nodes))
+        self.hashes = [h for h, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard_for(self, user):
+        i = bisect_right(self.hashes, stable_hash(user))
+        return self.shards[i % len(self.shards)]
+
+
+# read a cluster layout from a JSON file. It looks like
+#   {"virtual_nodes": 64,
+#    "shards": [{"addresses": [a0, a1, a2], "client_ports": [c0, c1, c2], "server_ports": [s0, s1, s2]}, ...]}
+# where each shard is a replica group of three servers, laid out like the SERVER_ADDR_*/*_PORT_* constants
+def load_cluster(path):
+    with open(path) as f:
+        cluster = json.load(f)
+    for i, shard in enumerate(cluster["shards"]):
+        for field in ("addresses", "client_ports", "server_ports"):
+            if len(shard[field]) != 3:
+                raise ValueError(f"Shard {i} needs exactly three {field}")
+    return cluster
+
+
+# a cluster of the given number of shards with every server on localhost, using six consecutive ports
+# per shard starting at base_port
+def localhost_cluster(shard_count, base_port, virtual_nodes=VIRTUAL_NODES):
+    return {"virtual_nodes": virtual_nodes, "shards": [{
+        "addresses": ["127.0.0.1"] * 3,
+        "client_ports": [base_port + 6 * i + j for j in range(3)],
+        "server_ports": [base_port + 6 * i + 3 + j for j in range(3)],
+    } for i in range(shard_count)]}
+
+
+def ring_for(cluster):
+    return HashRing(len(cluster["shards"]), cluster.get("virtual_nodes", VIRTUAL_NODES))
+
+
+# keyword arguments for Server for the servers of one shard
+def server_kwargs(shard):
+    addresses, client_ports, server_ports = shard["addresses"], shard["client_ports"], shard["server_ports"]
+    return dict(server_addr_0=addresses[0], server_addr_1=addresses[1], server_addr_2=addresses[2],
+                cfp_0=client_ports[0], cfp_1=client_ports[1], cfp_2=client_ports[2],
+                sfp_0=server_ports[0], sfp_1=server_ports[1], sfp_2=server_ports[2])
+
+
+# keyword arguments for Client for the servers of one shard
+def client_kwargs(shard):
+    addresses, client_ports = shard["addresses"], shard["client_ports"]
+    return dict(p_0=client_ports[0], p_1=client_ports[1], p_2=client_ports[2],
+                server_addr_0=addresses[0], server_addr_1=addresses[1], server_addr_2=addresses[2])
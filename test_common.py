@@ -0,0 +1,105 @@
+import pytest
+from common import *
+
+
+VALUES = [None, True, False, 0, -128, 127, 1 << 40, -(1 << 62), 1.5, "", "short", "long " * 100, "ünïcode",
+          b"\x00bytes", (), (1, "two", (3.0,)), [], [1, [2, [3]]], {}, {"a": 1, 2: [None]},
+          SingleMessage("alice", "hi"), (True, 5, ("alice", "bob", "hello"), 7)]
+
+
+@pytest.mark.parametrize("value", VALUES)
+def test_round_trip(value):
+    frame = encode_frame(value)
+    assert FRAME_HEADER.unpack_from(frame)[0] == len(frame) - FRAME_HEADER.size
+    assert decode_body(frame[FRAME_HEADER.size:]) == value
+    assert decode_body(encode_value(value)) == value
+
+
+def test_stream_frame_matches_encoded_tuple():
+    messages = [SingleMessage("a", "one"), SingleMessage("b", "two")]
+    encoded = b"".join(encode_value(message) for message in messages)
+    assert encode_stream_frame(3, 2, encoded) == encode_frame((3, messages))
+    assert encode_stream_frame(3, 2, encoded, 9) == encode_frame((3, messages, 9))
+
+
+def test_pop_frames_leaves_partial_frame():
+    frames = encode_frame(("one", 1)) + encode_frame(("two", 2))
+    buf = bytearray(frames[:-3])
+    assert pop_frames(buf) == [("one", 1)]
+    assert bytes(buf) == frames[len(encode_frame(("one", 1))):-3]
+    buf += frames[-3:]
+    assert pop_frames(buf) == [("two", 2)]
+    assert not buf
+
+
+@pytest.mark.parametrize("body", [b"", b"i\x00", b"s\x00\x00\x00\x09abc", b"t\x00\x00\x00\x02N", b"S\x02\xff\xfe",
+                                  b"?", b"NN", b"d\x00\x00\x00\x01l\x00\x00\x00\x00N"])
+def test_malformed_bodies(body):
+    with pytest.raises(ProtocolError):
+        decode_body(body)
+
+
+def test_oversized_frame():
+    with pytest.raises(ProtocolError):
+        pop_frames(bytearray(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1)))
+
+
+def test_compressed_frames():
+    frames = b"".join(encode_frame(("message", n, "x" * 100)) for n in range(50))
+    compressed = compress_frames(frames)
+    assert len(compressed) < len(frames)
+    buf = bytearray(compressed + encode_frame("after"))
+    assert pop_frames(buf) == [("message", n, "x" * 100) for n in range(50)] + ["after"]
+    assert not buf
+    raw = bytearray(compressed)
+    assert pop_raw_frames(raw) == [encode_frame(("message", n, "x" * 100)) for n in range(50)]
+
+
+def test_incompressible_frames_are_left_alone():
+    frame = encode_frame("x")
+    assert compress_frames(frame) == frame
+
+
+def test_truncated_compressed_frame_waits_for_the_rest():
+    compressed = compress_frames(encode_frame("y" * 1000))
+    buf = bytearray(compressed[:-1])
+    assert pop_frames(buf) == []
+    buf += compressed[-1:]
+    assert pop_frames(buf) == ["y" * 1000]
+
+
+def test_malformed_compressed_frame():
+    with pytest.raises(ProtocolError):
+        pop_frames(bytearray(FRAME_HEADER.pack(4 | COMPRESSED_FLAG) + b"junk"))
+
+
+def test_nesting_limit():
+    nested = None
+    for _ in range(MAX_NESTING_DEPTH):
+        nested = (nested,)
+    assert decode_body(encode_value(nested)) == nested
+    with pytest.raises(ProtocolError):
+        decode_body(encode_value((nested,)))
+    with pytest.raises(ProtocolError):
+        decode_body(b"t\x00\x00\x00\x01" * 5000 + b"N")
+
+
+def test_check_args():
+    check_args('CreateAccount', ("alice",))
+    check_args('ListAccounts', ("a*", None, 10))
+    check_args('GetHistory', ("alice", "bob", None, 50, 1.5))
+    for method, args in [('CreateAccount', (5,)), ('CreateAccount', ()), ('CreateAccount', ("a", "b")),
+                         ('CreateAccount', ["alice"]), ('JoinGroup', ("room", None)), ('AckMessages', ("alice", "1")),
+                         ('ListAccounts', ("a*", None, None))]:
+        with pytest.raises(ProtocolError):
+            check_args(method, args)
+
+
+# the leader adds the time to these calls, so a client can't leave out an arg to have the time take its
+# place, or send a time of its own
+@pytest.mark.parametrize("method", sorted(TIMESTAMPED_METHODS))
+def test_timestamped_calls_take_no_time(method):
+    check_args(method, ("mallory", "alice", "hello"))
+    for args in [("mallory", "alice"), ("mallory", "alice", "hello", 1792353820.0)]:
+        with pytest.raises(ProtocolError):
+            check_args(method, args)
@@ -0,0 +1,30 @@
+from history import HISTORY_QUERY_LIMIT, HistoryReader, HistoryStore
+
+
+def filled_store(tmp_path, count):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    for seq in range(1, count + 1):
+        store.append("u:a\0b", seq, float(seq), "a", "message %d" % seq)
+    return store
+
+
+# a page never holds more than HISTORY_QUERY_LIMIT messages, and a negative limit holds none
+def test_page_limits(tmp_path):
+    store = filled_store(tmp_path, HISTORY_QUERY_LIMIT + 10)
+    assert len(store.last("u:a\0b", limit=HISTORY_QUERY_LIMIT + 10)) == HISTORY_QUERY_LIMIT
+    assert store.last("u:a\0b", limit=-1) == []
+    assert store.since("u:a\0b", limit=-1) == []
+    assert [row[0] for row in store.last("u:a\0b", before=5, limit=2)] == [3, 4]
+    store.close()
+
+
+# a message stored again, e.g. when the write-ahead log is replayed, is only kept once, and a reader
+# sees everything the store has flushed
+def test_messages_are_stored_once(tmp_path):
+    store = filled_store(tmp_path, 3)
+    store.append("u:a\0b", 2, 2.0, "a", "message 2")
+    store.flush()
+    reader = HistoryReader(str(tmp_path / "history.db"))
+    assert [row[0] for row in reader.since("u:a\0b")] == [1, 2, 3]
+    reader.close()
+    store.close()
@@ -0,0 +1,77 @@
+from common import *
+from mailboxes import Mailbox, SpillFiles
+
+
+# a mailbox holding messages with ids 1 to count, all but the first limit of them spilled to disk
+def filled_mailbox(tmp_path, count, limit):
+    mailbox = Mailbox(str(tmp_path / "user.spill"), limit)
+    for message_id in range(1, count + 1):
+        mailbox.append("message %d" % message_id, message_id)
+    return mailbox
+
+
+# the encodings peek_encoded returns for the messages with the given ids
+def encoded(message_ids):
+    return b"".join(encode_value("message %d" % message_id) for message_id in message_ids)
+
+
+# a stream resumed after a message that's still in the spill file starts right after it, however many
+# times the spill file has to be read from to get there
+def test_peek_after_spilled_message(tmp_path):
+    mailbox = filled_mailbox(tmp_path, 10, limit=3)
+    assert mailbox.peek_encoded(7, 5) == (2, 9, encoded([8, 9]))
+    assert len(mailbox) == 10
+
+
+# everything up to where a stream resumes counts against its window, even if it's still spilled
+def test_count_through_spilled_messages(tmp_path):
+    mailbox = filled_mailbox(tmp_path, 10, limit=3)
+    assert mailbox.count_through(2) == 2
+    assert mailbox.count_through(5) == 5
+    assert mailbox.count_through(10) == 10
+    assert len(mailbox) == 10
+
+
+# a stream resumed part way through a spilled backlog gets each later message once and in order while
+# its acknowledgements drop what it has received and new messages keep spilling
+def test_resume_stream_over_spilled_messages(tmp_path):
+    mailbox = filled_mailbox(tmp_path, 20, limit=4)
+    sent = 6
+    delivered = []
+    while True:
+        count, last_id, batch = mailbox.peek_encoded(sent, 3)
+        if not count:
+            break
+        assert batch == encoded(range(sent + 1, last_id + 1))
+        delivered.extend(range(sent + 1, last_id + 1))
+        # the client acknowledges each batch once the next one has been sent
+        mailbox.drop_through(sent)
+        sent = last_id
+        assert mailbox.count_through(sent) == count
+        if sent == 12:
+            mailbox.append("message 21", 21)
+    assert delivered == list(range(7, 22))
+    assert mailbox.drop_through(sent) == 1
+    assert len(mailbox) == 0
+
+
+# a stream held back to the committed messages gets nothing past them, and knows whether it's waiting on them
+def test_peek_through(tmp_path):
+    mailbox = filled_mailbox(tmp_path, 10, limit=3)
+    assert mailbox.peek_encoded(0, 5, through=2) == (2, 2, encoded([1, 2]))
+    assert not mailbox.has_between(2, 2)
+    assert mailbox.has_between(2, 3)
+    assert mailbox.peek_encoded(2, 5, through=2) == (0, 2, b"")
+
+
+# more mailboxes can spill than there are spill files kept open, and each one still reads back in order
+def test_more_spilled_mailboxes_than_open_files(tmp_path):
+    spill_files = SpillFiles(limit=2)
+    mailboxes = [Mailbox(str(tmp_path / f"user{n}.spill"), 1, spill_files=spill_files) for n in range(5)]
+    for message_id in range(1, 5):
+        for mailbox in mailboxes:
+            mailbox.append("message %d" % message_id, message_id)
+    assert len(spill_files.files) == 2
+    for mailbox in mailboxes:
+        assert mailbox.take() == ["message %d" % message_id for message_id in range(1, 5)]
+    assert not spill_files.files and not list(tmp_path.iterdir())
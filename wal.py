@@ -0,0 +1,188 @@
+import os
+import struct
+import threading
+import zlib
+from common import *
+
+# every record in a log segment is a crc32 of the frame that follows it; the frame holds (seq, event)
+RECORD_CRC = struct.Struct("!I")
+# a snapshot file starts with the seq of the last event it covers and a crc32 of the state frame
+SNAPSHOT_HEADER = struct.Struct("!QI")
+
+SEGMENT_PREFIX = "wal-"
+SEGMENT_SUFFIX = ".log"
+SNAPSHOT_FILE = "snapshot.bin"
+
+
+class LogCorruptionError(Exception):
+    pass
+
+
+# a snapshot waiting in the write queue; it's written once every record before it is durable
+class _PendingSnapshot:
+    def __init__(self, seq, state_frame):
+        self.seq = seq
+        self.state_frame = state_frame
+
+
+# an append-only, checksummed log of events split into segments, plus periodic snapshots of the state
+# the events produce. Appends only buffer the record; a background thread writes everything that has
+# been buffered since its last pass and fsyncs once for the whole batch (group commit)
+class WriteAheadLog:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.cond = threading.Condition()
+        self.seq = 0  # seq of the last appended event
+        self.durable_seq = 0  # seq of the last event that has been fsynced
+        self.pending = []  # (seq, record) pairs and snapshots waiting to be written, in seq order
+        self.records_since_snapshot = 0
+        self.group_commits = 0  # number of fsyncs, each of which covers a whole batch of events
+        self.segment = None
+        self.closed = False
+        self.writer = None
+        self.on_durable = None  # called from the writer thread after each group commit
+
+    def segment_path(self, start_seq):
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{start_seq:020d}{SEGMENT_SUFFIX}")
+
+    # the (start seq, path) of every segment on disk in log order
+    def segments(self):
+        found = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                found.append((int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    # load the latest snapshot with restore(state), replay every later event with apply(event), and
+    # start the writer; returns the seq of the last recovered event
+    def recover(self, restore, apply):
+        last_seq = 0
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, "rb") as f:
+                raw = f.read()
+            last_seq, crc = SNAPSHOT_HEADER.unpack_from(raw)
+            state_frame = raw[SNAPSHOT_HEADER.size:]
+            if zlib.crc32(state_frame) != crc:
+                raise LogCorruptionError(f"Snapshot {snapshot_path} failed its checksum")
+            restore(decode_body(state_frame[FRAME_HEADER.size:]))
+        segments = self.segments()
+        for i, (_, path) in enumerate(segments):
+            last_seq, intact = self.replay_segment(path, apply, last_seq)
+            if not intact:
+                # a torn or corrupt record can only come from a crash mid-write, so nothing after it can be trusted
+                for _, later_path in segments[i + 1:]:
+                    os.remove(later_path)
+                break
+        self.seq = self.durable_seq = last_seq
+        self.segment = open(self.segment_path(last_seq + 1), "ab")
+        self.writer = threading.Thread(target=self.write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+        return last_seq
+
+    # apply every event in a segment with a seq above last_seq and return the new last seq and whether
+    # the segment was intact; a damaged segment is truncated right before its first bad record
+    def replay_segment(self, path, apply, last_seq):
+        with open(path, "rb") as f:
+            raw = f.read()
+        pos = 0
+        while pos < len(raw):
+            record = self.read_record(raw, pos)
+            if record is None:
+                with open(path, "r+b") as f:
+                    f.truncate(pos)
+                return last_seq, False
+            (seq, event), pos = record
+            if seq > last_seq:
+                apply(event)
+                last_seq = seq
+        return last_seq, True
+
+    # decode the record at pos, returning ((seq, event), end) or None if it's incomplete or corrupt
+    def read_record(self, raw, pos):
+        start = pos + RECORD_CRC.size
+        if start + FRAME_HEADER.size > len(raw):
+            return None
+        (crc,) = RECORD_CRC.unpack_from(raw, pos)
+        (length,) = FRAME_HEADER.unpack_from(raw, start)
+        end = start + FRAME_HEADER.size + length
+        if end > len(raw) or zlib.crc32(raw[start:end]) != crc:
+            return None
+        try:
+            return decode_body(raw[start + FRAME_HEADER.size:end]), end
+        except ProtocolError:
+            return None
+
+    # buffer an event for the next group commit and return its seq
+    def append(self, event):
+        with self.cond:
+            self.seq += 1
+            frame = encode_frame((self.seq, event))
+            self.pending.append((self.seq, RECORD_CRC.pack(zlib.crc32(frame)) + frame))
+            self.records_since_snapshot += 1
+            self.cond.notify()
+            return self.seq
+
+    # block until the event with the given seq has been fsynced
+    def wait_durable(self, seq, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.durable_seq >= seq, timeout)
+
+    # queue a snapshot of the state produced by every event appended so far; the caller must make sure
+    # no events are appended concurrently so that state and seq agree
+    def snapshot(self, state):
+        state_frame = encode_frame(state)
+        with self.cond:
+            self.pending.append((self.seq, _PendingSnapshot(self.seq, state_frame)))
+            self.records_since_snapshot = 0
+            self.cond.notify()
+
+    # write a snapshot, start a new segment after it, and remove the segments it makes redundant
+    def write_snapshot(self, snapshot):
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.segment.close()
+        self.segment = open(self.segment_path(snapshot.seq + 1), "ab")
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(snapshot_path + ".tmp", "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(snapshot.seq, zlib.crc32(snapshot.state_frame)))
+            f.write(snapshot.state_frame)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+        for start_seq, path in self.segments():
+            if start_seq <= snapshot.seq:
+                os.remove(path)
+
+    def write_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, []
+            for seq, item in batch:
+                if isinstance(item, _PendingSnapshot):
+                    self.write_snapshot(item)
+                else:
+                    self.segment.write(item)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            with self.cond:
+                self.durable_seq = batch[-1][0]
+                self.group_commits += 1
+                self.cond.notify_all()
+            if self.on_durable is not None:
+                self.on_durable()
+
+    # flush everything that has been appended and stop the writer
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+        if self.segment is not None:
+            self.segment.close()
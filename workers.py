@@ -0,0 +1,251 @@
+import logging
+import selectors
+import signal
+import socket
+import sqlite3
+from itertools import count
+from common import *
+from history import HISTORY_READS, HistoryReader
+from metrics import configure_logging
+from server import OUTPUT_HIGH_WATER, OUTPUT_LOW_WATER, REQUEST_ERRORS
+
+# frames from clients no bigger than this are decoded on their way through to spot requests for
+# compression; every other frame is passed on without being decoded
+SNIFF_SIZE = 64
+
+log = logging.getLogger("worker")
+
+
+# whether a frame from a client asks for compressed frames
+def asks_for_compression(frame):
+    request = decode_body(frame[FRAME_HEADER.size:])
+    return isinstance(request, tuple) and len(request) > 1 and request[1] == COMPRESS_CODE
+
+
+# a client connected to a worker, known to the server by id
+class Session:
+    __slots__ = ("id", "addr", "sock", "inb", "outb", "compress", "events", "reading_paused")
+
+    def __init__(self, id, addr, sock):
+        self.id = id
+        self.addr = addr
+        self.sock = sock
+        self.inb = bytearray()
+        self.outb = bytearray()
+        self.compress = False  # whether frames to the client are compressed, once it asks
+        self.events = selectors.EVENT_READ
+        # set while OUTPUT_HIGH_WATER bytes are waiting to be sent to the client, which the server is
+        # told about so it holds off the client's chat stream too
+        self.reading_paused = False
+
+
+# a process that accepts clients on a server's client-facing port alongside the server's other workers
+# (with SO_REUSEPORT the kernel spreads new connections across them) and passes their frames to the
+# server over a local socket, each tagged with the client's session id. The server keeps all of the
+# state, runs every call but history reads and does all of the replication, so workers never need to
+# agree on anything; what they take off the server's core is the socket reads and writes for every
+# client, splitting and inflating the frames clients send, compressing what goes back to them, and
+# answering their history reads, which the server hands back once everything they have to reflect is
+# in the history database
+class Worker:
+    def __init__(self, address, port, server_path, history_path, compression=True):
+        self.compression = compression
+        self.history = HistoryReader(history_path)
+        self.sel = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.listener.bind((address, port))
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.sel.register(self.listener, selectors.EVENT_READ, data=None)
+        # the server waits for every worker to connect before it starts serving, by which time
+        # they're all listening
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.connect(server_path)
+        self.server.setblocking(False)
+        self.server_inb = bytearray()
+        self.server_outb = bytearray()
+        self.server_events = selectors.EVENT_READ
+        self.sel.register(self.server, self.server_events, data=self)
+        # set while OUTPUT_HIGH_WATER bytes of requests are waiting to go to the server, which stops
+        # reading from every client until the server catches up
+        self.backed_up = False
+        self.sessions = {}
+        self.session_ids = count(CONTROL_SESSION + 1)
+        self.running = True
+
+    def run(self):
+        while self.running:
+            for key, mask in self.sel.select():
+                if key.data is None:
+                    self.accept()
+                elif key.data is self:
+                    self.service_server(mask)
+                elif key.data.id in self.sessions:
+                    self.service_session(key.data, mask)
+            self.flush_server()
+        # the server is gone, so closing every client makes them fail over to another server
+        for key in list(self.sel.get_map().values()):
+            key.fileobj.close()
+        self.sel.close()
+        self.history.close()
+
+    def accept(self):
+        try:
+            sock, addr = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session = Session(next(self.session_ids), addr, sock)
+        self.sessions[session.id] = session
+        self.sel.register(sock, session.events, data=session)
+        self.send_control("open", session.id, addr)
+
+    # close a client's connection, telling the server unless it was the server that closed it
+    def close_session(self, session, notify=True):
+        self.sel.unregister(session.sock)
+        session.sock.close()
+        del self.sessions[session.id]
+        if notify:
+            self.send_control("close", session.id)
+
+    # tell the server something about a session
+    def send_control(self, kind, session_id, *args):
+        self.server_outb += SESSION_HEADER.pack(CONTROL_SESSION)
+        self.server_outb += encode_frame((kind, session_id, *args))
+
+    # pass every frame a client sent on to the server as it is
+    def service_session(self, session, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                chunk = session.sock.recv(RECV_BUFFER_SIZE)
+            except OSError:
+                chunk = b""
+            if not chunk:
+                self.close_session(session)
+                return
+            session.inb += chunk
+            try:
+                frames = pop_raw_frames(session.inb)
+                header = SESSION_HEADER.pack(session.id)
+                for frame in frames:
+                    if len(frame) <= SNIFF_SIZE and asks_for_compression(frame):
+                        session.compress = self.compression
+                    self.server_outb += header
+                    self.server_outb += frame
+            except ProtocolError as e:
+                log.warning("Closing connection to %s: %s", session.addr, e)
+                self.close_session(session)
+                return
+        if mask & selectors.EVENT_WRITE and session.outb:
+            self.flush_session(session)
+
+    # hand the frames the server sent for each session to its client, compressing the ones for each
+    # client together if it asked for that
+    def service_server(self, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                chunk = self.server.recv(RECV_BUFFER_SIZE)
+            except OSError:
+                chunk = b""
+            if not chunk:
+                log.info("Server closed its connection, stopping")
+                self.running = False
+                return
+            self.server_inb += chunk
+            output = {}
+            for session_id, frame in pop_session_frames(self.server_inb):
+                if session_id == CONTROL_SESSION:
+                    self.handle_control(*decode_body(memoryview(frame)[FRAME_HEADER.size:]))
+                    continue
+                if session_id & QUERY_FLAG:
+                    session_id ^= QUERY_FLAG
+                    if session_id not in self.sessions:
+                        continue
+                    frame = self.answer_read(self.sessions[session_id], frame)
+                    if frame is None:
+                        continue
+                output.setdefault(session_id, []).append(frame)
+            for session_id, frames in output.items():
+                session = self.sessions.get(session_id)
+                if session is not None:
+                    self.queue_output(session, b"".join(frames))
+
+    # the reply to a history read the server handed back, run against our own connection to the history
+    # database; the server has already checked its args
+    def answer_read(self, session, frame):
+        request_id, (method, args), seq = decode_body(memoryview(frame)[FRAME_HEADER.size:])
+        try:
+            return encode_frame((request_id, HISTORY_READS[method](self.history, *args), seq))
+        except (*REQUEST_ERRORS, sqlite3.Error) as e:
+            log.warning("Closing connection to %s: %s", session.addr, e)
+            self.close_session(session)
+
+    # what the server has to say about a session: only that it closed it, after a bad request
+    def handle_control(self, kind, session_id):
+        session = self.sessions.get(session_id)
+        if kind == "close" and session is not None:
+            self.close_session(session, notify=False)
+
+    def queue_output(self, session, frames):
+        if session.compress and len(frames) >= COMPRESSION_THRESHOLD:
+            frames = compress_frames(frames)
+        session.outb += frames
+        self.flush_session(session)
+        if session.id in self.sessions and not session.reading_paused and len(session.outb) >= OUTPUT_HIGH_WATER:
+            session.reading_paused = True
+            self.send_control("paused", session.id)
+            self.update_events(session)
+
+    # send as much of a client's output as its socket takes
+    def flush_session(self, session):
+        try:
+            sent = session.sock.send(session.outb)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close_session(session)
+            return
+        del session.outb[:sent]
+        if session.reading_paused and len(session.outb) <= OUTPUT_LOW_WATER:
+            session.reading_paused = False
+            self.send_control("drained", session.id)
+        self.update_events(session)
+
+    def update_events(self, session):
+        reading = not (session.reading_paused or self.backed_up)
+        events = (selectors.EVENT_READ if reading else 0) | (selectors.EVENT_WRITE if session.outb else 0)
+        if events != session.events:
+            self.sel.modify(session.sock, events, data=session)
+            session.events = events
+
+    # send as much of what's waiting for the server as its socket takes
+    def flush_server(self):
+        if self.server_outb:
+            try:
+                sent = self.server.send(self.server_outb)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.running = False
+                return
+            del self.server_outb[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.server_outb else 0)
+        if events != self.server_events:
+            self.sel.modify(self.server, events, data=self)
+            self.server_events = events
+        backed_up = len(self.server_outb) >= (OUTPUT_LOW_WATER if self.backed_up else OUTPUT_HIGH_WATER)
+        if backed_up != self.backed_up:
+            self.backed_up = backed_up
+            for session in self.sessions.values():
+                self.update_events(session)
+
+
+# the entry point of a worker process started by Server.start_workers
+def run_worker(address, port, server_path, history_path, compression, log_level):
+    configure_logging(log_level)
+    # the server and its workers share a terminal; the server shuts down on ^C and the workers follow
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Worker(address, port, server_path, history_path, compression).run()